@@ -0,0 +1,107 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2 as cv
+
+from filters import parse_filter_chain, format_filter_chain
+from pipeline import ChainCompiler
+
+# Headless entry point: applies a filter chain to every image matched by a glob
+# Must never import PyQt5, it is meant to run on servers without a display
+
+DEFAULT_BATCH_SIZE = 32
+
+# Filter chain of each pool process, parsed and compiled once by the pool initializer
+_process_chain = None
+_process_compiler = ChainCompiler()
+
+
+def _init_process(chain_description: str):
+    global _process_chain
+    _process_chain = parse_filter_chain(chain_description)
+    _process_compiler.compile(_process_chain)
+    # Each process already gets its own core, OpenCV threads would only compete with the other processes
+    cv.setNumThreads(1)
+
+
+def output_path_for(input_path: str, input_root: str, output_dir: str):
+    return os.path.join(output_dir, os.path.relpath(input_path, input_root))
+
+
+def process_batch(jobs: list):
+    # Reads the whole batch first, then filters, then writes, so each process does its I/O in bulk
+    images = [(output_path, cv.imread(input_path)) for input_path, output_path in jobs]
+    results = []
+    for output_path, image in images:
+        if image is None:
+            results.append((output_path, None))
+        else:
+            results.append((output_path, _process_compiler.apply(image, _process_chain)))
+    failed = []
+    for output_path, image in results:
+        if image is None or not cv.imwrite(output_path, image):
+            failed.append(output_path)
+    return len(jobs) - len(failed), failed
+
+
+def split_in_batches(items: list, batch_size: int):
+    return [items[index:index + batch_size] for index in range(0, len(items), batch_size)]
+
+
+def run_batch(input_glob: str, chain_description: str, output_dir: str, workers: int = None,
+              batch_size: int = DEFAULT_BATCH_SIZE, verbose: bool = True):
+    # Parsing here as well so that an invalid chain fails before any process is started
+    chain = parse_filter_chain(chain_description)
+    input_paths = sorted(path for path in glob.glob(input_glob, recursive=True) if os.path.isfile(path))
+    if not input_paths:
+        raise FileNotFoundError(f'No images match {input_glob}')
+
+    input_root = os.path.dirname(input_paths[0]) if len(input_paths) == 1 else os.path.commonpath(input_paths)
+    jobs = [(path, output_path_for(path, input_root, output_dir)) for path in input_paths]
+    for directory in {os.path.dirname(output_path) for _, output_path in jobs}:
+        os.makedirs(directory, exist_ok=True)
+
+    if verbose:
+        print(f'Applying "{format_filter_chain(chain)}" to {len(jobs)} images')
+    processed = 0
+    failed = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_process, initargs=(chain_description,)) as executor:
+        for batch_processed, batch_failed in executor.map(process_batch, split_in_batches(jobs, batch_size)):
+            processed += batch_processed
+            failed += batch_failed
+            if verbose:
+                elapsed = time.perf_counter() - start
+                print(f'\r{processed}/{len(jobs)} images, {processed / elapsed:.1f} images/s', end='', flush=True)
+    elapsed = time.perf_counter() - start
+    if verbose:
+        print()
+        print(f'Processed {processed} images in {elapsed:.2f}s ({processed / elapsed:.1f} images/s)')
+        for output_path in failed:
+            print(f'Failed: {output_path}', file=sys.stderr)
+    return processed, failed, elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Applies a filter chain to a set of images without opening a window.')
+    parser.add_argument('input', help='Glob matching the input images, e.g. "photos/**/*.jpg"')
+    parser.add_argument('chain', help='Filters in application order, e.g. "Weighted Greyscale: 0.1, 0.7, 0.2 > Blur: 9, 9 > Negate"')
+    parser.add_argument('output', help='Directory where the filtered images are written')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+    parser.add_argument('-b', '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Number of images each worker reads and writes at a time')
+    args = parser.parse_args(argv)
+
+    try:
+        _, failed, _ = run_batch(args.input, args.chain, args.output, args.workers, args.batch_size)
+    except (ValueError, FileNotFoundError) as error:
+        parser.error(str(error))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+import argparse
+import resource
+import subprocess
+import sys
+
+from benchmarks.common import RESOLUTIONS, synthetic_image, median_time, peak_allocation
+from filters import parse_filter_chain
+from pipeline import ChainCompiler, apply_stage, compile_chain
+
+# Compares applying a chain with a new array per stage against the ping-pong buffers of ChainCompiler
+# Peak RSS is measured in a separate process per mode, since it can only grow during a process' life
+
+TEN_STAGE_CHAIN = ('Blur: 5, 5 > Negate > Embossed Edges > OR Filter: 10, 20, 30 > Gaussian Blur: 9, 9 > '
+                   'Weighted Greyscale > Blur: 3, 3 > Binarize: 100 > Embossed Edges > Canny: 50, 150')
+MODES = ('allocating', 'ping-pong')
+
+
+def allocating_apply(image, stages):
+    for stage in stages:
+        image = apply_stage(stage, image)
+    return image
+
+
+def mode_function(mode: str, image, chain: list):
+    if mode == 'allocating':
+        stages = compile_chain(chain)
+        return lambda: allocating_apply(image, stages)
+    compiler = ChainCompiler()
+    return lambda: compiler.apply(image, chain, expand_grey=False)
+
+
+# Runs frames of one mode and prints its peak RSS in MB, used through a subprocess
+def measure_rss(mode: str, resolution: str, frames: int):
+    width, height = RESOLUTIONS[resolution]
+    function = mode_function(mode, synthetic_image(width, height), parse_filter_chain(TEN_STAGE_CHAIN))
+    for _ in range(frames):
+        function()
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks per-stage allocations of a ten stage chain.')
+    parser.add_argument('--resolution', default='1080p', choices=list(RESOLUTIONS))
+    parser.add_argument('--frames', type=int, default=30)
+    parser.add_argument('--rss', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.rss is not None:
+        measure_rss(args.rss, args.resolution, args.frames)
+        return
+
+    width, height = RESOLUTIONS[args.resolution]
+    image = synthetic_image(width, height)
+    chain = parse_filter_chain(TEN_STAGE_CHAIN)
+    stages = compile_chain(chain)
+    print(f'{len(stages)} stages at {args.resolution}: {stages}')
+    print(f'{"mode":>11} {"ms/frame":>9} {"new frames/frame":>17} {"peak alloc MB":>14} {"peak RSS MB":>12}')
+    for mode in MODES:
+        function = mode_function(mode, image, chain)
+        elapsed = median_time(function, args.frames)
+        if mode == 'allocating':
+            allocations = len(stages)
+        else:
+            compiler = ChainCompiler()
+            compiler.apply(image, chain, expand_grey=False)
+            compiler.allocations = 0
+            for _ in range(args.frames):
+                compiler.apply(image, chain, expand_grey=False)
+            allocations = compiler.allocations / args.frames
+        peak = peak_allocation(function, args.frames) / 2 ** 20
+        rss = subprocess.run([sys.executable, '-m', 'benchmarks.allocations', '--rss', mode, '--resolution', args.resolution,
+                              '--frames', str(args.frames)], capture_output=True, text=True, check=True).stdout.strip()
+        print(f'{mode:>11} {elapsed * 1000:>9.2f} {allocations:>17.1f} {peak:>14.2f} {float(rss):>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
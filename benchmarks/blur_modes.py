@@ -0,0 +1,51 @@
+import argparse
+import sys
+
+import numpy as np
+
+from benchmarks.common import load_pictures, median_time
+from filters import blur, gaussian_blur, BlurMode
+
+# Compares the speed and the error (PSNR against the exact mode) of every blur mode across kernel sizes
+
+KERNEL_SIZES = (15, 31, 63, 99, 151, 199)
+MODES = (BlurMode.EXACT, BlurMode.BOX, BlurMode.PYRAMID, BlurMode.AUTO)
+# Lowest PSNR against EXACT documented for each mode in filters.BlurMode, checked for every kernel size
+DOCUMENTED_MIN_PSNR = {BlurMode.BOX: 45.0, BlurMode.PYRAMID: 24.5}
+
+
+def psnr(expected: np.ndarray, result: np.ndarray):
+    mse = np.mean((expected.astype(np.float64) - result) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the blur modes for several kernel sizes.')
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    images = load_pictures(args.width, args.height)
+    failures = []
+    for name, function in (('Gaussian Blur', gaussian_blur), ('Blur', blur)):
+        print(name)
+        print(f'{"kernel":>7}' + ''.join(f'{mode.value + " ms":>14}{mode.value + " dB":>14}' for mode in MODES))
+        for kernel_size in KERNEL_SIZES:
+            size = np.array([kernel_size, kernel_size])
+            row = f'{kernel_size:>7}'
+            for mode in MODES:
+                elapsed = median_time(lambda: function(images[0], size, mode), args.repeats)
+                worst_psnr = min(psnr(function(image, size, BlurMode.EXACT), function(image, size, mode)) for image in images)
+                row += f'{elapsed * 1000:>14.1f}{worst_psnr:>14.1f}'
+                if worst_psnr < DOCUMENTED_MIN_PSNR.get(mode, 0.0):
+                    failures.append(f'{name} {mode.value} kernel {kernel_size}: {worst_psnr:.1f} dB, documented '
+                                    f'{DOCUMENTED_MIN_PSNR[mode]:.1f} dB')
+            print(row)
+    for failure in failures:
+        print(f'Below the documented PSNR: {failure}')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
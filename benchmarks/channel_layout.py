@@ -0,0 +1,81 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from filters import parse_filter_chain
+from pipeline import compile_chain, apply_stage, expand_to_bgr
+
+# Compares the bytes written between stages when every stage returns BGR (the original behaviour)
+# against the layout aware pipeline, which keeps greyscale results in a single channel
+# Also checks that fused stages give the same output as applying the filters one by one, exiting with 1 if not
+
+GREYSCALE_HEAVY_CHAIN = ('Weighted Greyscale > Blur: 5, 5 > Negate > Gaussian Blur: 9, 9 > Embossed Edges > '
+                         'Binarize: 100 > Blur: 3, 3 > Canny: 50, 150 > Negate > Gaussian Blur: 5, 5')
+# Runs of per-pixel filters with two reductions, a foldable or not one after the first
+FUSION_CHAINS = ('Simple Greyscale > Binarize: 100 > Negate', 'Greyscale from channel: 2 > Simple Greyscale',
+                 'Simple Greyscale > Weighted Greyscale', 'Binarize: 100 > Weighted Greyscale > Negate',
+                 'Greyscale from channel: 1 > Weighted Greyscale', 'Negate > OR Filter: 10, 20, 30 > Binarize: 90')
+
+
+def run_bgr_only(image, chain):
+    written = 0
+    for filter_ in chain:
+        image = filter_.apply(image)
+        written += image.nbytes
+    return image, written
+
+
+def run_layout_aware(image, stages):
+    written = 0
+    for stage in stages:
+        image = apply_stage(stage, image)
+        written += image.nbytes
+    image = expand_to_bgr(image)
+    return image, written
+
+
+def measure(function, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result, written = function()
+        timings.append(time.perf_counter() - start)
+    return result, written, float(np.median(timings))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measures the bandwidth saved by keeping greyscale images in one channel.')
+    parser.add_argument('--chain', default=GREYSCALE_HEAVY_CHAIN)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    image = np.random.default_rng(0).integers(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+    chain = parse_filter_chain(args.chain)
+    stages = compile_chain(chain)
+
+    expected, bgr_written, bgr_time = measure(lambda: run_bgr_only(image, chain), args.repeats)
+    result, layout_written, layout_time = measure(lambda: run_layout_aware(image, stages), args.repeats)
+
+    print(f'Chain: {args.chain}')
+    print(f'Stages: {stages}')
+    print(f'Identical output: {np.array_equal(expected, result)}')
+    print(f'BGR only:     {bgr_written / 2 ** 20:8.1f} MB written between stages, {bgr_time * 1000:7.1f} ms per frame')
+    print(f'Layout aware: {layout_written / 2 ** 20:8.1f} MB written between stages, {layout_time * 1000:7.1f} ms per frame')
+    print(f'Saved {1 - layout_written / bgr_written:.0%} of the intermediate bandwidth')
+
+    mismatches = int(not np.array_equal(expected, result))
+    for description in FUSION_CHAINS:
+        chain = parse_filter_chain(description)
+        stages = compile_chain(chain)
+        identical = np.array_equal(run_bgr_only(image, chain)[0], run_layout_aware(image, stages)[0])
+        mismatches += not identical
+        print(f'{"Identical" if identical else "DIFFERENT"}: {stages}')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+import glob
+import os
+import time
+import tracemalloc
+
+import numpy as np
+import cv2 as cv
+
+PICTURES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pictures')
+
+RESOLUTIONS = {
+    'vga': (640, 480),
+    '1080p': (1920, 1080),
+    '4k': (3840, 2160),
+}
+
+
+def sticker_paths():
+    return sorted(glob.glob(os.path.join(PICTURES_DIR, '*.png')))
+
+
+# Bundled pictures flattened on white, scaled to the given resolution
+def load_pictures(width: int, height: int):
+    images = []
+    for path in sticker_paths():
+        picture = cv.imread(path, cv.IMREAD_UNCHANGED)
+        alpha = picture[:, :, 3:] / 255
+        flattened = (picture[:, :, :3] * alpha + 255 * (1 - alpha)).astype(np.uint8)
+        images.append(cv.resize(flattened, (width, height), interpolation=cv.INTER_AREA))
+    return images
+
+
+def synthetic_image(width: int, height: int, seed: int = 0):
+    return np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+
+def measure_times(function, repeats: int, warmup: int = 0):
+    for _ in range(warmup):
+        function()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def median_time(function, repeats: int):
+    return float(np.median(measure_times(function, repeats)))
+
+
+# Largest amount of memory allocated at once by one call, in bytes
+# NumPy and OpenCV's Python bindings both allocate arrays through tracemalloc-visible allocators
+def peak_allocation(function, repeats: int):
+    function()
+    tracemalloc.start()
+    peak = 0
+    try:
+        for _ in range(repeats):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            function()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return peak
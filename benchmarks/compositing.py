@@ -0,0 +1,65 @@
+import argparse
+
+import numpy as np
+import cv2 as cv
+
+from benchmarks.common import sticker_paths, median_time
+from overlays import overlay, Sticker, composite_stickers
+
+# Compares the original float64 overlay with the premultiplied in-place compositor
+
+STICKER_COUNTS = (1, 10, 100)
+
+
+def load_sticker_images(scale: float):
+    images = []
+    for path in sticker_paths():
+        image = cv.imread(path, cv.IMREAD_UNCHANGED)
+        images.append(cv.resize(image, (0, 0), fx=scale, fy=scale))
+    return images
+
+
+def place_stickers(images: list, count: int, width: int, height: int):
+    rng = np.random.default_rng(count)
+    stickers = []
+    for index in range(count):
+        image = images[index % len(images)]
+        x = int(rng.integers(-image.shape[1] // 2, width - image.shape[1] // 2))
+        y = int(rng.integers(-image.shape[0] // 2, height - image.shape[0] // 2))
+        stickers.append(Sticker(image, x, y))
+    return stickers
+
+
+def run_overlay(background, stickers):
+    frame = background.copy()
+    for sticker in stickers:
+        frame = overlay(frame, sticker.image, sticker.x, sticker.y)
+    return frame
+
+
+def run_compositor(background, stickers):
+    return composite_stickers(background.copy(), stickers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks sticker compositing with 1, 10 and 100 stickers.')
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--scale', type=float, default=0.1, help='Sticker scale, the app uses 0.1')
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    background = np.random.default_rng(0).integers(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+    images = load_sticker_images(args.scale)
+    print(f'{"stickers":>8} {"overlay ms":>11} {"compositor ms":>14} {"speedup":>8} {"max diff":>9}')
+    for count in STICKER_COUNTS:
+        stickers = place_stickers(images, count, args.width, args.height)
+        difference = np.abs(run_overlay(background, stickers).astype(np.int16) - run_compositor(background, stickers)).max()
+        overlay_time = median_time(lambda: run_overlay(background, stickers), args.repeats)
+        compositor_time = median_time(lambda: run_compositor(background, stickers), args.repeats)
+        print(f'{count:>8} {overlay_time * 1000:>11.2f} {compositor_time * 1000:>14.2f} '
+              f'{overlay_time / compositor_time:>7.1f}x {difference:>9}')
+
+
+if __name__ == '__main__':
+    main()
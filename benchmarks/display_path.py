@@ -0,0 +1,50 @@
+import argparse
+
+import cv2 as cv
+
+from benchmarks.common import RESOLUTIONS, synthetic_image, median_time, peak_allocation
+from display import DisplayBufferPool, fitted_size
+
+# Compares the original presentation path (BGR to RGB conversion, QImage.scaled and QPixmap.fromImage, each one
+# allocating a new frame) with resizing into a pooled BGR display buffer
+# Qt is not needed: its two copies are stood in for by an OpenCV resize and a NumPy copy of the same sizes
+
+DISPLAY_WIDTH = 640
+DISPLAY_HEIGHT = 480
+
+
+def allocating_path(frame):
+    frame_rgb = cv.cvtColor(frame, cv.COLOR_GRAY2RGB if frame.ndim == 2 else cv.COLOR_BGR2RGB)
+    scaled = cv.resize(frame_rgb, fitted_size(frame.shape[1], frame.shape[0], DISPLAY_WIDTH, DISPLAY_HEIGHT))
+    return scaled.copy()
+
+
+def pooled_path(pool: DisplayBufferPool):
+    def present(frame):
+        buffer = pool.acquire()
+        pool.render(frame, buffer)
+        buffer.release()
+    return present
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks presenting frames with and without pooled display buffers.')
+    parser.add_argument('--repeats', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    pool = DisplayBufferPool(DISPLAY_WIDTH, DISPLAY_HEIGHT)
+    print(f'{"frame":>12} {"allocating ms":>14} {"pooled ms":>10} {"allocating MB":>14} {"pooled MB":>10}')
+    for resolution, (width, height) in RESOLUTIONS.items():
+        for grey in (False, True):
+            frame = synthetic_image(width, height)
+            if grey:
+                frame = frame[:, :, 0].copy()
+            paths = (lambda: allocating_path(frame), lambda: pooled_path(pool)(frame))
+            times = [median_time(path, args.repeats) for path in paths]
+            allocated = [peak_allocation(path, args.repeats) / 2 ** 20 for path in paths]
+            name = resolution + (' grey' if grey else '')
+            print(f'{name:>12} {times[0] * 1000:>14.2f} {times[1] * 1000:>10.2f} {allocated[0]:>14.2f} {allocated[1]:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
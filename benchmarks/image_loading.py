@@ -0,0 +1,72 @@
+import argparse
+import os
+import tempfile
+import time
+
+import cv2 as cv
+
+from benchmarks.common import load_pictures
+from image_loading import PyramidCache, load_picture, load_sticker_image
+from proxy import ProxySource
+
+# Time to first preview of large pictures: decoding the whole file and downscaling it (the original path) against
+# load_picture with an empty pyramid cache and with the picture's pyramid cached
+# Also compares loading a sticker at 10% of its size in full and with reduced decoding
+
+DISPLAY_WIDTH = 640
+DISPLAY_HEIGHT = 480
+STICKER_SCALE = 0.1
+
+
+def original_preview(path: str):
+    image = cv.imread(path)
+    return ProxySource(image, DISPLAY_WIDTH, DISPLAY_HEIGHT).proxy
+
+
+# Seconds until load_picture hands over its first preview, and until it returns the full picture
+# Without an early preview (e.g. an uncached PNG) the first picture on screen is the full one
+def progressive_times(path: str, cache: PyramidCache):
+    start = time.perf_counter()
+    preview_times = []
+    load_picture(path, DISPLAY_WIDTH, DISPLAY_HEIGHT, cache, lambda proxy: preview_times.append(time.perf_counter()))
+    loaded = time.perf_counter()
+    return (preview_times[0] if preview_times else loaded) - start, loaded - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks time to first preview of large pictures.')
+    parser.add_argument('--width', type=int, default=12000)
+    parser.add_argument('--height', type=int, default=8000)
+    args = parser.parse_args(argv)
+
+    image = load_pictures(args.width, args.height)[0]
+    with tempfile.TemporaryDirectory() as directory:
+        print(f'{args.width}x{args.height}, display {DISPLAY_WIDTH}x{DISPLAY_HEIGHT}, times in ms')
+        print(f'{"file":>6} {"MB":>6} {"original":>9} {"cold preview":>13} {"cold full":>10} {"cached preview":>15}')
+        for extension in ('.jpg', '.png'):
+            path = os.path.join(directory, 'picture' + extension)
+            cv.imwrite(path, image)
+            start = time.perf_counter()
+            original_preview(path)
+            original = time.perf_counter() - start
+            cache = PyramidCache(os.path.join(directory, 'cache' + extension))
+            cold_preview, cold_full = progressive_times(path, cache)
+            cached_preview = progressive_times(path, cache)[0]
+            size = os.path.getsize(path) / 2 ** 20
+            print(f'{extension[1:]:>6} {size:>6.1f} {original * 1000:>9.0f} {cold_preview * 1000:>13.0f} '
+                  f'{cold_full * 1000:>10.0f} {cached_preview * 1000:>15.1f}')
+
+        path = os.path.join(directory, 'sticker.jpg')
+        cv.imwrite(path, image[:4000, :4000])
+        start = time.perf_counter()
+        cv.resize(cv.imread(path, cv.IMREAD_UNCHANGED), (0, 0), fx=STICKER_SCALE, fy=STICKER_SCALE)
+        full = time.perf_counter() - start
+        start = time.perf_counter()
+        load_sticker_image(path, STICKER_SCALE)
+        reduced = time.perf_counter() - start
+        print(f'4000x4000 JPEG sticker at {STICKER_SCALE:.0%}: full decode {full * 1000:.0f} ms, '
+              f'reduced decode {reduced * 1000:.0f} ms')
+
+
+if __name__ == '__main__':
+    main()
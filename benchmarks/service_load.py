@@ -0,0 +1,113 @@
+import argparse
+import http.client
+import json
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+import numpy as np
+
+from benchmarks.common import RESOLUTIONS, synthetic_image
+from filters import filter_chain_to_json, parse_filter_chain
+from service import DEFAULT_PORT, SERVICE_HOST
+
+# Load test of service.py: several clients send raw frames as fast as they get answers, over keep-alive connections
+# Reports throughput, latency percentiles and how many requests were turned away with 503
+
+DEFAULT_CHAIN = 'Gaussian Blur: 9, 9 > Canny: 50, 150'
+SERVER_START_TIMEOUT_SECONDS = 30
+
+
+# Responses to requests sent before measure_from (pool processes starting, chains compiling) are not counted
+def client_loop(host: str, port: int, body: bytes, headers: dict, measure_from: float, stop_at: float,
+                latencies: list, counts: dict, lock: threading.Lock):
+    connection = http.client.HTTPConnection(host, port)
+    while time.perf_counter() < stop_at:
+        start = time.perf_counter()
+        connection.request('POST', '/filter', body, headers)
+        response = connection.getresponse()
+        response.read()
+        elapsed = time.perf_counter() - start
+        if start < measure_from:
+            continue
+        with lock:
+            counts[response.status] = counts.get(response.status, 0) + 1
+            if response.status == 200:
+                latencies.append(elapsed)
+        if response.status == 503:
+            time.sleep(float(response.getheader('Retry-After', 1)))
+    connection.close()
+
+
+def wait_for_server(host: str, port: int):
+    deadline = time.perf_counter() + SERVER_START_TIMEOUT_SECONDS
+    while time.perf_counter() < deadline:
+        try:
+            connection = http.client.HTTPConnection(host, port, timeout=1)
+            connection.request('GET', '/stats')
+            connection.getresponse().read()
+            connection.close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError('The service did not start')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test of the filtering service.')
+    parser.add_argument('--url', default=f'http://{SERVICE_HOST}:{DEFAULT_PORT}')
+    parser.add_argument('-c', '--concurrency', type=int, default=16, help='Number of concurrent clients')
+    parser.add_argument('-s', '--seconds', type=float, default=10.0)
+    parser.add_argument('--warmup', type=float, default=2.0, help='Seconds of load before measuring')
+    parser.add_argument('-r', '--resolution', choices=RESOLUTIONS.keys(), default='vga')
+    parser.add_argument('--chain', default=DEFAULT_CHAIN, help='Filter chain, in the syntax of batch.py')
+    parser.add_argument('--spawn', action='store_true', help='Start service.py for the duration of the test')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Workers of the spawned service')
+    args = parser.parse_args(argv)
+
+    url = urlparse(args.url)
+    host, port = url.hostname, url.port or DEFAULT_PORT
+    server = None
+    if args.spawn:
+        command = [sys.executable, 'service.py', '--port', str(port)]
+        if args.workers is not None:
+            command += ['--workers', str(args.workers)]
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_server(host, port)
+        width, height = RESOLUTIONS[args.resolution]
+        frame = synthetic_image(width, height)
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'X-Image-Shape': ','.join(str(value) for value in frame.shape),
+            'X-Filter-Chain': json.dumps(filter_chain_to_json(parse_filter_chain(args.chain))),
+        }
+        latencies = []
+        counts = {}
+        lock = threading.Lock()
+        measure_from = time.perf_counter() + args.warmup
+        stop_at = measure_from + args.seconds
+        clients = [threading.Thread(target=client_loop, args=(host, port, frame.tobytes(), headers, measure_from,
+                                                              stop_at, latencies, counts, lock))
+                   for _ in range(args.concurrency)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print(f'{args.concurrency} clients, {args.resolution}, {args.chain}')
+    print(f'Throughput: {len(latencies) / args.seconds:.1f} images/s')
+    if latencies:
+        latencies_ms = np.array(latencies) * 1000
+        print(f'Latency: p50 {np.percentile(latencies_ms, 50):.1f} ms, p99 {np.percentile(latencies_ms, 99):.1f} ms')
+    print('Responses: ' + ', '.join(f'{status}: {count}' for status, count in sorted(counts.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import cv2 as cv
+
+from benchmarks.common import RESOLUTIONS, load_pictures, synthetic_image, sticker_paths, measure_times
+from filters import get_image_filter_list, parse_filter_chain
+from overlays import overlay, Sticker, composite_stickers
+from pipeline import ChainCompiler
+
+# Headless benchmark of every filter, some representative chains and the sticker overlays
+# "run" writes the results to a JSON file, "compare" flags cases that got slower than a saved baseline
+
+REPRESENTATIVE_CHAINS = {
+    'greyscale_negate_binarize': 'Simple Greyscale > Negate > Binarize: 127',
+    'weighted_gaussian_canny': 'Weighted Greyscale > Gaussian Blur: 15, 15 > Canny: 50, 150',
+    'blur_emboss_negate': 'Blur: 15, 15 > Embossed Edges > Negate',
+    'large_gaussian_pencil': 'Gaussian Blur: 99, 99 > Pencil Sketch',
+}
+OVERLAY_STICKERS = 10
+STICKER_SCALE = 0.1
+DEFAULT_REPEATS = 7
+DEFAULT_REGRESSION_THRESHOLD = 0.10
+
+
+def benchmark_images(resolution: str):
+    width, height = RESOLUTIONS[resolution]
+    return {'synthetic': synthetic_image(width, height), 'picture': load_pictures(width, height)[0]}
+
+
+def load_stickers(width: int, height: int):
+    images = [cv.resize(cv.imread(path, cv.IMREAD_UNCHANGED), (0, 0), fx=STICKER_SCALE, fy=STICKER_SCALE)
+              for path in sticker_paths()]
+    rng = np.random.default_rng(0)
+    return [Sticker(images[index % len(images)], int(rng.integers(0, width)), int(rng.integers(0, height)))
+            for index in range(OVERLAY_STICKERS)]
+
+
+def run_overlay(image, stickers):
+    frame = image.copy()
+    for sticker in stickers:
+        frame = overlay(frame, sticker.image, sticker.x, sticker.y)
+    return frame
+
+
+# Every case is a function of the input image, named "<group>/<name>"
+def benchmark_cases(width: int, height: int):
+    cases = {}
+    for filter_ in get_image_filter_list():
+        cases['filter/' + filter_.display_name] = filter_.apply
+    for name, description in REPRESENTATIVE_CHAINS.items():
+        chain = parse_filter_chain(description)
+        compiler = ChainCompiler()
+        cases['chain/' + name] = lambda image, chain=chain, compiler=compiler: compiler.apply(image, chain)
+    stickers = load_stickers(width, height)
+    cases[f'overlay/overlay x{OVERLAY_STICKERS}'] = lambda image: run_overlay(image, stickers)
+    cases[f'overlay/composite_stickers x{OVERLAY_STICKERS}'] = lambda image: composite_stickers(image.copy(), stickers)
+    return cases
+
+
+def run_suite(resolutions: list, repeats: int, case_filter: str = None, verbose: bool = True):
+    results = {}
+    for resolution in resolutions:
+        width, height = RESOLUTIONS[resolution]
+        images = benchmark_images(resolution)
+        for case_name, function in benchmark_cases(width, height).items():
+            if case_filter is not None and case_filter not in case_name:
+                continue
+            for source, image in images.items():
+                timings = measure_times(lambda: function(image), repeats, warmup=1)
+                median = float(np.median(timings))
+                result = {
+                    'resolution': resolution,
+                    'source': source,
+                    'median_ms': median * 1000,
+                    'p95_ms': float(np.percentile(timings, 95)) * 1000,
+                    'mb_per_s': image.nbytes / 2 ** 20 / median,
+                }
+                case_id = f'{case_name}@{resolution}/{source}'
+                results[case_id] = result
+                if verbose:
+                    print(f'{case_id:60} {result["median_ms"]:9.2f} ms  p95 {result["p95_ms"]:9.2f} ms  '
+                          f'{result["mb_per_s"]:9.1f} MB/s')
+    return results
+
+
+def environment():
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv.__version__,
+        'cpu_count': os.cpu_count(),
+    }
+
+
+# Returns the ids of the cases whose median time grew by more than threshold (0.10 = 10%)
+def compare_results(baseline: dict, current: dict, threshold: float, verbose: bool = True):
+    regressions = []
+    for case_id, result in current['results'].items():
+        if case_id not in baseline['results']:
+            continue
+        ratio = result['median_ms'] / baseline['results'][case_id]['median_ms']
+        regressed = ratio > 1 + threshold
+        if regressed:
+            regressions.append(case_id)
+        if verbose:
+            flag = 'REGRESSION' if regressed else ('faster' if ratio < 1 - threshold else '')
+            print(f'{case_id:60} {baseline["results"][case_id]["median_ms"]:9.2f} -> {result["median_ms"]:9.2f} ms '
+                  f'({ratio - 1:+6.1%}) {flag}')
+    missing = set(baseline['results']) - set(current['results'])
+    if verbose and missing:
+        print(f'{len(missing)} baseline case(s) were not run')
+    return regressions
+
+
+def load_results(path: str):
+    with open(path) as file:
+        return json.load(file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks filters, chains and overlays without a camera or a display.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Runs the benchmarks and writes the results to a JSON file')
+    run_parser.add_argument('output', help='JSON file the results are written to')
+    run_parser.add_argument('--resolutions', default=','.join(RESOLUTIONS),
+                            help=f'Comma separated subset of {", ".join(RESOLUTIONS)}')
+    run_parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    run_parser.add_argument('--filter', help='Only runs the cases whose name contains this text')
+    run_parser.add_argument('--baseline', help='Compares the results with this JSON file once they are written')
+    run_parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD)
+
+    compare_parser = subparsers.add_parser('compare', help='Compares two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                                help='Relative slowdown of the median reported as a regression')
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        resolutions = [resolution.strip() for resolution in args.resolutions.split(',')]
+        unknown = [resolution for resolution in resolutions if resolution not in RESOLUTIONS]
+        if unknown:
+            parser.error(f'Unknown resolution(s): {", ".join(unknown)}')
+        current = {'environment': environment(), 'results': run_suite(resolutions, args.repeats, args.filter)}
+        with open(args.output, 'w') as file:
+            json.dump(current, file, indent=2)
+        if args.baseline is None:
+            return 0
+        baseline = load_results(args.baseline)
+    else:
+        baseline = load_results(args.baseline)
+        current = load_results(args.current)
+
+    regressions = compare_results(baseline, current, args.threshold)
+    if regressions:
+        print(f'{len(regressions)} regression(s) above {args.threshold:.0%}')
+        return 1
+    print('No regressions')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+import math
+import threading
+import time
+
+import cv2 as cv
+import numpy as np
+
+# Skips recomputing camera frames, or parts of them, that did not change since the result being reused
+# Frames are compared on a grid of block means, which averages sensor noise away and costs a single resize
+# Must never import PyQt5, so it can be fed synthetic frames
+
+DEFAULT_BLOCK_SIZE = 16
+# Mean absolute difference of a block (0..255, on its most changed channel) above which it is recomputed
+DEFAULT_CHANGE_THRESHOLD = 4
+# Above this fraction of changed rows, recomputing stripes costs about as much as the whole frame
+MAX_PARTIAL_FRACTION = 0.5
+
+
+# Sensitivity shared by every processing thread, with their hit rate and the processing time they saved
+# A threshold of 0 turns change detection off
+class ChangeTracker:
+    def __init__(self, threshold: int = DEFAULT_CHANGE_THRESHOLD, block_size: int = DEFAULT_BLOCK_SIZE):
+        self.threshold = threshold
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.reused = 0
+        self.partial = 0
+        self.full = 0
+        self.spent_seconds = 0.0
+        self.saved_seconds = 0.0
+
+    def record(self, kind: str, spent: float, full_cost: float | None):
+        with self.lock:
+            self.frames += 1
+            setattr(self, kind, getattr(self, kind) + 1)
+            self.spent_seconds += spent
+            if full_cost is not None:
+                self.saved_seconds += max(full_cost - spent, 0.0)
+
+    def hit_rate(self):
+        return self.reused / self.frames if self.frames else 0.0
+
+    def saved_fraction(self):
+        total = self.spent_seconds + self.saved_seconds
+        return self.saved_seconds / total if total > 0 else 0.0
+
+    def reset(self):
+        with self.lock:
+            self.frames = self.reused = self.partial = self.full = 0
+            self.spent_seconds = self.saved_seconds = 0.0
+
+    def stats_text(self):
+        if self.threshold <= 0:
+            return 'Change detection off'
+        return (f'Unchanged: {self.hit_rate():.0%} reused, {self.partial} partial, {self.full} full, '
+                f'{self.saved_fraction():.0%} CPU saved')
+
+
+# Row ranges (in pixels) of the frame covered by the block rows that changed, grown by margin and merged when they touch
+def dirty_row_ranges(changed_rows: np.ndarray, height: int, margin: int = 0):
+    block_rows = len(changed_rows)
+    ranges = []
+    for block_row in np.flatnonzero(changed_rows):
+        # Block means are area averages, a block may cover a fraction of the rows next to it
+        top = max(0, math.floor(block_row * height / block_rows) - 1 - margin)
+        bottom = min(height, math.ceil((block_row + 1) * height / block_rows) + 1 + margin)
+        if ranges and top <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], bottom)
+        else:
+            ranges.append([top, bottom])
+    return [tuple(row_range) for row_range in ranges]
+
+
+# Applies a chain to camera frames, reusing the previous result when nothing changed and recomputing only
+# the rows that did otherwise, each extended by the chain's halo so the result matches a full recompute
+# Holds the previous frame and result, so every processing thread needs its own
+class IncrementalProcessor:
+    def __init__(self, tracker: ChangeTracker):
+        self.tracker = tracker
+        self.reference = None
+        self.result = None
+        self.result_key = None
+        self.full_cost = None
+
+    def signature(self, frame: np.ndarray):
+        rows = max(1, frame.shape[0] // self.tracker.block_size)
+        columns = max(1, frame.shape[1] // self.tracker.block_size)
+        return cv.resize(frame, (columns, rows), interpolation=cv.INTER_AREA).astype(np.int16)
+
+    # key identifies everything besides the frame the result depends on (chain parameters, frame size, ...)
+    # halo: rows each stripe needs above and below, None if the chain can only be applied to whole frames
+    # apply_chain: function from an image (the frame or a stripe of it) to its filtered result
+    def __call__(self, frame: np.ndarray, key, halo: int | None, apply_chain):
+        start = time.perf_counter()
+        threshold = self.tracker.threshold
+        if threshold <= 0:
+            self.reference = None
+            return apply_chain(frame)
+        signature = self.signature(frame)
+        if key != self.result_key or self.reference is None or self.reference.shape != signature.shape:
+            return self.recompute(frame, signature, key, apply_chain, start)
+
+        difference = np.abs(signature - self.reference)
+        changed_blocks = (difference.max(axis=2) if difference.ndim == 3 else difference) > threshold
+        changed_rows = changed_blocks.any(axis=1)
+        if not changed_rows.any():
+            self.tracker.record('reused', self.elapsed(start), self.full_cost)
+            return self.result
+        if halo is None or changed_rows.mean() > MAX_PARTIAL_FRACTION:
+            return self.recompute(frame, signature, key, apply_chain, start)
+
+        # The held result may still be on its way to the display, so stripes are pasted on a copy
+        result = self.result.copy()
+        height = frame.shape[0]
+        # A changed pixel moves the results up to halo rows away, computing those needs another halo of input
+        for top, bottom in dirty_row_ranges(changed_rows, height, halo):
+            extended_top = max(0, top - halo)
+            extended_bottom = min(height, bottom + halo)
+            stripe = apply_chain(frame[extended_top:extended_bottom])
+            result[top:bottom] = stripe[top - extended_top:bottom - extended_top]
+        # Blocks under the threshold keep their old reference, so slow drifts still add up to a change
+        self.reference[changed_rows] = signature[changed_rows]
+        self.result = result
+        self.tracker.record('partial', self.elapsed(start), self.full_cost)
+        return result
+
+    def recompute(self, frame: np.ndarray, signature: np.ndarray, key, apply_chain, start):
+        self.result = apply_chain(frame)
+        self.result_key = key
+        self.reference = signature
+        self.full_cost = self.elapsed(start)
+        self.tracker.record('full', self.full_cost, None)
+        return self.result
+
+    @staticmethod
+    def elapsed(start):
+        return time.perf_counter() - start
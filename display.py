@@ -0,0 +1,71 @@
+import threading
+
+import cv2 as cv
+import numpy as np
+
+# Display buffers reused frame after frame, so that presenting a frame allocates no new frame-sized arrays
+# The presenter resizes each result straight into a free buffer, the GUI thread draws it without converting it,
+# and the buffer returns to the pool when the next frame replaces it on screen
+# Must never import PyQt5, so the pool can be measured headless
+
+DEFAULT_DISPLAY_BUFFERS = 3
+
+
+# Largest size with the image's aspect ratio fitting in max_width x max_height, like Qt.KeepAspectRatio
+def fitted_size(width: int, height: int, max_width: int, max_height: int):
+    scale = min(max_width / width, max_height / height)
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+class DisplayBuffer:
+    def __init__(self, pool, max_width: int, max_height: int):
+        self.pool = pool
+        self.data = np.zeros((max_height, max_width, 3), dtype=np.uint8)
+        # View of data holding the current frame, smaller than data when the aspect ratios differ
+        self.image = self.data
+        # Whatever the GUI wraps around the buffer (e.g. a QImage), kept alive as long as the buffer is in use
+        self.handle = None
+
+    def release(self):
+        self.handle = None
+        self.pool.release(self)
+
+
+# A fixed number of BGR buffers of the display size
+# Three are enough for one frame on screen, one waiting for the GUI thread and one being rendered
+class DisplayBufferPool:
+    def __init__(self, max_width: int, max_height: int, buffers: int = DEFAULT_DISPLAY_BUFFERS):
+        self.max_width = max_width
+        self.max_height = max_height
+        self.condition = threading.Condition()
+        self.free = [DisplayBuffer(self, max_width, max_height) for _ in range(buffers)]
+        # Greyscale results are resized here before being expanded into a buffer, only used by the rendering thread
+        self.grey_scratch = np.zeros((max_height, max_width), dtype=np.uint8)
+        self.dropped = 0
+
+    # Returns None if no buffer was released before the timeout, the frame should then be dropped
+    def acquire(self, timeout: float = None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.free, timeout):
+                self.dropped += 1
+                return None
+            return self.free.pop()
+
+    def release(self, buffer: DisplayBuffer):
+        with self.condition:
+            self.free.append(buffer)
+            self.condition.notify()
+
+    # Resizes a BGR or greyscale frame into the buffer in a single pass, keeping its aspect ratio
+    # Bilinear costs little even from 4K and looks better than the nearest neighbour QImage.scaled it replaces
+    def render(self, frame: np.ndarray, buffer: DisplayBuffer):
+        width, height = fitted_size(frame.shape[1], frame.shape[0], self.max_width, self.max_height)
+        target = buffer.data[:height, :width]
+        if frame.ndim == 2:
+            grey = self.grey_scratch[:height, :width]
+            cv.resize(frame, (width, height), dst=grey, interpolation=cv.INTER_LINEAR)
+            cv.cvtColor(grey, cv.COLOR_GRAY2BGR, dst=target)
+        else:
+            cv.resize(frame, (width, height), dst=target, interpolation=cv.INTER_LINEAR)
+        buffer.image = target
+        return buffer
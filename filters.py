@@ -1,73 +1,312 @@
+import copy
 import numpy as np
 from enum import Enum
 from typing import Callable
 import cv2 as cv
 
+from profiling import PROFILER
 
-def simple_greyscale(image: np.ndarray):
+
+# Channel layout of the images passed between filters
+# Greyscale results are kept in a single channel and only expanded to BGR when a later stage needs colour
+class ChannelLayout(Enum):
+    GREY = 1
+    BGR = 3
+
+
+ANY_LAYOUT = (ChannelLayout.GREY, ChannelLayout.BGR)
+
+
+def image_layout(image: np.ndarray):
+    return ChannelLayout.GREY if image.ndim == 2 else ChannelLayout.BGR
+
+
+def expand_to_bgr(image: np.ndarray, dst: np.ndarray = None):
+    if image.ndim == 2:
+        return cv.cvtColor(image, cv.COLOR_GRAY2BGR, dst=dst)
+    if dst is not None:
+        np.copyto(dst, image)
+        return dst
+    return image
+
+
+# The "_values" functions and most filters accept dst, an array of the result's shape and dtype written in place of
+# allocating a new one; functions whose result may also be their own input say so in their ImageFilter (in_place)
+
+# Result written to dst when given, otherwise returned as is
+def to_dst(values: np.ndarray, dst: np.ndarray = None):
+    if dst is None or values is dst:
+        return values
+    np.copyto(dst, values, casting='unsafe')
+    return dst
+
+
+def simple_greyscale_values(image: np.ndarray, dst: np.ndarray = None):
+    # The mean of three equal channels is the channel itself
+    if image.ndim == 2:
+        return to_dst(image, dst)
+    # The sum of three uint8 fits in uint16, and its floor division is exactly the truncated mean
+    sums = image.sum(-1, dtype=np.uint16)
+    np.floor_divide(sums, 3, out=sums)
+    return to_dst(sums, dst) if dst is not None else sums.astype(np.uint8)
+
+
+def simple_greyscale(image: np.ndarray, dst: np.ndarray = None):
+    return cv.cvtColor(simple_greyscale_values(image), cv.COLOR_GRAY2BGR, dst=dst)
+
+
+def weighted_greyscale_values(image: np.ndarray, weights: np.ndarray, dst: np.ndarray = None):
     original_shape = image.shape
     image = (image.reshape(-1, 3)
-             .mean(-1)
+             .dot(weights)
              .astype(np.uint8)
              .reshape(original_shape[0], original_shape[1]))
-    return cv.cvtColor(image, cv.COLOR_GRAY2BGR)
+    return to_dst(np.where(image < 255, image, 255), dst)
 
 
 # Allows for user selected vector of weights
 # Binds pixel value to maximum of 255
-def weighted_greyscale(image: np.ndarray, weights: np.ndarray):
-    original_shape = image.shape
-    image = (image.reshape(-1, 3)
-             .dot(weights)
-             .astype(np.uint8)
-             .reshape(original_shape[0], original_shape[1]))
-    image = np.where(image < 255, image, 255)
-    return cv.cvtColor(image, cv.COLOR_GRAY2BGR)
+def weighted_greyscale(image: np.ndarray, weights: np.ndarray, dst: np.ndarray = None):
+    return cv.cvtColor(weighted_greyscale_values(image, weights), cv.COLOR_GRAY2BGR, dst=dst)
 
 
-def greyscale_from_channel(image: np.ndarray, channel: int):
-    original_shape = image.shape
-    image = image.reshape(-1, 3)[:, channel].reshape(original_shape[0], original_shape[1])
-    return cv.cvtColor(image, cv.COLOR_GRAY2BGR)
+def greyscale_from_channel_values(image: np.ndarray, channel: int, dst: np.ndarray = None):
+    if image.ndim == 2:
+        return to_dst(image, dst)
+    return cv.extractChannel(image, channel, dst=dst)
+
+
+def greyscale_from_channel(image: np.ndarray, channel: int, dst: np.ndarray = None):
+    return cv.cvtColor(greyscale_from_channel_values(image, channel), cv.COLOR_GRAY2BGR, dst=dst)
+
+
+# Safe in place (dst may be image), like negate
+def filter_or(image: np.ndarray, color: np.ndarray, dst: np.ndarray = None):
+    # Colour components are 0..255, so OR-ing their low byte gives the same result as the original int64 OR
+    return np.bitwise_or(image, np.asarray(color).astype(np.uint8), out=dst)
+
+
+def negate(image, dst: np.ndarray = None):
+    return np.bitwise_xor(image, 255, out=dst)
+
+
+def binarize_values(image: np.ndarray, threshold: int, dst: np.ndarray = None):
+    grey = simple_greyscale_values(image, dst)
+    # Pixels above threshold become 255, like np.where(grey > threshold, 255, 0)
+    return cv.threshold(grey, threshold, 255, cv.THRESH_BINARY, dst=dst)[1]
+
+
+def binarize(image: np.ndarray, threshold: int, dst: np.ndarray = None):
+    return cv.cvtColor(binarize_values(image, threshold), cv.COLOR_GRAY2BGR, dst=dst)
+
+
+# How blur and gaussian_blur compute large kernels
+# EXACT: the OpenCV filter itself
+# BOX: three box filters whose sizes match the Gaussian variance (only for gaussian_blur, blur already is one),
+#      cost independent of the kernel size, PSNR of at least 45 dB against EXACT on the bundled pictures
+# PYRAMID: blurs a pyrDown-reduced image with a proportionally smaller kernel and scales it back up,
+#          fastest for very large kernels but as low as 24.5 dB against EXACT (worst case measured 24.8 dB,
+#          Gaussian kernel 151 at 640x480), the error grows with fine texture and smaller pictures
+# AUTO: EXACT below LARGE_KERNEL_THRESHOLD, otherwise BOX for gaussian_blur and EXACT for blur
+# The error bounds are measured by benchmarks/blur_modes.py, which fails when a mode falls below its bound
+class BlurMode(Enum):
+    AUTO = 'auto'
+    EXACT = 'exact'
+    BOX = 'box'
+    PYRAMID = 'pyramid'
+
+
+LARGE_KERNEL_THRESHOLD = 31
+BOX_PASSES = 3
+# Smallest kernel the reduced image is blurred with, fewer levels are used if it would be smaller
+PYRAMID_MIN_KERNEL = 9
+
+
+# Sigma OpenCV derives from a kernel size when none is given
+def gaussian_sigma(kernel_size: int):
+    return 0.3 * ((kernel_size - 1) * 0.5 - 1) + 0.8
+
+
+# Box sizes whose repeated application has the variance of a Gaussian (Kovesi, "Fast almost-Gaussian filtering")
+def box_sizes_for_sigma(sigma: float, passes: int = BOX_PASSES):
+    ideal_width = np.sqrt(12 * sigma ** 2 / passes + 1)
+    lower = int(np.floor(ideal_width))
+    if lower % 2 == 0:
+        lower -= 1
+    upper = lower + 2
+    lower_count = round((12 * sigma ** 2 - passes * lower ** 2 - 4 * passes * lower - 3 * passes) / (-4 * lower - 4))
+    lower_count = min(max(lower_count, 0), passes)
+    return [lower] * lower_count + [upper] * (passes - lower_count)
+
 
+def pyramid_levels(kernel_size: int):
+    levels = 0
+    while kernel_size // 2 ** (levels + 1) >= PYRAMID_MIN_KERNEL:
+        levels += 1
+    return levels
 
-def filter_or(image: np.ndarray, color: np.ndarray):
-    return (image | color).astype(np.uint8)
 
+def pyramid_filter(image: np.ndarray, levels: int, reduced_filter: Callable, dst: np.ndarray = None):
+    reduced = image
+    for _ in range(levels):
+        reduced = cv.pyrDown(reduced)
+    reduced = reduced_filter(reduced)
+    return cv.resize(reduced, (image.shape[1], image.shape[0]), dst=dst, interpolation=cv.INTER_LINEAR)
 
-def negate(image):
-    return image ^ 255
 
+def pyramid_variance(levels: int):
+    # Each pyrDown adds a blur of variance 4 ** level, in full resolution pixels
+    return (4 ** levels - 1) / 3
 
-def binarize(image: np.ndarray, threshold: int):
-    image = simple_greyscale(image)
-    return np.where(image > threshold, 255, 0).astype(np.uint8)
 
+def reduced_box_size(size: int, levels: int):
+    variance = max((size ** 2 - 1) / 12 - pyramid_variance(levels), 0) / 4 ** levels
+    return max(1, round(np.sqrt(12 * variance + 1)))
 
-def blur(image: np.ndarray, size: np.ndarray):
-    return cv.blur(image, tuple(size))
 
+def select_blur_mode(size: np.ndarray, mode: BlurMode, large_kernel_mode: BlurMode):
+    if mode != BlurMode.AUTO:
+        return mode
+    return large_kernel_mode if max(size) >= LARGE_KERNEL_THRESHOLD else BlurMode.EXACT
 
-def gaussian_blur(image: np.ndarray, size: np.ndarray):
+
+def blur(image: np.ndarray, size: np.ndarray, mode: BlurMode = BlurMode.AUTO, dst: np.ndarray = None):
+    # cv.blur uses running sums, so its cost does not depend on the kernel size and AUTO always keeps it exact
+    if select_blur_mode(size, mode, BlurMode.EXACT) == BlurMode.PYRAMID:
+        levels = pyramid_levels(min(size))
+        # pyrDown already smooths each level, its variance is taken out of the reduced box
+        reduced_size = tuple(reduced_box_size(int(value), levels) for value in size)
+        return pyramid_filter(image, levels, lambda reduced: cv.blur(reduced, reduced_size), dst)
+    return cv.blur(image, tuple(size), dst=dst)
+
+
+def gaussian_blur(image: np.ndarray, size: np.ndarray, mode: BlurMode = BlurMode.AUTO, dst: np.ndarray = None):
     size = size - (size % 2 == 0)
-    return cv.GaussianBlur(image, tuple(size), 0)
+    mode = select_blur_mode(size, mode, BlurMode.BOX)
+    if mode == BlurMode.BOX:
+        sizes = zip(box_sizes_for_sigma(gaussian_sigma(size[0])), box_sizes_for_sigma(gaussian_sigma(size[1])))
+        # The first pass leaves the input untouched, the others run in place on its result
+        for box_size in sizes:
+            image = cv.blur(image, box_size, dst=dst)
+            dst = image
+        return image
+    if mode == BlurMode.PYRAMID:
+        levels = pyramid_levels(min(size))
+        # The variance pyrDown already added is taken out of the blur done on the reduced image
+        sigmas = [np.sqrt(max(gaussian_sigma(value) ** 2 - pyramid_variance(levels), 0.25)) / 2 ** levels for value in size]
+        return pyramid_filter(image, levels, lambda reduced: cv.GaussianBlur(reduced, (0, 0), sigmas[0], sigmaY=sigmas[1]), dst)
+    return cv.GaussianBlur(image, tuple(size), 0, dst=dst)
 
 
-def canny(image: np.ndarray, thresholds: list):
-    image = cv.Canny(cv.cvtColor(image, cv.COLOR_BGR2GRAY), *thresholds)
-    return cv.cvtColor(image, cv.COLOR_GRAY2BGR)
+def canny_values(image: np.ndarray, thresholds: list, dst: np.ndarray = None):
+    if image.ndim == 3:
+        image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    return cv.Canny(image, *thresholds, edges=dst)
 
 
-def embossed_edges(image):
+def canny(image: np.ndarray, thresholds: list, dst: np.ndarray = None):
+    return cv.cvtColor(canny_values(image, thresholds), cv.COLOR_GRAY2BGR, dst=dst)
+
+
+def embossed_edges(image, dst: np.ndarray = None):
     kernel = np.array([[0, -3, -3],
                        [3, 0, -3],
                        [3, 3, 0]])
-    img_emboss = cv.filter2D(image, -1, kernel=kernel)
+    img_emboss = cv.filter2D(image, -1, kernel=kernel, dst=dst)
     return img_emboss
 
 
+def pencil_sketch_values(image):
+    return cv.pencilSketch(image)[0]
+
+
 def pencil_sketch(image):
-    return cv.cvtColor(cv.pencilSketch(image)[0], cv.COLOR_GRAY2BGR)
+    return cv.cvtColor(pencil_sketch_values(image), cv.COLOR_GRAY2BGR)
+
+
+# Description of a filter that works on one pixel at a time, used by the chain compiler to fuse consecutive filters
+# reduce: optional function turning a BGR image into a single channel image, applied first, with an optional dst
+# table: optional 256 x 3 lookup table (one column per BGR channel) applied afterwards
+# foldable: whether reduce gives the same result for a pixel regardless of the rest of the image,
+# so that it can be evaluated on a lookup table instead of on the frame
+# grey_input: whether reduce also accepts single channel images
+class PixelOperation:
+    def __init__(self, reduce: Callable = None, table: np.ndarray = None, foldable: bool = True, grey_input: bool = True):
+        self.reduce = reduce
+        self.table = table
+        self.foldable = foldable
+        self.grey_input = grey_input
+
+
+def channel_table(values: np.ndarray):
+    values = values.astype(np.uint8)
+    if values.ndim == 1:
+        values = np.repeat(values[:, np.newaxis], 3, axis=1)
+    return np.ascontiguousarray(values)
+
+
+def simple_greyscale_operation():
+    return PixelOperation(reduce=simple_greyscale_values)
+
+
+def weighted_greyscale_operation(weights: np.ndarray):
+    # The dot product may be evaluated differently depending on the array size, so it is only safe on whole frames
+    weights = weights.copy()
+    return PixelOperation(reduce=lambda image, dst=None: weighted_greyscale_values(image, weights, dst),
+                          foldable=False, grey_input=False)
+
+
+def greyscale_from_channel_operation(channel: int):
+    return PixelOperation(reduce=lambda image, dst=None: greyscale_from_channel_values(image, channel, dst))
+
+
+def filter_or_operation(color: np.ndarray):
+    return PixelOperation(table=channel_table(np.arange(256)[:, np.newaxis] | np.asarray(color)[np.newaxis, :]))
+
+
+def negate_operation():
+    return PixelOperation(table=channel_table(np.arange(256) ^ 255))
+
+
+def binarize_operation(threshold: int):
+    return PixelOperation(reduce=simple_greyscale_values, table=channel_table(np.where(np.arange(256) > threshold, 255, 0)))
+
+
+# Rows a filter needs above and below a horizontal stripe to give the same result as on the whole frame
+# Filters that cannot be split in stripes (e.g. Canny, whose hysteresis follows edges across the frame) have none
+def no_halo(*_):
+    return 0
+
+
+def blur_halo(size: np.ndarray, mode: BlurMode = BlurMode.AUTO):
+    # The pyramid path resamples the frame, so stripes would not line up with the whole-frame result
+    if select_blur_mode(size, mode, BlurMode.EXACT) == BlurMode.PYRAMID:
+        return None
+    return int(size[1]) // 2
+
+
+def gaussian_blur_halo(size: np.ndarray, mode: BlurMode = BlurMode.AUTO):
+    size = size - (size % 2 == 0)
+    mode = select_blur_mode(size, mode, BlurMode.BOX)
+    if mode == BlurMode.PYRAMID:
+        return None
+    if mode == BlurMode.BOX:
+        return sum(box_size // 2 for box_size in box_sizes_for_sigma(gaussian_sigma(size[1])))
+    return int(size[1]) // 2
+
+
+def embossed_edges_halo():
+    return 1
+
+
+# Parameter values giving a similar look on an image downscaled by scale
+# gradient_ratio is how much stronger the gradients of the downscaled image are, which is what Canny thresholds compare to
+def blur_scaled_size(size: np.ndarray, scale: float, gradient_ratio: float):
+    return np.maximum(1, np.round(size * scale)).astype(size.dtype)
+
+
+def canny_scaled_thresholds(thresholds: list, scale: float, gradient_ratio: float):
+    return [max(1, int(round(threshold * gradient_ratio))) for threshold in thresholds]
 
 
 class FilterParameterType(Enum):
@@ -86,20 +325,89 @@ class ImageFilter:
                  filter_parameter_type: FilterParameterType,
                  filter_parameter_name: str = "",
                  filter_parameter_value=None,
-                 min_max_param_value: tuple = None):
+                 min_max_param_value: tuple = None,
+                 pixel_operation: Callable = None,
+                 layout_function: Callable = None,
+                 input_layouts: tuple = (ChannelLayout.BGR,),
+                 output_layout: ChannelLayout | None = ChannelLayout.BGR,
+                 tile_halo: Callable = None,
+                 filter_options: dict = None,
+                 scale_parameter: Callable = None,
+                 accepts_dst: bool = False,
+                 in_place: bool = False):
         self.display_name = display_name
+        self.profiler_name = 'filter/' + display_name
         self.filter_id = filter_id
         self.filter_function = filter_function
         self.filter_parameter_type = filter_parameter_type
         self.filter_parameter_name = filter_parameter_name
         self.filter_parameter_value = filter_parameter_value
         self.min_max_param_value = min_max_param_value
-
-    def apply(self, image):
+        # Builds the PixelOperation for the current parameter value, None if the filter depends on neighbouring pixels
+        self.pixel_operation = pixel_operation
+        # Same as filter_function, but may return a single channel image and accepts every layout in input_layouts
+        # output_layout is None when the result has the same layout as the input
+        self.layout_function = layout_function if layout_function is not None else filter_function
+        self.input_layouts = input_layouts
+        self.output_layout = output_layout
+        # Returns the stripe halo for the current parameter value, None if the filter cannot be tiled
+        self.tile_halo = tile_halo
+        # Keyword arguments passed to every function of the filter, e.g. the blur mode
+        self.filter_options = filter_options if filter_options is not None else {}
+        # Returns the parameter value to use on a downscaled image, None if the parameter does not depend on the scale
+        self.scale_parameter = scale_parameter
+        # Whether the filter's functions take a dst output array, and whether that array may be the input itself
+        self.accepts_dst = accepts_dst
+        self.in_place = in_place
+
+    # Calls one of the filter's functions with the current parameter value and options
+    def call_with_parameters(self, function: Callable, *args, **keywords):
         if self.filter_parameter_value is not None:
-            return self.filter_function(image, self.filter_parameter_value)
-        else:
-            return self.filter_function(image)
+            args += (self.filter_parameter_value,)
+        return function(*args, **self.filter_options, **keywords)
+
+    # dst is only used by filters that accept one, the result must be taken from the return value
+    def apply(self, image, dst: np.ndarray = None):
+        start = PROFILER.start()
+        result = self.call_with_parameters(self.filter_function, image, **self.dst_keywords(dst))
+        PROFILER.stop(self.profiler_name, start)
+        return result
+
+    def apply_layout(self, image, dst: np.ndarray = None):
+        return self.call_with_parameters(self.layout_function, image, **self.dst_keywords(dst))
+
+    def dst_keywords(self, dst: np.ndarray | None):
+        return {'dst': dst} if dst is not None and self.accepts_dst else {}
+
+    def accepts_layout(self, layout: ChannelLayout):
+        return layout in self.input_layouts
+
+    def get_output_layout(self, input_layout: ChannelLayout):
+        return self.output_layout if self.output_layout is not None else input_layout
+
+    def get_tile_halo(self):
+        if self.tile_halo is None:
+            return None
+        return self.call_with_parameters(self.tile_halo)
+
+    def get_pixel_operation(self):
+        if self.pixel_operation is None:
+            return None
+        return self.call_with_parameters(self.pixel_operation)
+
+    # Copy of the filter with its parameter adapted to an image downscaled by scale
+    def scaled_copy(self, scale: float, gradient_ratio: float):
+        scaled = copy.copy(self)
+        if self.scale_parameter is not None:
+            scaled.filter_parameter_value = self.scale_parameter(self.filter_parameter_value, scale, gradient_ratio)
+        return scaled
+
+    # Hashable value that changes whenever the filter would give a different result
+    def parameter_key(self):
+        value = self.filter_parameter_value
+        if isinstance(value, (np.ndarray, list)):
+            value = tuple(np.asarray(value).tolist())
+        return self.filter_id, value, tuple(sorted(self.filter_options.items()))
 
     def update_parameter_value(self, value, index: int | None):
         if self.filter_parameter_type == FilterParameterType.INT_VALUE:
@@ -117,19 +425,164 @@ class ImageFilter:
 def get_image_filter_list():
     # Filter_id must increase linearly in the same order as the filters
     return [
-        ImageFilter("Simple Greyscale", 0, simple_greyscale, FilterParameterType.NONE),
-        ImageFilter("Weighted Greyscale", 1, weighted_greyscale, FilterParameterType.BGR_FLOAT_VALUE, "Weights", np.array([0.07, 0.71, 0.21]), (0.0, 1.0)),
-        ImageFilter("Greyscale from channel", 2, greyscale_from_channel, FilterParameterType.INT_VALUE, "Channel", 0, (0, 2)),
-        ImageFilter("OR Filter", 3, filter_or, FilterParameterType.BGR_VALUE, "Filter Color", np.array([255, 0, 255]), (0, 255)),
-        ImageFilter("Negate", 4, negate, FilterParameterType.NONE),
-        ImageFilter("Binarize", 5, binarize, FilterParameterType.INT_VALUE, "Threshold", 127, (0, 255)),
-        ImageFilter("Blur", 6, blur, FilterParameterType.INT_TUPLE_2, "Width / Height", np.array([15, 15]), (1, 200)),
-        ImageFilter("Canny", 7, canny, FilterParameterType.INT_TUPLE_2, "Lower Threshold / Upper Threshold", [50, 150], (1, 300)),
-        ImageFilter("Embossed Edges", 8, embossed_edges, FilterParameterType.NONE),
-        ImageFilter("Gaussian Blur", 9, gaussian_blur, FilterParameterType.INT_TUPLE_2, "Width / Height", np.array([15, 15]), (1, 200)),
-        ImageFilter("Pencil Sketch", 10, pencil_sketch, FilterParameterType.NONE)
+        ImageFilter("Simple Greyscale", 0, simple_greyscale, FilterParameterType.NONE,
+                    pixel_operation=simple_greyscale_operation, layout_function=simple_greyscale_values,
+                    input_layouts=ANY_LAYOUT, output_layout=ChannelLayout.GREY, tile_halo=no_halo,
+                    accepts_dst=True),
+        ImageFilter("Weighted Greyscale", 1, weighted_greyscale, FilterParameterType.BGR_FLOAT_VALUE, "Weights", np.array([0.07, 0.71, 0.21]), (0.0, 1.0),
+                    weighted_greyscale_operation, weighted_greyscale_values, output_layout=ChannelLayout.GREY, accepts_dst=True),
+        ImageFilter("Greyscale from channel", 2, greyscale_from_channel, FilterParameterType.INT_VALUE, "Channel", 0, (0, 2),
+                    greyscale_from_channel_operation, greyscale_from_channel_values, ANY_LAYOUT, ChannelLayout.GREY, no_halo,
+                    accepts_dst=True),
+        ImageFilter("OR Filter", 3, filter_or, FilterParameterType.BGR_VALUE, "Filter Color", np.array([255, 0, 255]), (0, 255),
+                    filter_or_operation, tile_halo=no_halo, accepts_dst=True, in_place=True),
+        ImageFilter("Negate", 4, negate, FilterParameterType.NONE,
+                    pixel_operation=negate_operation, input_layouts=ANY_LAYOUT, output_layout=None, tile_halo=no_halo,
+                    accepts_dst=True, in_place=True),
+        ImageFilter("Binarize", 5, binarize, FilterParameterType.INT_VALUE, "Threshold", 127, (0, 255),
+                    binarize_operation, binarize_values, ANY_LAYOUT, ChannelLayout.GREY, no_halo, accepts_dst=True),
+        ImageFilter("Blur", 6, blur, FilterParameterType.INT_TUPLE_2, "Width / Height", np.array([15, 15]), (1, 200),
+                    input_layouts=ANY_LAYOUT, output_layout=None, tile_halo=blur_halo, filter_options={'mode': BlurMode.AUTO},
+                    scale_parameter=blur_scaled_size, accepts_dst=True),
+        ImageFilter("Canny", 7, canny, FilterParameterType.INT_TUPLE_2, "Lower Threshold / Upper Threshold", [50, 150], (1, 300),
+                    layout_function=canny_values, input_layouts=ANY_LAYOUT, output_layout=ChannelLayout.GREY,
+                    scale_parameter=canny_scaled_thresholds, accepts_dst=True),
+        ImageFilter("Embossed Edges", 8, embossed_edges, FilterParameterType.NONE,
+                    input_layouts=ANY_LAYOUT, output_layout=None, tile_halo=embossed_edges_halo, accepts_dst=True),
+        ImageFilter("Gaussian Blur", 9, gaussian_blur, FilterParameterType.INT_TUPLE_2, "Width / Height", np.array([15, 15]), (1, 200),
+                    input_layouts=ANY_LAYOUT, output_layout=None, tile_halo=gaussian_blur_halo, filter_options={'mode': BlurMode.AUTO},
+                    scale_parameter=blur_scaled_size, accepts_dst=True),
+        ImageFilter("Pencil Sketch", 10, pencil_sketch, FilterParameterType.NONE,
+                    layout_function=pencil_sketch_values, output_layout=ChannelLayout.GREY)
     ]
 
 
 def get_image_filter_dict():
     return {filter_.display_name: filter_ for filter_ in get_image_filter_list()}
+
+
+FILTER_CHAIN_SEPARATOR = '>'
+FILTER_PARAMETER_SEPARATOR = ':'
+FILTER_OPTIONS_SEPARATOR = ';'
+
+
+def parse_filter_parameter(filter_: ImageFilter, text: str):
+    values = [value.strip() for value in text.split(',')]
+    if filter_.filter_parameter_type == FilterParameterType.INT_VALUE:
+        parsed = [int(value) for value in values]
+        expected_length = 1
+    elif filter_.filter_parameter_type == FilterParameterType.BGR_FLOAT_VALUE:
+        parsed = [float(value) for value in values]
+        expected_length = 3
+    else:
+        parsed = [int(value) for value in values]
+        expected_length = len(filter_.filter_parameter_value)
+    if len(parsed) != expected_length:
+        raise ValueError(f'{filter_.display_name} expects {expected_length} parameter value(s), found {len(parsed)}')
+    minimum, maximum = filter_.min_max_param_value
+    if any(value < minimum or value > maximum for value in parsed):
+        raise ValueError(f'{filter_.display_name} parameters must be between {minimum} and {maximum}')
+    if filter_.filter_parameter_type == FilterParameterType.INT_VALUE:
+        return parsed[0]
+    if isinstance(filter_.filter_parameter_value, list):
+        return parsed
+    return np.array(parsed, dtype=filter_.filter_parameter_value.dtype)
+
+
+# Options are written as "name=value" pairs, values are converted to the type of the option's default value
+def parse_filter_options(filter_: ImageFilter, text: str):
+    options = dict(filter_.filter_options)
+    for option in text.split(','):
+        if not option.strip():
+            continue
+        name, _, value = option.partition('=')
+        name, value = name.strip(), value.strip()
+        if name not in options:
+            raise ValueError(f'{filter_.display_name} has no option {name}')
+        try:
+            options[name] = type(options[name])(value)
+        except ValueError:
+            raise ValueError(f'Invalid value for {filter_.display_name} option {name}: {value}')
+    return options
+
+
+# Builds a new list of filters from a description such as "Greyscale from channel: 1 > Blur: 25, 25; mode=pyramid > Negate"
+# Names match ImageFilter.display_name; filters without a parameter list keep their default values
+def parse_filter_chain(description: str):
+    chain = []
+    for step in description.split(FILTER_CHAIN_SEPARATOR):
+        step, _, options_text = step.partition(FILTER_OPTIONS_SEPARATOR)
+        name, _, parameter_text = step.partition(FILTER_PARAMETER_SEPARATOR)
+        name = name.strip()
+        if not name:
+            continue
+        # A fresh dictionary for every step so that repeated filters keep their own parameters
+        filter_dictionary = get_image_filter_dict()
+        if name not in filter_dictionary:
+            raise ValueError(f'Unknown filter: {name}')
+        filter_ = filter_dictionary[name]
+        if parameter_text.strip():
+            if filter_.filter_parameter_type == FilterParameterType.NONE:
+                raise ValueError(f'{name} does not take parameters')
+            filter_.filter_parameter_value = parse_filter_parameter(filter_, parameter_text)
+        if options_text.strip():
+            filter_.filter_options = parse_filter_options(filter_, options_text)
+        chain.append(filter_)
+    return chain
+
+
+def format_filter_chain(chain: list):
+    steps = []
+    for filter_ in chain:
+        if filter_.filter_parameter_type == FilterParameterType.NONE:
+            steps.append(filter_.display_name)
+        else:
+            values = np.atleast_1d(filter_.filter_parameter_value).tolist()
+            steps.append(filter_.display_name + FILTER_PARAMETER_SEPARATOR + ' ' + ', '.join(str(value) for value in values))
+        default_options = get_image_filter_list()[filter_.filter_id].filter_options
+        options = [f'{name}={getattr(value, "value", value)}' for name, value in filter_.filter_options.items()
+                   if default_options.get(name) != value]
+        if options:
+            steps[-1] += FILTER_OPTIONS_SEPARATOR + ' ' + ', '.join(options)
+    return (' ' + FILTER_CHAIN_SEPARATOR + ' ').join(steps)
+
+
+# Chain as a list of JSON-compatible steps: {"filter": display_name, "parameter": value(s), "options": {name: value}}
+# "parameter" and "options" are left out when a filter has none
+def filter_chain_to_json(chain: list):
+    steps = []
+    for filter_ in chain:
+        step = {'filter': filter_.display_name}
+        if filter_.filter_parameter_type != FilterParameterType.NONE:
+            value = filter_.filter_parameter_value
+            step['parameter'] = np.asarray(value).tolist() if isinstance(value, (np.ndarray, list)) else value
+        if filter_.filter_options:
+            step['options'] = {name: getattr(value, 'value', value) for name, value in filter_.filter_options.items()}
+        steps.append(step)
+    return steps
+
+
+# Inverse of filter_chain_to_json, validated like parse_filter_chain
+def filter_chain_from_json(steps: list):
+    if not isinstance(steps, list):
+        raise ValueError('A filter chain must be a list of steps')
+    chain = []
+    for step in steps:
+        if not isinstance(step, dict) or not isinstance(step.get('filter'), str):
+            raise ValueError(f'Invalid chain step: {step}')
+        filter_dictionary = get_image_filter_dict()
+        if step['filter'] not in filter_dictionary:
+            raise ValueError(f'Unknown filter: {step["filter"]}')
+        filter_ = filter_dictionary[step['filter']]
+        if step.get('parameter') is not None:
+            if filter_.filter_parameter_type == FilterParameterType.NONE:
+                raise ValueError(f'{filter_.display_name} does not take parameters')
+            values = np.atleast_1d(step['parameter']).tolist()
+            filter_.filter_parameter_value = parse_filter_parameter(filter_, ', '.join(str(value) for value in values))
+        if step.get('options'):
+            if not isinstance(step['options'], dict):
+                raise ValueError(f'Options of {filter_.display_name} must be an object')
+            options_text = ', '.join(f'{name}={value}' for name, value in step['options'].items())
+            filter_.filter_options = parse_filter_options(filter_, options_text)
+        chain.append(filter_)
+    return chain
@@ -0,0 +1,203 @@
+import copy
+import threading
+import time
+
+import cv2 as cv
+
+from filters import BlurMode
+from change_detection import IncrementalProcessor
+from pipeline import ChainCompiler, apply_stage, compile_chain, chain_key, chain_halo
+from proxy import ProxySource
+
+# Keeps camera mode near its target frame rate by lowering the quality of processing while frames cost too much
+# Levels are tried in order, each one cheaper than the previous, and quality is restored once there is headroom
+# Must never import PyQt5, so it can be driven by synthetic frame costs
+
+
+# scale: processing resolution relative to the captured frame, the presenter scales the result back up
+# fast_blur: Gaussian blurs in AUTO mode use the box approximation at every kernel size
+# heavy_stage_interval: the most expensive stage only runs every n-th frame, reusing its last result in between
+class QualityLevel:
+    def __init__(self, name: str, scale: float = 1.0, fast_blur: bool = False, heavy_stage_interval: int = 1):
+        self.name = name
+        self.scale = scale
+        self.fast_blur = fast_blur
+        self.heavy_stage_interval = heavy_stage_interval
+
+    def __str__(self):
+        return self.name
+
+
+QUALITY_LEVELS = [
+    QualityLevel('Full'),
+    QualityLevel('Fast blur', fast_blur=True),
+    QualityLevel('75% resolution', 0.75, True),
+    QualityLevel('50% resolution', 0.5, True),
+    QualityLevel('50% resolution, heavy filter every 2nd frame', 0.5, True, 2),
+]
+
+# A level is dropped when the smoothed frame cost exceeds the budget, and restored when it stays below
+# RESTORE_BUDGET_FRACTION of it for RESTORE_FRAMES frames, so the better level has room for its extra cost
+COST_SMOOTHING = 0.2
+DEGRADE_FRAMES = 5
+RESTORE_FRAMES = 30
+RESTORE_BUDGET_FRACTION = 0.45
+
+
+# Decides the quality level from the processing time of each frame
+# parallelism: frames processed at the same time, each one can then take that many frame intervals
+class QualityGovernor:
+    def __init__(self, target_fps: int, parallelism: int = 1, levels: list = None):
+        self.levels = levels if levels is not None else QUALITY_LEVELS
+        self.target_fps = target_fps
+        self.parallelism = parallelism
+        self.lock = threading.Lock()
+        self.enabled = True
+        # Level used regardless of frame costs, None lets the governor choose
+        self.pinned_level = None
+        self.level_index = 0
+        self.smoothed_cost = None
+        self.frames_over_budget = 0
+        self.frames_under_budget = 0
+        self.level_changes = 0
+
+    def set_target_fps(self, target_fps: int):
+        with self.lock:
+            self.target_fps = target_fps
+            self.reset_history()
+
+    # A disabled governor always processes at full quality
+    def set_enabled(self, enabled: bool):
+        with self.lock:
+            self.enabled = enabled
+            self.reset_history()
+
+    def pin(self, level_index: int | None):
+        with self.lock:
+            self.pinned_level = level_index
+            self.reset_history()
+
+    def reset_history(self):
+        self.smoothed_cost = None
+        self.frames_over_budget = 0
+        self.frames_under_budget = 0
+
+    def current_index(self):
+        if not self.enabled:
+            return 0
+        if self.pinned_level is not None:
+            return self.pinned_level
+        return self.level_index
+
+    def current_level(self):
+        return self.levels[self.current_index()]
+
+    # Seconds a frame may take, None when there is no target frame rate
+    def budget(self):
+        if self.target_fps <= 0:
+            return None
+        return self.parallelism / self.target_fps
+
+    def frame_finished(self, seconds: float):
+        with self.lock:
+            if not self.enabled or self.pinned_level is not None:
+                return
+            if self.smoothed_cost is None:
+                self.smoothed_cost = seconds
+            else:
+                self.smoothed_cost += COST_SMOOTHING * (seconds - self.smoothed_cost)
+            budget = self.budget()
+            if budget is not None and self.smoothed_cost > budget:
+                self.frames_over_budget += 1
+                self.frames_under_budget = 0
+                if self.frames_over_budget >= DEGRADE_FRAMES and self.level_index < len(self.levels) - 1:
+                    self.change_level(self.level_index + 1)
+            elif budget is None or self.smoothed_cost < budget * RESTORE_BUDGET_FRACTION:
+                self.frames_under_budget += 1
+                self.frames_over_budget = 0
+                if self.frames_under_budget >= RESTORE_FRAMES and self.level_index > 0:
+                    self.change_level(self.level_index - 1)
+            else:
+                self.frames_over_budget = 0
+                self.frames_under_budget = 0
+
+    def change_level(self, level_index: int):
+        self.level_index = level_index
+        self.level_changes += 1
+        # Costs measured at the previous level say little about the new one
+        self.reset_history()
+
+    def status_text(self):
+        if not self.enabled:
+            return 'Quality: Full (governor off)'
+        suffix = ' (pinned)' if self.pinned_level is not None else ''
+        return f'Quality: {self.current_level()}{suffix}'
+
+
+def fast_blur_chain(chain: list):
+    fast_chain = []
+    for filter_ in chain:
+        if filter_.filter_options.get('mode') == BlurMode.AUTO:
+            filter_ = copy.copy(filter_)
+            filter_.filter_options = dict(filter_.filter_options, mode=BlurMode.BOX)
+        fast_chain.append(filter_)
+    return fast_chain
+
+
+# Applies a chain at the governor's current quality level and reports the frame's cost back to it
+# Holds per-thread state, so every processing thread needs its own
+# incremental: optional IncrementalProcessor skipping what did not change since the previous frame
+class GovernedProcessor:
+    def __init__(self, governor: QualityGovernor, incremental: IncrementalProcessor = None):
+        self.governor = governor
+        self.incremental = incremental
+        self.chain_compiler = ChainCompiler()
+        self.frame_count = 0
+        # Canny thresholds are rescaled with the gradient ratio of the first frame seen at each scale
+        self.gradient_ratios = {}
+        # Key and result of the heaviest stage, reused on the frames it is skipped
+        self.stage_costs = {}
+        self.held_key = None
+        self.held_result = None
+
+    def __call__(self, frame, chain: list):
+        start = time.perf_counter()
+        level = self.governor.current_level()
+        chain = list(chain)
+        if level.scale < 1.0:
+            full_frame = frame
+            size = (max(1, round(frame.shape[1] * level.scale)), max(1, round(frame.shape[0] * level.scale)))
+            frame = cv.resize(frame, size, interpolation=cv.INTER_AREA)
+            if level.scale not in self.gradient_ratios:
+                full_gradient = ProxySource.mean_gradient(full_frame)
+                self.gradient_ratios[level.scale] = ProxySource.mean_gradient(frame) / full_gradient if full_gradient > 0 else 1.0
+            chain = [filter_.scaled_copy(level.scale, self.gradient_ratios[level.scale]) for filter_ in chain]
+        if level.fast_blur:
+            chain = fast_blur_chain(chain)
+        if level.heavy_stage_interval > 1:
+            result = self.apply_skipping_heavy_stage(frame, chain, level.heavy_stage_interval)
+        elif self.incremental is not None:
+            halo = chain_halo(self.chain_compiler.compile(chain))
+            result = self.incremental(frame, (chain_key(chain), frame.shape), halo,
+                                      lambda image: self.chain_compiler.apply(image, chain, expand_grey=False))
+        else:
+            result = self.chain_compiler.apply(frame, chain, expand_grey=False)
+        self.frame_count += 1
+        self.governor.frame_finished(time.perf_counter() - start)
+        return result
+
+    def apply_skipping_heavy_stage(self, image, chain: list, interval: int):
+        stages = compile_chain(chain)
+        heaviest = max(range(len(stages)), key=lambda index: self.stage_costs.get(index, 0.0), default=None)
+        for index, stage in enumerate(stages):
+            key = (index, stage.parameter_key(), image.shape)
+            if index == heaviest and self.frame_count % interval != 0 and key == self.held_key:
+                image = self.held_result
+                continue
+            stage_start = time.perf_counter()
+            image = apply_stage(stage, image)
+            self.stage_costs[index] = time.perf_counter() - stage_start
+            if index == heaviest:
+                self.held_key = key
+                self.held_result = image
+        return image
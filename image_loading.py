@@ -0,0 +1,280 @@
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+
+import cv2 as cv
+import numpy as np
+
+from proxy import ProxySource, proxy_size
+
+# Loads large pictures so that a preview is on screen long before the full image is decoded:
+# JPEGs are decoded at 1/2, 1/4 or 1/8 of their size (the decoder skips the rest of the DCT) when the preview is
+# that small, and every large picture leaves a pyramid of downscaled copies in an on-disk cache, so reopening it
+# only needs the copy just above display size
+# Must never import PyQt5, so that loading can be measured headless
+
+CACHE_DIRECTORY_ENVIRONMENT_VARIABLE = 'IMAGE_FILTER_CACHE_DIR'
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'python-image-filter-app', 'pyramids')
+# Least recently used pyramids are removed above this total size
+MAX_CACHE_BYTES = 512 * 2 ** 20
+# Pictures this small decode fast enough without a pyramid
+MIN_CACHED_PIXELS = 4 * 2 ** 20
+# Longest side of the largest cached level, the next ones halve it down to MIN_LEVEL_SIZE
+MAX_LEVEL_SIZE = 2048
+MIN_LEVEL_SIZE = 128
+# Bytes read from the start and end of a file for its cache key, together with its size and modification time
+KEY_SAMPLE_BYTES = 2 ** 20
+# Pyramids being written start with this prefix until they are moved in place under their key
+STAGING_PREFIX = 'staging-'
+REDUCED_COLOR_FLAGS = {2: cv.IMREAD_REDUCED_COLOR_2, 4: cv.IMREAD_REDUCED_COLOR_4, 8: cv.IMREAD_REDUCED_COLOR_8}
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_ALPHA_COLOUR_TYPES = (4, 6)
+JPEG_SOI = b'\xff\xd8'
+# Start of frame markers, the ones holding the image size (0xc4, 0xc8 and 0xcc are other segments)
+JPEG_SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+
+# Format, size and transparency of a PNG or JPEG read from its header, None for other formats or broken files
+class ImageHeader:
+    def __init__(self, image_format: str, width: int, height: int, has_alpha: bool):
+        self.image_format = image_format
+        self.width = width
+        self.height = height
+        self.has_alpha = has_alpha
+
+
+def read_image_header(path: str):
+    try:
+        with open(path, 'rb') as file:
+            return read_image_header_from(file)
+    except OSError:
+        return None
+
+
+# Same as read_image_header for a binary file object positioned at the start of the image, e.g. an io.BytesIO
+def read_image_header_from(file):
+    try:
+        start = file.read(8)
+        if start == PNG_SIGNATURE:
+            return read_png_header(file)
+        if start[:2] == JPEG_SOI:
+            file.seek(2)
+            return read_jpeg_header(file)
+    except (OSError, struct.error):
+        pass
+    return None
+
+
+def read_png_header(file):
+    length, chunk_type = struct.unpack('>I4s', file.read(8))
+    if chunk_type != b'IHDR':
+        return None
+    width, height, _, colour_type = struct.unpack('>IIBB', file.read(10))
+    has_alpha = colour_type in PNG_ALPHA_COLOUR_TYPES
+    file.seek(length - 10 + 4, os.SEEK_CUR)
+    # A tRNS chunk, which comes before the image data, makes a palette or an opaque colour type transparent
+    while not has_alpha:
+        length, chunk_type = struct.unpack('>I4s', file.read(8))
+        if chunk_type == b'IDAT' or chunk_type == b'IEND':
+            break
+        has_alpha = chunk_type == b'tRNS'
+        file.seek(length + 4, os.SEEK_CUR)
+    return ImageHeader('png', width, height, has_alpha)
+
+
+def read_jpeg_header(file):
+    while True:
+        marker = file.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None
+        length = struct.unpack('>H', file.read(2))[0]
+        if marker[1] in JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>xHH', file.read(5))
+            return ImageHeader('jpeg', width, height, False)
+        file.seek(length - 2, os.SEEK_CUR)
+
+
+# Largest JPEG reduction (1, 2, 4 or 8) that still decodes at least target_width x target_height pixels
+# Other formats are decoded in full by OpenCV even with IMREAD_REDUCED_*, so they are never reduced
+def reduction_factor(header: ImageHeader | None, target_width: int, target_height: int):
+    if header is None or header.image_format != 'jpeg' or header.has_alpha:
+        return 1
+    factor = 1
+    while factor < 8 and header.width // (factor * 2) >= target_width and header.height // (factor * 2) >= target_height:
+        factor *= 2
+    return factor
+
+
+def read_reduced(path: str, factor: int):
+    return cv.imread(path, REDUCED_COLOR_FLAGS[factor] if factor > 1 else cv.IMREAD_COLOR)
+
+
+# Downscaled copies of large pictures, one directory per picture with a .npy file per level and their metadata
+# The key hashes the file size, modification time and the bytes at both ends, so reading a multi-hundred-MB file
+# is never needed to find its pyramid
+class PyramidCache:
+    def __init__(self, directory: str = None, max_bytes: int = MAX_CACHE_BYTES):
+        self.directory = directory or os.environ.get(CACHE_DIRECTORY_ENVIRONMENT_VARIABLE) or DEFAULT_CACHE_DIRECTORY
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(path: str):
+        status = os.stat(path)
+        digest = hashlib.sha1(f'{status.st_size}:{status.st_mtime_ns}'.encode())
+        with open(path, 'rb') as file:
+            digest.update(file.read(KEY_SAMPLE_BYTES))
+            if status.st_size > KEY_SAMPLE_BYTES:
+                file.seek(max(KEY_SAMPLE_BYTES, status.st_size - KEY_SAMPLE_BYTES))
+                digest.update(file.read())
+        return digest.hexdigest()
+
+    # Smallest cached level at least as large as the picture's proxy for max_width x max_height and the picture's
+    # metadata, None if not cached
+    def load(self, path: str, max_width: int, max_height: int):
+        try:
+            entry = os.path.join(self.directory, self.key(path))
+            with open(os.path.join(entry, 'meta.json')) as file:
+                meta = json.load(file)
+            min_width, min_height = proxy_size(meta['width'], meta['height'], max_width, max_height)[1]
+            levels = meta['levels']
+            # The largest level is used when none is big enough, e.g. for displays larger than MAX_LEVEL_SIZE
+            level = next((index for index in range(len(levels) - 1, -1, -1)
+                          if levels[index][0] >= min_width and levels[index][1] >= min_height), 0)
+            image = np.load(os.path.join(entry, f'level_{level}.npy'))
+        except (OSError, ValueError, KeyError, IndexError):
+            return None
+        # Marks the pyramid as recently used, a read-only cache is still used as it is
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        return image, meta
+
+    # Builds and writes the pyramid of a decoded picture, mean_gradient is stored for ProxySource
+    # Caching is best effort: a cache directory that cannot be written (read-only, full, not a directory) is skipped
+    def store(self, path: str, image: np.ndarray, mean_gradient: float = None):
+        height, width = image.shape[:2]
+        if width * height < MIN_CACHED_PIXELS:
+            return
+        scale = 1.0
+        while max(width, height) * scale > MAX_LEVEL_SIZE:
+            scale /= 2
+        level = cv.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv.INTER_AREA)
+        levels = [level]
+        while max(level.shape[:2]) // 2 >= MIN_LEVEL_SIZE:
+            level = cv.resize(level, (level.shape[1] // 2, level.shape[0] // 2), interpolation=cv.INTER_AREA)
+            levels.append(level)
+        meta = {'width': width, 'height': height, 'mean_gradient': mean_gradient,
+                'levels': [(level.shape[1], level.shape[0]) for level in levels]}
+        staging = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Written aside and moved in place, so that a half written pyramid is never loaded
+            staging = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=self.directory)
+            for index, level in enumerate(levels):
+                np.save(os.path.join(staging, f'level_{index}.npy'), level)
+            with open(os.path.join(staging, 'meta.json'), 'w') as file:
+                json.dump(meta, file)
+            entry = os.path.join(self.directory, self.key(path))
+            shutil.rmtree(entry, ignore_errors=True)
+            os.replace(staging, entry)
+        except OSError:
+            if staging is not None:
+                shutil.rmtree(staging, ignore_errors=True)
+            return
+        self.evict()
+
+    # Pyramids being written by another process are left alone, as is anything that is not a pyramid
+    def evict(self):
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            entry = os.path.join(self.directory, name)
+            if name.startswith(STAGING_PREFIX) or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(item.stat().st_size for item in os.scandir(entry) if item.is_file())
+                entries.append((os.stat(entry).st_mtime, size, entry))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+# Loads a picture for editing: on_preview(proxy) gets a ProxySource built from a display-size preview if one is
+# available before the full decode (from the cache or a reduced JPEG decode), then the full image is decoded and
+# returned with the ProxySource for it
+# The full image's mean gradient (for Canny thresholds on the proxy) is computed here, off the worker thread,
+# and cached with the pyramid
+def load_picture(path: str, max_width: int, max_height: int, cache: PyramidCache = None, on_preview=None):
+    cache = cache if cache is not None else PyramidCache()
+    proxy = None
+    cached = cache.load(path, max_width, max_height)
+    if cached is not None:
+        level, meta = cached
+        proxy = preview_proxy(level, (meta['width'], meta['height']), max_width, max_height, meta['mean_gradient'])
+    else:
+        header = read_image_header(path)
+        factor = 1
+        if header is not None:
+            factor = reduction_factor(header, *proxy_size(header.width, header.height, max_width, max_height)[1])
+        reduced = read_reduced(path, factor) if factor > 1 else None
+        if reduced is not None:
+            proxy = preview_proxy(reduced, oriented_size(header, reduced), max_width, max_height)
+    if proxy is not None and on_preview is not None:
+        on_preview(proxy)
+
+    image = cv.imread(path)
+    if image is None:
+        raise ValueError(f'Could not read image {path}')
+    if proxy is None or proxy.full_size != (image.shape[1], image.shape[0]):
+        proxy = ProxySource(image, max_width, max_height)
+    if cached is not None:
+        full_gradient = cached[1]['mean_gradient']
+    else:
+        full_gradient = ProxySource.mean_gradient(image)
+        cache.store(path, image, full_gradient)
+    return image, proxy.with_image(image, full_gradient)
+
+
+# Size of the full picture in the orientation it is decoded in: like the full decode, reduced decoding applies
+# the EXIF orientation, which the header size does not
+def oriented_size(header: ImageHeader, decoded: np.ndarray):
+    if (header.width > header.height) != (decoded.shape[1] > decoded.shape[0]) and header.width != header.height:
+        return header.height, header.width
+    return header.width, header.height
+
+
+def preview_proxy(level: np.ndarray, full_size: tuple, max_width: int, max_height: int, full_gradient: float = None):
+    size = proxy_size(*full_size, max_width, max_height)[1]
+    if (level.shape[1], level.shape[0]) != size:
+        level = cv.resize(level, size, interpolation=cv.INTER_AREA)
+    return ProxySource(None, max_width, max_height, level, full_size, full_gradient)
+
+
+# Reads a sticker at scale times its size; opaque JPEGs are decoded reduced, anything that may be transparent in full,
+# since the reduced decoders drop the alpha channel
+def load_sticker_image(path: str, scale: float):
+    header = read_image_header(path)
+    if header is not None:
+        width, height = max(1, round(header.width * scale)), max(1, round(header.height * scale))
+        factor = reduction_factor(header, width, height)
+        if factor > 1:
+            image = read_reduced(path, factor)
+            if image is not None:
+                return cv.resize(image, (width, height), interpolation=cv.INTER_AREA)
+    image = cv.imread(path, cv.IMREAD_UNCHANGED)
+    if image is None:
+        return None
+    return cv.resize(image, (0, 0), fx=scale, fy=scale)
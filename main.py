@@ -1,9 +1,26 @@
+import os
 import sys
+import threading
+import time
 
 from PyQt5 import QtWidgets, QtCore, QtGui
 from PyQt5.Qt import Qt
 from filters import *
 from overlays import *
+from pipeline import ChainCompiler
+from stage_cache import StageCache, apply_cached
+from scheduling import *
+from stages import FramePipeline
+from tiling import TiledExecutor
+from profiling import PROFILER
+from video import process_video
+from proxy import ProxySource, render_full_resolution
+from display import DisplayBufferPool
+from governor import QualityGovernor, GovernedProcessor, QUALITY_LEVELS
+from change_detection import ChangeTracker, IncrementalProcessor, DEFAULT_CHANGE_THRESHOLD
+from recording import FrameRecorder, FrameReplay, recording_reader
+from image_loading import PyramidCache, load_picture, load_sticker_image
+from snapshots import EditState, PictureSource
 
 SCREEN_HEIGHT = 600
 SCREEN_WIDTH = 800
@@ -18,6 +35,31 @@ STOP_CAMERA_BUTTON_TEXT = 'Stop Camera'
 START_CAMERA_BUTTON_TEXT = 'Start Camera'
 
 SLIDER_FLOAT_SCALING_FACTOR = 500
+# Stickers are added at this fraction of their file's size
+STICKER_SCALE = 0.1
+
+# Setting this environment variable serves the timing histograms on http://127.0.0.1:<port>/metrics
+METRICS_PORT_ENVIRONMENT_VARIABLE = 'IMAGE_FILTER_METRICS_PORT'
+# Setting these replays a recording made with recording.py in place of the camera, looped, at the recorded timing
+# or, with the speed set to "fast", as fast as frames are taken
+REPLAY_ENVIRONMENT_VARIABLE = 'IMAGE_FILTER_REPLAY'
+REPLAY_SPEED_ENVIRONMENT_VARIABLE = 'IMAGE_FILTER_REPLAY_SPEED'
+REPLAY_SPEED_FAST = 'fast'
+# Setting this records every captured frame to the given path
+RECORD_ENVIRONMENT_VARIABLE = 'IMAGE_FILTER_RECORD'
+HUD_REFRESH_SECONDS = 0.25
+HUD_STAGES = ('capture', 'overlay', 'filters', 'scale', 'latency')
+# How long presenting waits for the GUI thread to give a display buffer back before dropping the frame
+DISPLAY_BUFFER_TIMEOUT_SECONDS = 0.1
+
+# Threads applying stickers and filters to camera frames, so that heavy chains can use several cores
+PROCESSING_THREADS = 2
+
+MAX_CHANGE_THRESHOLD = 64
+
+QUALITY_AUTO = 'Auto'
+QUALITY_OFF = 'Off'
+QUALITY_PINNED = 'Pinned: '
 
 
 class MainWindow(QtWidgets.QWidget):
@@ -28,7 +70,11 @@ class MainWindow(QtWidgets.QWidget):
         filter_list = get_image_filter_list()
         self.Worker = Worker(filter_list)
         self.Worker.start()
+        # Downscaled copies of large pictures, so reopening them shows a preview without decoding the whole file
+        self.pyramid_cache = PyramidCache()
+        self.picture_loader = None
         self.Worker.ImageUpdate.connect(self.image_update_slot)
+        self.Worker.StatsUpdate.connect(self.stats_update_slot)
 
         # Main Horizontal Layout
         # Includes all hidden filter options
@@ -49,7 +95,7 @@ class MainWindow(QtWidgets.QWidget):
         self.main_vertical_layout.addLayout(self.filter_buttons_layout)
 
         # Adding camera feed to main layout
-        self.FeedLabel = QtWidgets.QLabel()
+        self.FeedLabel = FrameView()
         self.main_vertical_layout.addWidget(self.FeedLabel)
 
         # Adding filter composition description
@@ -57,6 +103,49 @@ class MainWindow(QtWidgets.QWidget):
         self.filter_composition_label.setText(NO_FILTERS_SELECTED)
         self.main_vertical_layout.addWidget(self.filter_composition_label)
 
+        # Adding frame rate and CPU usage description
+        self.stats_label = QtWidgets.QLabel()
+        self.main_vertical_layout.addWidget(self.stats_label)
+
+        # Adding target frame rate selection, 0 renders frames as fast as they arrive
+        self.target_fps_layout = QtWidgets.QHBoxLayout()
+        self.target_fps_layout.addWidget(QtWidgets.QLabel('Target FPS'))
+        self.target_fps_spin_box = QtWidgets.QSpinBox()
+        self.target_fps_spin_box.setRange(0, MAX_TARGET_FPS)
+        self.target_fps_spin_box.setSpecialValueText('Unlimited')
+        self.target_fps_spin_box.setValue(DEFAULT_TARGET_FPS)
+        self.target_fps_spin_box.valueChanged.connect(self.Worker.set_target_fps)
+        self.target_fps_layout.addWidget(self.target_fps_spin_box)
+        # Camera frames are processed at lower quality when they cannot keep up with the target, unless pinned or off
+        self.target_fps_layout.addWidget(QtWidgets.QLabel('Quality'))
+        self.quality_combo_box = QtWidgets.QComboBox()
+        self.quality_combo_box.addItems([QUALITY_AUTO, QUALITY_OFF] + [QUALITY_PINNED + str(level) for level in QUALITY_LEVELS])
+        self.quality_combo_box.currentIndexChanged.connect(self.quality_changed)
+        self.target_fps_layout.addWidget(self.quality_combo_box)
+        # Camera frames whose blocks changed less than this are not processed again, 0 processes every frame
+        self.target_fps_layout.addWidget(QtWidgets.QLabel('Change threshold'))
+        self.change_threshold_spin_box = QtWidgets.QSpinBox()
+        self.change_threshold_spin_box.setRange(0, MAX_CHANGE_THRESHOLD)
+        self.change_threshold_spin_box.setSpecialValueText('Off')
+        self.change_threshold_spin_box.setValue(DEFAULT_CHANGE_THRESHOLD)
+        self.change_threshold_spin_box.valueChanged.connect(self.Worker.set_change_threshold)
+        self.target_fps_layout.addWidget(self.change_threshold_spin_box)
+        self.main_vertical_layout.addLayout(self.target_fps_layout)
+
+        # Adding performance HUD toggle and timings export
+        self.performance_layout = QtWidgets.QHBoxLayout()
+        self.hud_check_box = QtWidgets.QCheckBox('Performance HUD')
+        self.hud_check_box.toggled.connect(self.hud_toggled)
+        self.performance_layout.addWidget(self.hud_check_box)
+        self.export_timings_button = QtWidgets.QPushButton('Export timings')
+        self.export_timings_button.clicked.connect(self.export_timings_button_clicked)
+        self.performance_layout.addWidget(self.export_timings_button)
+        self.main_vertical_layout.addLayout(self.performance_layout)
+        metrics_port = os.environ.get(METRICS_PORT_ENVIRONMENT_VARIABLE)
+        if metrics_port:
+            PROFILER.enabled = True
+            PROFILER.serve_metrics(int(metrics_port))
+
         # Adding "stop camera" button to main layout
         self.camera_button = QtWidgets.QPushButton('Stop Camera')
         self.camera_button.clicked.connect(self.cancel_feed)
@@ -67,6 +156,22 @@ class MainWindow(QtWidgets.QWidget):
         self.select_image_button.clicked.connect(self.select_image_button_clicked)
         self.main_vertical_layout.addWidget(self.select_image_button)
 
+        # Adding video file processing button
+        self.process_video_button = QtWidgets.QPushButton('Process video')
+        self.process_video_button.clicked.connect(self.process_video_button_clicked)
+        self.main_vertical_layout.addWidget(self.process_video_button)
+
+        # Adding preview proxy toggle and full resolution export of the selected image
+        self.proxy_layout = QtWidgets.QHBoxLayout()
+        self.proxy_check_box = QtWidgets.QCheckBox('Preview proxy')
+        self.proxy_check_box.setChecked(True)
+        self.proxy_check_box.toggled.connect(self.Worker.set_proxy_enabled)
+        self.proxy_layout.addWidget(self.proxy_check_box)
+        self.export_button = QtWidgets.QPushButton('Export')
+        self.export_button.clicked.connect(self.export_button_clicked)
+        self.proxy_layout.addWidget(self.export_button)
+        self.main_vertical_layout.addLayout(self.proxy_layout)
+
         # Adding sticker buttons
         self.add_sticker_button = QtWidgets.QPushButton('Add Sticker')
         self.add_sticker_button.clicked.connect(self.add_sticker_button_clicked)
@@ -134,6 +239,14 @@ class MainWindow(QtWidgets.QWidget):
                     self.filter_parameter_widgets.append(FilterParameterWidget(filter_, slider_, slider_index))
                     self.sliders_layout.addWidget(slider_)
                 self.filter_param_layout.addLayout(self.sliders_layout)
+                if 'mode' in filter_.filter_options:
+                    # Lets the user pick how large kernels are computed
+                    self.mode_combo_box = QtWidgets.QComboBox()
+                    self.mode_combo_box.addItems([mode.value for mode in BlurMode])
+                    self.mode_combo_box.setCurrentText(filter_.filter_options['mode'].value)
+                    self.mode_combo_box.currentTextChanged.connect(self.filter_mode_changed)
+                    self.filter_parameter_widgets.append(FilterParameterWidget(filter_, self.mode_combo_box, None))
+                    self.filter_param_layout.addWidget(self.mode_combo_box, alignment=QtCore.Qt.AlignHCenter)
                 self.finalize_filter_param_widget_setup(self.filter_param_layout, index)
 
         # Finished configuration of main horizontal layout
@@ -142,8 +255,29 @@ class MainWindow(QtWidgets.QWidget):
         self.filter_dictionary = get_image_filter_dict()
 
     # Function called by ImageUpdate to refresh camera frame
-    def image_update_slot(self, image):
-        self.FeedLabel.setPixmap(QtGui.QPixmap.fromImage(image))
+    def image_update_slot(self, buffer):
+        self.FeedLabel.set_frame(buffer)
+
+    def stats_update_slot(self, text):
+        self.stats_label.setText(text)
+
+    def quality_changed(self, index):
+        # Items are Auto, Off, then one per quality level
+        self.Worker.governor.set_enabled(index != 1)
+        self.Worker.governor.pin(index - 2 if index >= 2 else None)
+
+    def hud_toggled(self, checked):
+        # Timings are only recorded while someone looks at them, unless the metrics endpoint is being served
+        PROFILER.enabled = checked or PROFILER.server is not None
+        self.Worker.set_hud_enabled(checked)
+
+    def export_timings_button_clicked(self):
+        if not PROFILER.rings:
+            QtWidgets.QMessageBox.information(self, 'Export timings', 'No timings recorded, enable the performance HUD first.')
+            return
+        path = os.path.abspath(time.strftime('timings_%Y%m%d_%H%M%S.json'))
+        PROFILER.export_json(path)
+        QtWidgets.QMessageBox.information(self, 'Export timings', f'Timings exported to {path}')
 
     def add_filter_param_details(self, filter_):
         filter_param_layout = QtWidgets.QVBoxLayout()
@@ -167,7 +301,12 @@ class MainWindow(QtWidgets.QWidget):
             if widget.widget == self.sender():
                 if widget.filter_.filter_parameter_type == FilterParameterType.BGR_FLOAT_VALUE:
                     i = float(i) / float(SLIDER_FLOAT_SCALING_FACTOR)
-                widget.filter_.update_parameter_value(i, widget.param_index)
+                self.Worker.edit_state.set_parameter(widget.filter_.filter_id, i, widget.param_index)
+
+    def filter_mode_changed(self, text):
+        for widget in self.filter_parameter_widgets:
+            if widget.widget == self.sender():
+                self.Worker.edit_state.set_option(widget.filter_.filter_id, 'mode', BlurMode(text))
 
     def filter_button_handler(self):
         for button_and_layout in self.filter_button_to_param_layout_list:
@@ -206,13 +345,13 @@ class MainWindow(QtWidgets.QWidget):
 
     # Function called by "Stop Camera" button
     def cancel_feed(self):
-        self.Worker.using_camera = False
+        self.Worker.set_using_camera(False)
         # Update button to restart camera
         self.camera_button.setText(START_CAMERA_BUTTON_TEXT)
         self.camera_button.clicked.connect(self.restart_feed)
 
     def restart_feed(self):
-        self.Worker.using_camera = True
+        self.Worker.set_using_camera(True)
         # Update button to stop camera
         self.camera_button.setText(STOP_CAMERA_BUTTON_TEXT)
         self.camera_button.clicked.connect(self.cancel_feed)
@@ -223,11 +362,94 @@ class MainWindow(QtWidgets.QWidget):
         self.file_selection_worker.fileSelected.connect(self.set_selected_image)
         self.file_selection_worker.start()
 
+    # Decoding runs on a PictureLoadWorker: a preview is shown as soon as it is ready, the full picture later
     def set_selected_image(self):
-        if self.file_selection_worker.file_path is not None:
-            self.Worker.picture = cv.imread(self.file_selection_worker.file_path)
-            self.cancel_feed()
-            self.file_selection_worker.stop()
+        file_path = self.file_selection_worker.file_path
+        self.file_selection_worker.stop()
+        if not file_path:
+            return
+        self.picture_loader = PictureLoadWorker(file_path, self.pyramid_cache)
+        self.picture_loader.previewLoaded.connect(self.picture_preview_loaded)
+        self.picture_loader.pictureLoaded.connect(self.picture_loaded)
+        self.picture_loader.loadFailed.connect(self.picture_load_failed)
+        self.picture_loader.start()
+        self.cancel_feed()
+
+    # Results of a loader replaced by a newer selection are ignored
+    def picture_preview_loaded(self, proxy):
+        if self.sender() is self.picture_loader:
+            self.Worker.set_preview(proxy)
+
+    def picture_loaded(self, picture, proxy):
+        if self.sender() is self.picture_loader:
+            self.Worker.set_picture(picture, proxy)
+
+    def picture_load_failed(self, message):
+        if self.sender() is self.picture_loader:
+            self.Worker.set_picture(None)
+            QtWidgets.QMessageBox.warning(self, 'Select image', message)
+
+    def process_video_button_clicked(self):
+        self.file_selection_worker = FileDialogWorker()
+        self.file_selection_worker.fileSelected.connect(self.set_selected_video)
+        self.file_selection_worker.start()
+
+    def set_selected_video(self):
+        input_path = self.file_selection_worker.file_path
+        self.file_selection_worker.stop()
+        if not input_path:
+            return
+        output_path = os.path.splitext(input_path)[0] + '_filtered.mp4'
+        # Snapshots are never modified, so later edits do not affect a video being processed
+        snapshot = self.Worker.current_snapshot()
+        chain, stickers = list(snapshot.chain), list(snapshot.stickers)
+        self.video_worker = VideoWorker(input_path, output_path, chain, stickers)
+        self.video_progress_dialog = QtWidgets.QProgressDialog(f'Processing {os.path.basename(input_path)}', 'Cancel', 0, 0, self)
+        self.video_progress_dialog.setWindowModality(Qt.WindowModal)
+        self.video_progress_dialog.canceled.connect(self.video_worker.cancel)
+        self.video_worker.progressUpdate.connect(self.video_progress_update)
+        self.video_worker.videoFinished.connect(self.video_finished)
+        self.video_progress_dialog.show()
+        self.video_worker.start()
+
+    def video_progress_update(self, done, total):
+        self.video_progress_dialog.setMaximum(total)
+        self.video_progress_dialog.setValue(done)
+
+    def video_finished(self, message):
+        self.video_progress_dialog.reset()
+        QtWidgets.QMessageBox.information(self, 'Process video', message)
+
+    def export_button_clicked(self):
+        source = self.Worker.picture_source
+        picture = source.picture
+        if source.loading:
+            QtWidgets.QMessageBox.information(self, 'Export', 'The image is still loading.')
+            return
+        if self.Worker.using_camera or picture is None:
+            QtWidgets.QMessageBox.information(self, 'Export', 'Select an image first.')
+            return
+        output_path = QtWidgets.QFileDialog.getSaveFileName(self, 'Export', 'export.png', 'Images (*.png *.jpg *.bmp *.tif)')[0]
+        if not output_path:
+            return
+        snapshot = self.Worker.current_snapshot()
+        chain, stickers = list(snapshot.chain), list(snapshot.stickers)
+        self.export_worker = ExportWorker(picture, output_path, chain, stickers)
+        self.export_progress_dialog = QtWidgets.QProgressDialog('Rendering at full resolution', 'Cancel', 0, 0, self)
+        self.export_progress_dialog.setWindowModality(Qt.WindowModal)
+        self.export_progress_dialog.canceled.connect(self.export_worker.cancel)
+        self.export_worker.progressUpdate.connect(self.export_progress_update)
+        self.export_worker.exportFinished.connect(self.export_finished)
+        self.export_progress_dialog.show()
+        self.export_worker.start()
+
+    def export_progress_update(self, done, total):
+        self.export_progress_dialog.setMaximum(total)
+        self.export_progress_dialog.setValue(done)
+
+    def export_finished(self, message):
+        self.export_progress_dialog.reset()
+        QtWidgets.QMessageBox.information(self, 'Export', message)
 
     def add_sticker_button_clicked(self):
         self.file_selection_worker = FileDialogWorker()
@@ -235,14 +457,22 @@ class MainWindow(QtWidgets.QWidget):
         self.file_selection_worker.start()
 
     def set_selected_sticker(self):
-        if self.file_selection_worker.file_path is not None:
-            pic = cv.imread(self.file_selection_worker.file_path, cv.IMREAD_UNCHANGED)
-            pic = cv.resize(pic, (0, 0), fx=0.1, fy=0.1)
-            # (x, y) is where the top-left pixel of the sticker will go in the background image
-            # To start in the middle, we subtract the sticker's width and height from the background center
-            self.Worker.add_sticker(Sticker(pic, (IMAGE_WIDTH - pic.shape[1]) // 2, (IMAGE_HEIGHT - pic.shape[0]) // 2))
-            self.remove_sticker_button.setHidden(False)
-            self.file_selection_worker.stop()
+        file_path = self.file_selection_worker.file_path
+        self.file_selection_worker.stop()
+        if not file_path:
+            return
+        self.sticker_loader = StickerLoadWorker(file_path)
+        self.sticker_loader.stickerLoaded.connect(self.sticker_loaded)
+        self.sticker_loader.start()
+
+    def sticker_loaded(self, pic):
+        if pic is None:
+            QtWidgets.QMessageBox.warning(self, 'Add Sticker', 'Could not read the sticker.')
+            return
+        # (x, y) is where the top-left pixel of the sticker will go in the background image
+        # To start in the middle, we subtract the sticker's width and height from the background center
+        self.Worker.add_sticker(Sticker(pic, (IMAGE_WIDTH - pic.shape[1]) // 2, (IMAGE_HEIGHT - pic.shape[0]) // 2))
+        self.remove_sticker_button.setHidden(False)
 
     def remove_sticker_button_clicked(self):
         self.Worker.remove_sticker()
@@ -251,80 +481,286 @@ class MainWindow(QtWidgets.QWidget):
         self.remove_sticker_button.setHidden(True)
 
     def keyPressEvent(self, event):
-        if len(self.Worker.stickers) > 0:
-            if event.key() == Qt.Key_W:
-                self.Worker.stickers[-1].y -= 10
-            if event.key() == Qt.Key_A:
-                self.Worker.stickers[-1].x -= 10
-            if event.key() == Qt.Key_S:
-                self.Worker.stickers[-1].y += 10
-            if event.key() == Qt.Key_D:
-                self.Worker.stickers[-1].x += 10
+        if event.key() == Qt.Key_W:
+            self.Worker.edit_state.move_last_sticker(0, -10)
+        if event.key() == Qt.Key_A:
+            self.Worker.edit_state.move_last_sticker(-10, 0)
+        if event.key() == Qt.Key_S:
+            self.Worker.edit_state.move_last_sticker(0, 10)
+        if event.key() == Qt.Key_D:
+            self.Worker.edit_state.move_last_sticker(10, 0)
+
+
+# Shows display buffers as they are, the buffer on screen goes back to its pool once the next one arrives
+class FrameView(QtWidgets.QWidget):
+    def __init__(self):
+        super().__init__()
+        self.buffer = None
+        self.setMinimumSize(IMAGE_WIDTH, IMAGE_HEIGHT)
+
+    def set_frame(self, buffer):
+        if self.buffer is not None:
+            self.buffer.release()
+        self.buffer = buffer
+        self.update()
+
+    def paintEvent(self, event):
+        if self.buffer is not None:
+            painter = QtGui.QPainter(self)
+            painter.drawImage(0, 0, self.buffer.handle)
+            painter.end()
 
 
 class Worker(QtCore.QThread):
-    ImageUpdate = QtCore.pyqtSignal(QtGui.QImage)
+    # Carries a DisplayBuffer, which the receiver must release once it is no longer shown
+    ImageUpdate = QtCore.pyqtSignal(object)
     HideRemoveStickerButton = QtCore.pyqtSignal()
+    StatsUpdate = QtCore.pyqtSignal(str)
 
     def __init__(self, available_filters: list):
         super().__init__()
         self.ThreadActive = False
-        self.available_filters = available_filters
-        self.active_filters_ = []
-        self.picture: np.ndarray | None = None
+        # Filter chain and stickers, edited by the GUI thread and read here as one snapshot per frame
+        self.edit_state = EditState(available_filters, 1 / DEFAULT_TARGET_FPS, self.edits_published)
+        # Still picture, set by the GUI thread and read here once per frame, like the edits
+        self.picture_source = PictureSource(0)
         self.camera = None
         self.using_camera = True
-        self.stickers = []
-
-    # TODO - Improve this
+        self.chain_compiler = ChainCompiler()
+        self.stage_cache = StageCache()
+        # Splits large still images in stripes so that a single big blur uses every core
+        self.tiled_executor = TiledExecutor()
+        self.scheduler = FrameScheduler()
+        # Only camera mode is governed, still images already are edited on a proxy and cached
+        self.governor = QualityGovernor(DEFAULT_TARGET_FPS, PROCESSING_THREADS)
+        self.change_tracker = ChangeTracker()
+        self.frame_pipeline: FramePipeline | None = None
+        self.hud_enabled = False
+        self.hud_lines = []
+        self.hud_updated_at = 0.0
+        # Still images larger than the display are edited on a downscaled proxy, built in this thread for a picture
+        # set without one and kept with the PictureSource it belongs to
+        self.proxy_enabled = True
+        self.built_proxy: tuple[PictureSource, ProxySource] | None = None
+        self.display_pool = DisplayBufferPool(IMAGE_WIDTH, IMAGE_HEIGHT)
+        # Cache key of the still image result currently on screen
+        self.displayed_key = None
+
+    # Renders only when something changed (a new camera frame, a parameter, a sticker or the source),
+    # at most at the target frame rate, and waits without using the CPU otherwise
+    # In camera mode this thread is only the presentation stage: capture and processing run in frame_pipeline
     def run(self):
         self.ThreadActive = True
-        self.camera = cv.VideoCapture(0)
+        read_frame = self.open_camera()
+        recorder = None
+        record_path = os.environ.get(RECORD_ENVIRONMENT_VARIABLE)
+        if record_path:
+            recorder = FrameRecorder(record_path)
+            read_frame = recording_reader(read_frame, recorder)
+        self.frame_pipeline = FramePipeline(read_frame, self.create_frame_processor, self.pace_frame, PROCESSING_THREADS)
+        self.frame_pipeline.set_paused(not self.using_camera)
+        self.frame_pipeline.start()
         while self.ThreadActive:
-            ret, frame = None, None
             if self.using_camera:
-                ret, frame = self.camera.read()
-            elif isinstance(self.picture, np.ndarray):
-                ret, frame = True, self.picture.copy()
-            if ret:
-                for sticker in self.stickers:
-                    frame = overlay(frame, sticker.image, sticker.x, sticker.y)
-                for active_filter in self.active_filters_:
-                    frame = active_filter.apply(frame)
-                frame_rgb = cv.cvtColor(frame, cv.COLOR_BGR2RGB)
-                converted_and_scaled = (QtGui.QImage(frame_rgb.data, frame_rgb.shape[1], frame_rgb.shape[0], QtGui.QImage.Format_RGB888)
-                                        .scaled(IMAGE_WIDTH, IMAGE_HEIGHT, QtCore.Qt.KeepAspectRatio))
-                self.ImageUpdate.emit(converted_and_scaled)
+                self.displayed_key = None
+                frame = self.frame_pipeline.next_frame(STATS_INTERVAL_SECONDS)
+                if frame is not None:
+                    if self.present_frame(frame.image):
+                        self.frame_pipeline.frame_presented(frame)
+            elif self.picture_source.has_picture():
+                self.pace_frame()
+                source = self.picture_source
+                use_proxy = self.proxy_enabled or source.loading
+                snapshot = self.edit_state.snapshot
+                # Still images only recompute the stages whose input or parameters changed
+                source_key = (source.version, use_proxy, snapshot.stickers_version)
+                chain = list(snapshot.chain)
+                if use_proxy:
+                    chain = self.current_proxy(source).scale_chain(chain)
+                stages = self.chain_compiler.compile(chain)
+                frame, result_key = apply_cached(self.stage_cache, source_key,
+                                                 lambda: self.load_picture(source, use_proxy, snapshot.stickers),
+                                                 stages, self.tiled_executor)
+                if result_key != self.displayed_key and self.present_frame(frame):
+                    self.displayed_key = result_key
+                # Any event received while rendering is still pending, so none of them is lost here
+                self.scheduler.wait_for_event(STATS_INTERVAL_SECONDS)
+            else:
+                self.scheduler.wait_for_event(STATS_INTERVAL_SECONDS)
+            if self.scheduler.update_stats():
+                self.StatsUpdate.emit(' | '.join((self.scheduler.stats_text(), self.frame_pipeline.stats_text(),
+                                                  self.governor.status_text(), self.change_tracker.stats_text())))
+        self.frame_pipeline.stop()
+        self.tiled_executor.shutdown()
         self.camera.release()
+        if recorder is not None:
+            recorder.close()
+
+    # Returns the function reading camera frames, from a recording when one is set to be replayed
+    def open_camera(self):
+        replay_path = os.environ.get(REPLAY_ENVIRONMENT_VARIABLE)
+        if replay_path:
+            realtime = os.environ.get(REPLAY_SPEED_ENVIRONMENT_VARIABLE) != REPLAY_SPEED_FAST
+            self.camera = FrameReplay(replay_path, realtime, loop=True)
+            return self.camera.read
+        self.camera = cv.VideoCapture(0)
+        # Keeping a single buffered frame, so that the frame read is the most recent one
+        self.camera.set(cv.CAP_PROP_BUFFERSIZE, 1)
+        return self.camera.read
+
+    def pace_frame(self):
+        self.scheduler.wait_until_due()
+        self.scheduler.frame_started()
+
+    # Called once per processing thread, each thread gets its own compiled chain
+    def create_frame_processor(self):
+        governed_processor = GovernedProcessor(self.governor, IncrementalProcessor(self.change_tracker))
+
+        def process(frame):
+            # Read once, so the stickers and every stage of this frame come from the same edit
+            snapshot = self.edit_state.snapshot
+            frame = self.overlay_stickers(frame, snapshot.stickers)
+            start = PROFILER.start()
+            frame = governed_processor(frame, snapshot.chain)
+            PROFILER.stop('filters', start)
+            return frame
+        return process
+
+    def current_proxy(self, source: PictureSource):
+        if source.proxy is not None:
+            return source.proxy
+        if self.built_proxy is None or self.built_proxy[0] is not source:
+            self.built_proxy = (source, ProxySource(source.picture, IMAGE_WIDTH, IMAGE_HEIGHT))
+        return self.built_proxy[1]
+
+    def load_picture(self, source: PictureSource, use_proxy: bool, stickers: tuple):
+        if use_proxy:
+            proxy = self.current_proxy(source)
+            return self.overlay_stickers(proxy.proxy.copy(), proxy.scale_stickers(stickers))
+        return self.overlay_stickers(source.picture.copy(), stickers)
+
+    def overlay_stickers(self, frame, stickers: tuple):
+        start = PROFILER.start()
+        frame = composite_stickers(frame, stickers)
+        PROFILER.stop('overlay', start)
+        return frame
+
+    # Resizes a BGR or greyscale frame into a free display buffer and hands it to the GUI thread
+    # Returns False if the GUI thread kept every buffer for too long, in which case the frame is dropped
+    def present_frame(self, frame):
+        buffer = self.display_pool.acquire(DISPLAY_BUFFER_TIMEOUT_SECONDS)
+        if buffer is None:
+            return False
+        start = PROFILER.start()
+        self.display_pool.render(frame, buffer)
+        height, width = buffer.image.shape[:2]
+        # Wraps the buffer's memory in place, Format_BGR888 reads OpenCV's channel order without a conversion
+        buffer.handle = QtGui.QImage(buffer.data.data, width, height, buffer.data.strides[0], QtGui.QImage.Format_BGR888)
+        PROFILER.stop('scale', start)
+        if self.hud_enabled:
+            self.draw_hud(buffer.handle)
+        self.ImageUpdate.emit(buffer)
+        self.scheduler.frame_presented()
+        return True
+
+    def hud_text_lines(self):
+        summary = PROFILER.summary()
+        dropped_frames = self.display_pool.dropped
+        if self.frame_pipeline is not None:
+            dropped_frames += self.frame_pipeline.dropped_frames()
+        PROFILER.set_counter('dropped_frames', dropped_frames)
+        PROFILER.set_counter('unchanged_frames_reused', self.change_tracker.reused)
+        PROFILER.set_counter('change_detection_saved_seconds', self.change_tracker.saved_seconds)
+        PROFILER.set_counter('edits_coalesced', self.edit_state.coalesced)
+        lines = [f'FPS {self.scheduler.achieved_fps():.1f}   dropped {dropped_frames}', self.governor.status_text()]
+        for name in HUD_STAGES:
+            if name in summary:
+                lines.append(f'{name}: {summary[name]["median_ms"]:.1f} ms')
+        for name, stage in summary.items():
+            if name.startswith('filter/'):
+                lines.append(f'{name[len("filter/"):]}: {stage["median_ms"]:.1f} ms')
+        return lines
+
+    # Draws frame rate, dropped frames and per-stage timings on the top-left corner of the displayed image
+    def draw_hud(self, image: QtGui.QImage):
+        now = time.perf_counter()
+        if now - self.hud_updated_at >= HUD_REFRESH_SECONDS:
+            self.hud_lines = self.hud_text_lines()
+            self.hud_updated_at = now
+        painter = QtGui.QPainter(image)
+        line_height = painter.fontMetrics().height()
+        width = max(painter.fontMetrics().horizontalAdvance(line) for line in self.hud_lines) + 12
+        painter.fillRect(0, 0, width, line_height * len(self.hud_lines) + 8, QtGui.QColor(0, 0, 0, 160))
+        painter.setPen(QtGui.QColor(255, 255, 0))
+        for index, line in enumerate(self.hud_lines):
+            painter.drawText(6, 4 + line_height * (index + 1) - painter.fontMetrics().descent(), line)
+        painter.end()
+
+    # proxy: the picture's ProxySource if it was already built while loading
+    # Replacing the reference is the whole hand-over, the render thread reads either the previous picture or this one
+    def set_picture(self, picture: np.ndarray | None, proxy: ProxySource = None):
+        self.picture_source = PictureSource(self.picture_source.version + 1, picture, proxy)
+        self.scheduler.notify(EVENT_SOURCE)
+
+    # Shows a picture from its proxy while the full resolution image is still being decoded
+    def set_preview(self, proxy: ProxySource):
+        self.picture_source = PictureSource(self.picture_source.version + 1, None, proxy, True)
+        self.scheduler.notify(EVENT_SOURCE)
+
+    def set_using_camera(self, using_camera: bool):
+        self.using_camera = using_camera
+        if self.frame_pipeline is not None:
+            self.frame_pipeline.set_paused(not using_camera)
+        self.scheduler.notify(EVENT_SOURCE)
+
+    def set_proxy_enabled(self, proxy_enabled: bool):
+        self.proxy_enabled = proxy_enabled
+        self.scheduler.notify(EVENT_SOURCE)
+
+    def set_change_threshold(self, threshold: int):
+        self.change_tracker.threshold = threshold
+        self.change_tracker.reset()
+
+    def set_target_fps(self, target_fps: int):
+        self.scheduler.set_target_fps(target_fps)
+        self.governor.set_target_fps(target_fps)
+        # Publishing edits faster than frames are rendered would only render frames no one sees
+        self.edit_state.set_min_interval(1 / target_fps if target_fps > 0 else 0.0)
+
+    def set_hud_enabled(self, hud_enabled: bool):
+        self.hud_enabled = hud_enabled
+        # Still images are only presented again when their result changes, the HUD has to force it
+        self.displayed_key = None
+        self.scheduler.notify(EVENT_PARAMETER)
+
+    # Called by EditState on the thread that published (the GUI thread or its coalescing timer)
+    def edits_published(self, snapshot, events: set):
+        for event in events:
+            self.scheduler.notify(event)
+
+    # Latest edits, including any change still waiting to be coalesced
+    def current_snapshot(self):
+        self.edit_state.flush()
+        return self.edit_state.snapshot
 
     def activate_or_deactivate_filter(self, param_filter_id):
-        filter_index = None
-        for index, active_filter in enumerate(self.active_filters_):
-            if active_filter.filter_id == param_filter_id:
-                filter_index = index
-
-        if filter_index is not None:
-            self.active_filters_.pop(filter_index)
-        else:
-            # Add new filter at the end so that it will be processed last
-            self.active_filters_.append(self.available_filters[param_filter_id])
-
-        if len(self.active_filters_) > 0:
-            return FILTER_COMPOSITION + ' > '.join([str(filter_) for filter_ in self.active_filters_])
+        self.edit_state.toggle_filter(param_filter_id)
+        active_filters = self.edit_state.active_chain()
+        if len(active_filters) > 0:
+            return FILTER_COMPOSITION + ' > '.join([str(filter_) for filter_ in active_filters])
         else:
             return NO_FILTERS_SELECTED
 
     def add_sticker(self, sticker: Sticker):
-        self.stickers.append(sticker)
+        self.edit_state.add_sticker(sticker)
 
     def remove_sticker(self):
-        if len(self.stickers) > 0:
-            self.stickers.pop(0)
-        if len(self.stickers) == 0:
+        if self.edit_state.remove_sticker() == 0:
             self.HideRemoveStickerButton.emit()
 
     def stop(self):
         self.ThreadActive = False
+        self.scheduler.notify(EVENT_STOP)
         # self.quit()
 
 
@@ -343,6 +779,107 @@ class FileDialogWorker(QtCore.QThread):
         self.quit()
 
 
+# Loads a picture with image_loading.load_picture, the preview and the full picture arrive as separate signals
+class PictureLoadWorker(QtCore.QThread):
+    previewLoaded = QtCore.pyqtSignal(object)
+    pictureLoaded = QtCore.pyqtSignal(object, object)
+    loadFailed = QtCore.pyqtSignal(str)
+
+    def __init__(self, file_path: str, cache: PyramidCache):
+        super().__init__()
+        self.file_path = file_path
+        self.cache = cache
+
+    def run(self):
+        try:
+            picture, proxy = load_picture(self.file_path, IMAGE_WIDTH, IMAGE_HEIGHT, self.cache, self.previewLoaded.emit)
+        except (ValueError, OSError) as error:
+            self.loadFailed.emit(str(error))
+            return
+        self.pictureLoaded.emit(picture, proxy)
+
+
+class StickerLoadWorker(QtCore.QThread):
+    # Carries the sticker image, None if it could not be read
+    stickerLoaded = QtCore.pyqtSignal(object)
+
+    def __init__(self, file_path: str):
+        super().__init__()
+        self.file_path = file_path
+
+    def run(self):
+        self.stickerLoaded.emit(load_sticker_image(self.file_path, STICKER_SCALE))
+
+
+# Processes a video file in the background, reporting progress to the GUI thread
+class VideoWorker(QtCore.QThread):
+    progressUpdate = QtCore.pyqtSignal(int, int)
+    videoFinished = QtCore.pyqtSignal(str)
+
+    def __init__(self, input_path: str, output_path: str, chain: list, stickers: list):
+        super().__init__()
+        self.input_path = input_path
+        self.output_path = output_path
+        self.chain = chain
+        self.stickers = stickers
+        self.cancelled = threading.Event()
+
+    def run(self):
+        try:
+            stats = process_video(self.input_path, self.output_path, self.chain, self.stickers,
+                                  progress=self.progressUpdate.emit, cancelled=self.cancelled)
+        except (ValueError, FileNotFoundError) as error:
+            self.videoFinished.emit(str(error))
+            return
+        except Exception as error:
+            # Anything else still closes the progress dialog, which is modal
+            self.videoFinished.emit(f'Failed: {type(error).__name__}: {error}')
+            return
+        status = 'Cancelled' if self.cancelled.is_set() else 'Finished'
+        self.videoFinished.emit(f'{status}: {stats}\nWritten to {self.output_path}')
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+# Renders the selected image at full resolution in the background and writes it to output_path
+class ExportWorker(QtCore.QThread):
+    progressUpdate = QtCore.pyqtSignal(int, int)
+    exportFinished = QtCore.pyqtSignal(str)
+
+    def __init__(self, picture: np.ndarray, output_path: str, chain: list, stickers: list):
+        super().__init__()
+        self.picture = picture
+        self.output_path = output_path
+        self.chain = chain
+        self.stickers = stickers
+        self.cancelled = threading.Event()
+
+    def run(self):
+        start = time.perf_counter()
+        tiled_executor = TiledExecutor()
+        try:
+            result = render_full_resolution(self.picture, self.chain, self.stickers, self.progressUpdate.emit,
+                                            self.cancelled, tiled_executor)
+            if result is None:
+                self.exportFinished.emit('Cancelled')
+                return
+            if not cv.imwrite(self.output_path, result):
+                self.exportFinished.emit(f'Could not write {self.output_path}')
+                return
+        except Exception as error:
+            # Anything else still closes the progress dialog, which is modal
+            self.exportFinished.emit(f'Failed: {type(error).__name__}: {error}')
+            return
+        finally:
+            tiled_executor.shutdown()
+        self.exportFinished.emit(f'{result.shape[1]}x{result.shape[0]} rendered in {time.perf_counter() - start:.2f}s\n'
+                                 f'Written to {self.output_path}')
+
+    def cancel(self):
+        self.cancelled.set()
+
+
 # Class used to keep track of which filter a parameter adjustment widget belongs to
 class FilterParameterWidget:
     def __init__(self, filter_: ImageFilter, widget: QtCore.QObject, param_index: int | None):
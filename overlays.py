@@ -1,4 +1,7 @@
+import itertools
+
 import numpy as np
+import cv2 as cv
 
 
 def overlay(background, foreground, x_offset=None, y_offset=None):
@@ -14,19 +17,14 @@ def overlay(background, foreground, x_offset=None, y_offset=None):
     if y_offset is None:
         y_offset = (bg_h - fg_h) // 2
 
-    w = min(fg_w, bg_w, fg_w + x_offset, bg_w - x_offset)
-    h = min(fg_h, bg_h, fg_h + y_offset, bg_h - y_offset)
-
-    if w < 1 or h < 1:
+    regions = overlap_regions(bg_h, bg_w, fg_h, fg_w, x_offset, y_offset)
+    if regions is None:
         return
 
     # clip foreground and background images to the overlapping regions
-    bg_x = max(0, x_offset)
-    bg_y = max(0, y_offset)
-    fg_x = max(0, x_offset * -1)
-    fg_y = max(0, y_offset * -1)
-    foreground = foreground[fg_y:fg_y + h, fg_x:fg_x + w]
-    background_subsection = background[bg_y:bg_y + h, bg_x:bg_x + w]
+    bg_region, fg_region = regions
+    foreground = foreground[fg_region]
+    background_subsection = background[bg_region]
 
     # separate alpha and color channels from the foreground image
     foreground_colors = foreground[:, :, :3]
@@ -39,13 +37,63 @@ def overlay(background, foreground, x_offset=None, y_offset=None):
     composite = background_subsection * (1 - alpha_mask) + foreground_colors * alpha_mask
 
     # overwrite the section of the background image that has been updated
-    background[bg_y:bg_y + h, bg_x:bg_x + w] = composite
+    background[bg_region] = composite
     out = background.copy()
     return out
 
 
+# Returns the (background, foreground) slices where a foreground at (x_offset, y_offset) overlaps the background,
+# or None if they do not overlap
+def overlap_regions(bg_h, bg_w, fg_h, fg_w, x_offset, y_offset):
+    w = min(fg_w, bg_w, fg_w + x_offset, bg_w - x_offset)
+    h = min(fg_h, bg_h, fg_h + y_offset, bg_h - y_offset)
+    if w < 1 or h < 1:
+        return None
+    bg_x = max(0, x_offset)
+    bg_y = max(0, y_offset)
+    fg_x = max(0, x_offset * -1)
+    fg_y = max(0, y_offset * -1)
+    return (slice(bg_y, bg_y + h), slice(bg_x, bg_x + w)), (slice(fg_y, fg_y + h), slice(fg_x, fg_x + w))
+
+
 class Sticker:
+    _ids = itertools.count()
+
     def __init__(self, image, x=None, y=None):
+        self.sticker_id = next(Sticker._ids)
         self.image = image
         self.x = x
         self.y = y
+        # Prepared once here so that drawing the sticker on a frame needs no float math and no per-frame masks
+        # premultiplied: colour * alpha / 255, inverse_alpha: 255 - alpha, both 3 channel uint8
+        if image.shape[2] == 4:
+            alpha = cv.cvtColor(image[:, :, 3], cv.COLOR_GRAY2BGR)
+        else:
+            alpha = np.full(image.shape[:2] + (3,), 255, dtype=np.uint8)
+        self.premultiplied = cv.multiply(np.ascontiguousarray(image[:, :, :3]), alpha, scale=1 / 255)
+        self.inverse_alpha = cv.bitwise_not(alpha)
+
+    # Blends the sticker into the frame in place, only touching the region it covers
+    def draw(self, frame):
+        bg_h, bg_w = frame.shape[:2]
+        fg_h, fg_w = self.premultiplied.shape[:2]
+        x_offset = (bg_w - fg_w) // 2 if self.x is None else self.x
+        y_offset = (bg_h - fg_h) // 2 if self.y is None else self.y
+        regions = overlap_regions(bg_h, bg_w, fg_h, fg_w, x_offset, y_offset)
+        if regions is None:
+            return
+        bg_region, fg_region = regions
+        background_subsection = frame[bg_region]
+        # background * (255 - alpha) / 255 + premultiplied colour, with OpenCV rounding and saturation
+        cv.multiply(background_subsection, self.inverse_alpha[fg_region], dst=background_subsection, scale=1 / 255)
+        cv.add(background_subsection, self.premultiplied[fg_region], dst=background_subsection)
+
+
+# Draws every sticker on the frame in place, in the order they were added
+# Read-only frames (e.g. replayed from a recording) are copied first
+def composite_stickers(frame, stickers: list):
+    if stickers and not frame.flags.writeable:
+        frame = frame.copy()
+    for sticker in stickers:
+        sticker.draw(frame)
+    return frame
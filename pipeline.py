@@ -0,0 +1,221 @@
+from collections import OrderedDict
+
+import numpy as np
+import cv2 as cv
+
+from filters import ImageFilter, ChannelLayout, image_layout, expand_to_bgr, to_dst
+from profiling import PROFILER
+
+# Shapes PingPongBuffers keeps buffers for, a BGR and a greyscale shape per frame size
+MAX_BUFFER_SHAPES = 4
+
+IDENTITY_TABLE = np.ascontiguousarray(np.repeat(np.arange(256, dtype=np.uint8)[:, np.newaxis], 3, axis=1))
+
+
+# A run of consecutive per-pixel filters applied as a single reduction followed by a single lookup table
+class FusedStage:
+    def __init__(self, filters: list, reduce=None, table: np.ndarray = IDENTITY_TABLE, grey_input: bool = True):
+        self.filters = filters
+        self.reduce = reduce
+        self.table = table
+        self.uniform_table = bool((table == table[:, :1]).all())
+        self.grey_table = np.ascontiguousarray(table[:, 0])
+        self.profiler_name = 'filter/' + repr(self)
+        self.accepts_dst = True
+        # Lookup tables only read the pixel they write, so without a reduction the input can be the output
+        self.in_place = reduce is None
+        if reduce is not None:
+            self.input_layouts = (ChannelLayout.GREY, ChannelLayout.BGR) if grey_input else (ChannelLayout.BGR,)
+        else:
+            self.input_layouts = (ChannelLayout.GREY, ChannelLayout.BGR) if self.uniform_table else (ChannelLayout.BGR,)
+
+    def apply(self, image):
+        return expand_to_bgr(self.apply_layout(image))
+
+    # With a dst, every step after the first one runs in place on it
+    def apply_layout(self, image, dst: np.ndarray = None):
+        if self.reduce is not None:
+            image = self.reduce(image, dst=dst if dst is not None and dst.ndim == 2 else None)
+        if image.ndim == 2:
+            if self.uniform_table:
+                return cv.LUT(image, self.grey_table, dst=dst)
+            image = expand_to_bgr(image, dst)
+        if self.table is IDENTITY_TABLE:
+            return to_dst(image, dst)
+        return cv.LUT(image, self.table.reshape(1, 256, 3), dst=dst)
+
+    def accepts_layout(self, layout: ChannelLayout):
+        return layout in self.input_layouts
+
+    def get_output_layout(self, input_layout: ChannelLayout):
+        if self.uniform_table and (self.reduce is not None or input_layout == ChannelLayout.GREY):
+            return ChannelLayout.GREY
+        return ChannelLayout.BGR
+
+    def parameter_key(self):
+        return tuple(filter_.parameter_key() for filter_ in self.filters)
+
+    # Per-pixel stages need no halo, unless one of their filters is only exact on whole frames
+    def get_tile_halo(self):
+        if any(filter_.get_tile_halo() is None for filter_ in self.filters):
+            return None
+        return 0
+
+    def __repr__(self):
+        return '(' + ' > '.join(str(filter_) for filter_ in self.filters) + ')'
+
+
+# Accumulates per-pixel operations until one of them can no longer be merged into the pending stage
+class _FusedStageBuilder:
+    def __init__(self):
+        self.filters = []
+        self.reduce = None
+        self.grey_input = True
+        self.table = IDENTITY_TABLE
+
+    def can_add(self, operation):
+        if operation.reduce is None:
+            return True
+        # The stage reduces before its table, so a first reduction cannot follow table operations
+        if self.reduce is None:
+            return self.table is IDENTITY_TABLE
+        # A second reduction is evaluated on the 256 grey levels of the first one, only exact when it is foldable
+        return operation.foldable
+
+    def add(self, filter_: ImageFilter, operation):
+        if operation.reduce is not None:
+            if self.reduce is None:
+                self.reduce = operation.reduce
+                self.grey_input = operation.grey_input
+            else:
+                # Every pixel currently is table[grey], so the new reduction only depends on grey as well
+                folded = operation.reduce(self.table[np.newaxis, :, :]).reshape(256)
+                self.table = np.ascontiguousarray(np.repeat(folded[:, np.newaxis], 3, axis=1))
+        if operation.table is not None:
+            self.table = np.ascontiguousarray(np.take_along_axis(operation.table, self.table.astype(np.intp), axis=0))
+        self.filters.append(filter_)
+
+    def build(self):
+        return FusedStage(self.filters, self.reduce, self.table, self.grey_input)
+
+
+# Splits a filter chain in stages, fusing every run of per-pixel filters
+def compile_chain(chain: list):
+    stages = []
+    builder = None
+    for filter_ in chain:
+        operation = filter_.get_pixel_operation()
+        if operation is None:
+            if builder is not None:
+                stages.append(builder.build())
+                builder = None
+            stages.append(filter_)
+            continue
+        if builder is not None and not builder.can_add(operation):
+            stages.append(builder.build())
+            builder = None
+        if builder is None:
+            builder = _FusedStageBuilder()
+        builder.add(filter_, operation)
+    if builder is not None:
+        stages.append(builder.build())
+    return stages
+
+
+def chain_key(chain: list):
+    return tuple(filter_.parameter_key() for filter_ in chain)
+
+
+# Rows a stripe needs above and below for the whole compiled chain to match the whole-frame result,
+# None if a stage can only be applied to whole frames
+def chain_halo(stages: list):
+    halos = [stage.get_tile_halo() for stage in stages]
+    if any(halo is None for halo in halos):
+        return None
+    return sum(halos)
+
+
+# Two output arrays per image shape, reused frame after frame: each stage writes into the one its input is not in
+# Only the most recently used shapes are kept, stripes of varying height would otherwise pile up
+class PingPongBuffers:
+    def __init__(self, max_shapes: int = MAX_BUFFER_SHAPES):
+        self.buffers = OrderedDict()
+        self.max_shapes = max_shapes
+
+    def get(self, shape: tuple, avoid: np.ndarray):
+        pair = self.buffers.get(shape)
+        if pair is None:
+            pair = self.buffers[shape] = [np.empty(shape, dtype=np.uint8), np.empty(shape, dtype=np.uint8)]
+            if len(self.buffers) > self.max_shapes:
+                self.buffers.popitem(last=False)
+        self.buffers.move_to_end(shape)
+        return pair[1] if pair[0] is avoid else pair[0]
+
+    def owns(self, image: np.ndarray):
+        pair = self.buffers.get(image.shape)
+        return pair is not None and any(buffer is image for buffer in pair)
+
+
+# Shape of the image a stage returns for the given input
+def stage_output_shape(stage, image: np.ndarray):
+    input_layout = image_layout(image)
+    if not stage.accepts_layout(input_layout):
+        input_layout = ChannelLayout.BGR
+    if stage.get_output_layout(input_layout) == ChannelLayout.GREY:
+        return image.shape[:2]
+    return image.shape[:2] + (3,)
+
+
+# Keeps the compiled plan of the last chain it was given, compiling again only when the chain or a parameter changes
+class ChainCompiler:
+    def __init__(self):
+        self.plan_key = None
+        self.plan = []
+        self.compile_count = 0
+        self.buffers = PingPongBuffers()
+        # Stage results that needed a new array, because the stage takes no dst or it was the last one
+        self.allocations = 0
+
+    def compile(self, chain: list):
+        key = chain_key(chain)
+        if key != self.plan_key:
+            self.plan = compile_chain(chain)
+            self.plan_key = key
+            self.compile_count += 1
+        return self.plan
+
+    # Greyscale results stay in a single channel between stages that accept it
+    # expand_grey=False leaves the expansion to the caller, e.g. a display that can convert grey directly
+    # executor: optional TiledExecutor used to split large frames in stripes
+    # Intermediate results go to ping-pong buffers, the last stage returns a new array the caller may keep
+    # (or writes into out when given, an array of the final shape), the input image is never modified
+    def apply(self, image, chain: list, expand_grey: bool = True, executor=None, out: np.ndarray = None):
+        stages = self.compile(list(chain))
+        for index, stage in enumerate(stages):
+            shape = stage_output_shape(stage, image)
+            if index < len(stages) - 1:
+                in_place = stage.in_place and image.shape == shape and self.buffers.owns(image)
+                dst = image if in_place else self.buffers.get(shape, image)
+            else:
+                dst = out if out is not None and out.shape == shape else None
+            result = apply_stage(stage, image, executor, dst if stage.accepts_dst else None)
+            if result is not dst:
+                self.allocations += 1
+            image = result
+        if expand_grey and image.ndim == 2:
+            return expand_to_bgr(image, out)
+        if not stages:
+            return to_dst(image, out)
+        return image
+
+
+def apply_stage(stage, image, executor=None, dst: np.ndarray = None):
+    start = PROFILER.start()
+    if not stage.accepts_layout(image_layout(image)):
+        image = expand_to_bgr(image)
+    if executor is not None:
+        image = executor.apply(stage, image, dst)
+    else:
+        image = stage.apply_layout(image, dst)
+    PROFILER.stop(stage.profiler_name, start)
+    return image
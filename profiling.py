@@ -0,0 +1,139 @@
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+RING_CAPACITY = 512
+# Upper bounds of the histogram buckets, in milliseconds
+HISTOGRAM_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 33, 50, 100, 200, 500, 1000, 2000, 5000)
+METRICS_HOST = '127.0.0.1'
+
+
+# Fixed size buffer holding the latest durations of one stage
+class TimingRing:
+    def __init__(self, capacity: int = RING_CAPACITY):
+        self.values = np.zeros(capacity)
+        self.counter = itertools.count()
+        self.count = 0
+
+    def add(self, seconds: float):
+        # next() on a count is atomic, so threads recording the same stage never overwrite each other's slot
+        index = next(self.counter)
+        self.values[index % len(self.values)] = seconds
+        self.count = index + 1
+
+    def latest(self):
+        return self.values[:min(self.count, len(self.values))]
+
+
+# Records how long each stage and filter takes
+# Usage: start = PROFILER.start(); ...; PROFILER.stop('stage', start)
+# While disabled, start returns None and stop returns immediately, so instrumented code pays almost nothing
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.rings = {}
+        self.rings_lock = threading.Lock()
+        self.counters = {}
+        self.server = None
+
+    def start(self):
+        if self.enabled:
+            return time.perf_counter()
+        return None
+
+    def stop(self, name: str, start):
+        if start is None:
+            return
+        self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float):
+        ring = self.rings.get(name)
+        if ring is None:
+            with self.rings_lock:
+                ring = self.rings.setdefault(name, TimingRing())
+        ring.add(seconds)
+
+    def set_counter(self, name: str, value: int):
+        self.counters[name] = value
+
+    def reset(self):
+        with self.rings_lock:
+            self.rings = {}
+        self.counters = {}
+
+    # Median, p95 and total count of every stage, in milliseconds
+    def summary(self):
+        summary = {}
+        for name, ring in list(self.rings.items()):
+            values = ring.latest() * 1000
+            if len(values) == 0:
+                continue
+            summary[name] = {
+                'count': ring.count,
+                'median_ms': float(np.median(values)),
+                'p95_ms': float(np.percentile(values, 95)),
+            }
+        return summary
+
+    # Cumulative histogram of the durations currently in each ring, with HISTOGRAM_BUCKETS_MS as upper bounds
+    def histograms(self):
+        histograms = {}
+        for name, ring in list(self.rings.items()):
+            values = ring.latest() * 1000
+            buckets = [int(np.count_nonzero(values <= bound)) for bound in HISTOGRAM_BUCKETS_MS]
+            histograms[name] = {'buckets_ms': list(HISTOGRAM_BUCKETS_MS), 'cumulative_counts': buckets,
+                                'samples': len(values), 'sum_ms': float(values.sum())}
+        return histograms
+
+    def export_json(self, path: str):
+        with open(path, 'w') as file:
+            json.dump({'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'summary': self.summary(),
+                       'histograms': self.histograms(), 'counters': self.counters}, file, indent=2)
+
+    # Prometheus text format, with the rolling window of every ring exposed as a histogram
+    def metrics_text(self):
+        lines = ['# TYPE stage_duration_ms histogram']
+        for name, histogram in self.histograms().items():
+            label = name.replace('\\', '\\\\').replace('"', '\\"')
+            for bound, count in zip(histogram['buckets_ms'], histogram['cumulative_counts']):
+                lines.append(f'stage_duration_ms_bucket{{stage="{label}",le="{bound}"}} {count}')
+            lines.append(f'stage_duration_ms_bucket{{stage="{label}",le="+Inf"}} {histogram["samples"]}')
+            lines.append(f'stage_duration_ms_sum{{stage="{label}"}} {histogram["sum_ms"]}')
+            lines.append(f'stage_duration_ms_count{{stage="{label}"}} {histogram["samples"]}')
+        for name, value in self.counters.items():
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    # Serves metrics_text on http://127.0.0.1:<port>/metrics from a background thread
+    def serve_metrics(self, port: int):
+        profiler = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = profiler.metrics_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((METRICS_HOST, port), MetricsHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop_serving(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+
+PROFILER = Profiler()
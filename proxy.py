@@ -0,0 +1,109 @@
+import copy
+
+import cv2 as cv
+import numpy as np
+
+from overlays import Sticker, composite_stickers
+from pipeline import apply_stage, compile_chain
+
+# Interactive editing of large pictures runs the chain on a copy downscaled once to display size (the proxy)
+# Filters whose look depends on the image size get their parameters rescaled, so the preview matches the full
+# resolution result, which is only rendered on export
+
+
+# Scale of the proxy of a width x height picture and the proxy's size, pictures are never scaled up
+def proxy_size(width: int, height: int, max_width: int, max_height: int):
+    scale = min(1.0, max_width / width, max_height / height)
+    return scale, (max(1, round(width * scale)), max(1, round(height * scale)))
+
+
+# image: the full picture, None while only a preview of it is loaded
+# proxy: an already downscaled copy to use instead of resizing image, full_size: (width, height) of the picture
+# full_gradient: mean_gradient of the full picture if it is already known
+class ProxySource:
+    def __init__(self, image: np.ndarray | None, max_width: int, max_height: int, proxy: np.ndarray = None,
+                 full_size: tuple = None, full_gradient: float = None):
+        self.image = image
+        self.full_size = full_size if full_size is not None else (image.shape[1], image.shape[0])
+        self.scale, size = proxy_size(*self.full_size, max_width, max_height)
+        if proxy is not None:
+            self.proxy = proxy
+        elif self.scale < 1.0:
+            self.proxy = cv.resize(image, size, interpolation=cv.INTER_AREA)
+        else:
+            self.proxy = image
+        self.full_gradient = full_gradient
+        self._gradient_ratio = None
+        # sticker_id -> (sticker image it was made from, scaled Sticker), the cached Stickers are never moved
+        self.scaled_stickers = {}
+
+    # The same proxy for the full picture once it is loaded
+    def with_image(self, image: np.ndarray, full_gradient: float = None):
+        source = copy.copy(self)
+        source.image = image
+        source.full_gradient = full_gradient if full_gradient is not None else self.full_gradient
+        source._gradient_ratio = None
+        source.scaled_stickers = {}
+        return source
+
+    # How much stronger the edges of the proxy are than those of the full image, computed on first use
+    # Downscaling packs the same intensity step in fewer pixels, so Canny thresholds are multiplied by this
+    # Until the full picture is loaded (and without its gradient) thresholds are left as they are
+    def gradient_ratio(self):
+        if self._gradient_ratio is None:
+            if self.full_gradient is None:
+                if self.image is None:
+                    return 1.0
+                self.full_gradient = self.mean_gradient(self.image)
+            full = self.full_gradient
+            self._gradient_ratio = self.mean_gradient(self.proxy) / full if full > 0 else 1.0
+        return self._gradient_ratio
+
+    @staticmethod
+    def mean_gradient(image: np.ndarray):
+        grey = cv.cvtColor(image, cv.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        return float(np.mean(np.abs(cv.Sobel(grey, cv.CV_32F, 1, 0))) + np.mean(np.abs(cv.Sobel(grey, cv.CV_32F, 0, 1))))
+
+    def scale_chain(self, chain: list):
+        if self.scale == 1.0:
+            return list(chain)
+        gradient_ratio = self.gradient_ratio() if any(filter_.scale_parameter is not None for filter_ in chain) else 1.0
+        return [filter_.scaled_copy(self.scale, gradient_ratio) for filter_ in chain]
+
+    # Stickers resized with the picture, the resized images are kept while their stickers exist
+    # Each call returns new Stickers sharing the cached images, so stickers already handed out are never changed
+    def scale_stickers(self, stickers: list):
+        if self.scale == 1.0:
+            return stickers
+        scaled = []
+        for sticker in stickers:
+            cached = self.scaled_stickers.get(sticker.sticker_id)
+            if cached is None or cached[0] is not sticker.image:
+                image = cv.resize(sticker.image, (0, 0), fx=self.scale, fy=self.scale, interpolation=cv.INTER_AREA)
+                cached = (sticker.image, Sticker(image))
+                self.scaled_stickers[sticker.sticker_id] = cached
+            scaled_sticker = copy.copy(cached[1])
+            scaled_sticker.x = None if sticker.x is None else round(sticker.x * self.scale)
+            scaled_sticker.y = None if sticker.y is None else round(sticker.y * self.scale)
+            scaled.append(scaled_sticker)
+        live_ids = {sticker.sticker_id for sticker in stickers}
+        for sticker_id in list(self.scaled_stickers):
+            if sticker_id not in live_ids:
+                del self.scaled_stickers[sticker_id]
+        return scaled
+
+
+# Renders the picture at its full resolution with the original parameters, one stage at a time
+# progress(stages_done, total_stages) is called after each stage; returns None if cancelled (a threading.Event) is set
+def render_full_resolution(image: np.ndarray, chain: list, stickers: list, progress=None, cancelled=None, executor=None):
+    image = composite_stickers(image.copy(), stickers)
+    stages = compile_chain(chain)
+    if progress is not None:
+        progress(0, len(stages))
+    for index, stage in enumerate(stages):
+        if cancelled is not None and cancelled.is_set():
+            return None
+        image = apply_stage(stage, image, executor)
+        if progress is not None:
+            progress(index + 1, len(stages))
+    return image
@@ -0,0 +1,246 @@
+import argparse
+import os
+import sys
+import time
+
+import cv2 as cv
+import numpy as np
+
+from filters import parse_filter_chain, format_filter_chain
+from overlays import composite_stickers
+from pipeline import ChainCompiler
+from video import load_sticker, DEFAULT_STICKER_SCALE
+
+# Records captured frames with their timestamps to a file and replays them in place of the camera, so slowdowns
+# can be reproduced and whole pipelines benchmarked without a webcam
+# The file is a fixed size header followed by fixed size records (timestamp, raw pixels), both memory-mapped:
+# replayed frames are read-only views into the mapping, never copies, and the OS pages them in as needed
+# Must never import PyQt5, recordings are also replayed headless
+
+RECORDING_MAGIC = b'IFAFRAME'
+RECORDING_VERSION = 1
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('version', '<u4'), ('height', '<u4'), ('width', '<u4'), ('channels', '<u4'),
+                         ('count', '<u8')])
+# Records start at a round offset, so every frame starts on the same alignment as in a freshly allocated array
+HEADER_SIZE = 64
+# Records the file grows by when full, so that it is not resized (and remapped) on every frame
+GROWTH_RECORDS = 64
+
+
+def record_dtype(shape: tuple):
+    return np.dtype([('timestamp', '<f8'), ('frame', np.uint8, shape)])
+
+
+# Writes frames to a recording, all of them must have the shape of the first one
+# Timestamps are seconds since the first frame; the frame count in the header is updated on every frame,
+# so a recording cut short by a crash is still readable up to its last frame
+class FrameRecorder:
+    def __init__(self, path: str):
+        self.path = path
+        self.header = None
+        self.records = None
+        self.shape = None
+        self.count = 0
+        self.started_at = None
+
+    def write(self, frame: np.ndarray, timestamp: float = None):
+        now = time.perf_counter() if timestamp is None else timestamp
+        if self.records is None:
+            self.create(frame.shape)
+            self.started_at = now
+        if frame.shape != self.shape:
+            raise ValueError(f'Frame shape {frame.shape} differs from the recording shape {self.shape}')
+        if self.count == len(self.records):
+            self.map_records(self.count + GROWTH_RECORDS)
+        record = self.records[self.count]
+        record['timestamp'] = now - self.started_at
+        np.copyto(record['frame'], frame)
+        self.count += 1
+        self.header['count'] = self.count
+
+    def create(self, shape: tuple):
+        self.shape = shape
+        with open(self.path, 'wb') as file:
+            file.truncate(HEADER_SIZE)
+        self.header = np.memmap(self.path, HEADER_DTYPE, 'r+', shape=())
+        self.header['magic'] = RECORDING_MAGIC
+        self.header['version'] = RECORDING_VERSION
+        self.header['height'], self.header['width'] = shape[:2]
+        self.header['channels'] = shape[2] if len(shape) == 3 else 1
+        self.map_records(GROWTH_RECORDS)
+
+    def map_records(self, capacity: int):
+        if self.records is not None:
+            self.records.flush()
+            self.records = None
+        self.records = np.memmap(self.path, record_dtype(self.shape), 'r+', HEADER_SIZE, (capacity,))
+
+    def close(self):
+        if self.records is None:
+            return
+        self.records.flush()
+        self.header.flush()
+        self.records = None
+        self.header = None
+        # Drops the unused records of the last growth step
+        with open(self.path, 'r+b') as file:
+            file.truncate(HEADER_SIZE + self.count * record_dtype(self.shape).itemsize)
+
+
+# Wraps a read_frame function (returning (ret, image) like cv.VideoCapture.read) so every frame read is recorded
+def recording_reader(read_frame, recorder: FrameRecorder):
+    def read_and_record():
+        ret, image = read_frame()
+        if ret:
+            recorder.write(image)
+        return ret, image
+    return read_and_record
+
+
+# Replays a recording through read(), like cv.VideoCapture.read
+# realtime: frames become available at their recorded timing; when the reader falls behind it gets the latest due
+# frame, as from a camera keeping a single buffered frame. Otherwise every frame is returned in order, immediately
+# loop: starts over at the end instead of returning (False, None)
+class FrameReplay:
+    def __init__(self, path: str, realtime: bool = True, loop: bool = False):
+        header = np.memmap(path, HEADER_DTYPE, 'r', shape=())
+        if header['magic'] != RECORDING_MAGIC or header['version'] != RECORDING_VERSION:
+            raise ValueError(f'{path} is not a frame recording')
+        height, width, channels = int(header['height']), int(header['width']), int(header['channels'])
+        self.shape = (height, width, channels) if channels > 1 else (height, width)
+        self.frame_count = int(header['count'])
+        if self.frame_count == 0:
+            raise ValueError(f'{path} has no frames')
+        records = np.memmap(path, record_dtype(self.shape), 'r', HEADER_SIZE, (self.frame_count,))
+        self.timestamps = np.asarray(records['timestamp'])
+        self.frames = np.asarray(records['frame'])
+        self.realtime = realtime
+        self.loop = loop
+        self.position = 0
+        self.started_at = None
+        self.skipped = 0
+
+    def duration(self):
+        return float(self.timestamps[-1] - self.timestamps[0])
+
+    def fps(self):
+        return (self.frame_count - 1) / self.duration() if self.duration() > 0 else 0.0
+
+    def read(self):
+        if self.position == self.frame_count:
+            if not self.loop:
+                return False, None
+            self.position = 0
+            if self.started_at is not None:
+                # The first frame of the next pass is due one average frame interval after the last one
+                self.started_at += self.duration() + (1 / self.fps() if self.fps() > 0 else 0.0)
+        index = self.position
+        if self.realtime:
+            index = self.wait_for_frame()
+        self.position = index + 1
+        return True, self.frames[index]
+
+    # Sleeps until the next frame is due, or returns the latest due frame if that time already passed
+    def wait_for_frame(self):
+        now = time.perf_counter()
+        if self.started_at is None:
+            self.started_at = now
+        elapsed = now - self.started_at
+        offsets = self.timestamps - self.timestamps[0]
+        if elapsed < offsets[self.position]:
+            time.sleep(offsets[self.position] - elapsed)
+            return self.position
+        index = int(np.searchsorted(offsets, elapsed, 'right')) - 1
+        self.skipped += index - self.position
+        return index
+
+    def rewind(self):
+        self.position = 0
+        self.started_at = None
+        self.skipped = 0
+
+    # The views returned by read() stay valid, the mapping is closed once the last of them is gone
+    def release(self):
+        self.frames = None
+        self.position = self.frame_count
+        self.loop = False
+
+
+# Video files are recorded with their own frame timestamps, cameras with the time each frame was read
+def record(source: str, path: str, frames: int, seconds: float):
+    camera = source.isdigit()
+    capture = cv.VideoCapture(int(source) if camera else source)
+    if not capture.isOpened():
+        raise FileNotFoundError(f'Could not open {source}')
+    recorder = FrameRecorder(path)
+    deadline = time.perf_counter() + seconds
+    try:
+        while recorder.count < frames and (not camera or time.perf_counter() < deadline):
+            ret, image = capture.read()
+            if not ret:
+                break
+            recorder.write(image, None if camera else capture.get(cv.CAP_PROP_POS_MSEC) / 1000)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        recorder.close()
+        capture.release()
+    return recorder.count
+
+
+# Applies stickers and a chain to every frame of a recording, one after the other, and returns the frame times
+def benchmark_replay(replay: FrameReplay, chain: list, stickers: list):
+    chain_compiler = ChainCompiler()
+    times = []
+    while True:
+        ret, frame = replay.read()
+        if not ret:
+            return times
+        start = time.perf_counter()
+        chain_compiler.apply(composite_stickers(frame, stickers), chain, expand_grey=False)
+        times.append(time.perf_counter() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Records frames to a file, or replays a recording through a chain.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    record_parser = commands.add_parser('record', help='Records a camera (its index) or a video file')
+    record_parser.add_argument('source', help='Camera index or video path')
+    record_parser.add_argument('output')
+    record_parser.add_argument('--frames', type=int, default=sys.maxsize)
+    record_parser.add_argument('--seconds', type=float, default=10.0, help='How long to record a camera')
+    replay_parser = commands.add_parser('replay', help='Applies a chain to every recorded frame and reports timings')
+    replay_parser.add_argument('recording')
+    replay_parser.add_argument('chain', help='e.g. "Gaussian Blur: 9, 9 > Canny: 50, 150"')
+    replay_parser.add_argument('--realtime', action='store_true', help='Replay at the recorded timing')
+    replay_parser.add_argument('--sticker', action='append', default=[], help='path[@x,y], may be repeated')
+    replay_parser.add_argument('--sticker-scale', type=float, default=DEFAULT_STICKER_SCALE)
+    args = parser.parse_args(argv)
+
+    if args.command == 'record':
+        try:
+            count = record(args.source, args.output, args.frames, args.seconds)
+        except FileNotFoundError as error:
+            parser.error(str(error))
+        size = os.path.getsize(args.output) / 2 ** 20 if os.path.exists(args.output) else 0
+        print(f'Recorded {count} frames to {args.output} ({size:.1f} MB)')
+        return 0
+
+    try:
+        replay = FrameReplay(args.recording, args.realtime)
+        chain = parse_filter_chain(args.chain)
+        stickers = [load_sticker(description, args.sticker_scale) for description in args.sticker]
+    except (ValueError, FileNotFoundError) as error:
+        parser.error(str(error))
+    print(f'{replay.frame_count} frames of {replay.shape[1]}x{replay.shape[0]} recorded at {replay.fps():.1f} fps, '
+          f'"{format_filter_chain(chain)}"')
+    start = time.perf_counter()
+    times = np.array(benchmark_replay(replay, chain, stickers)) * 1000
+    elapsed = time.perf_counter() - start
+    print(f'{len(times) / elapsed:.1f} frames/s, median {np.median(times):.2f} ms, p95 {np.percentile(times, 95):.2f} ms'
+          + (f', {replay.skipped} frames skipped' if args.realtime else ''))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
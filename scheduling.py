@@ -0,0 +1,84 @@
+import threading
+import time
+from collections import deque
+
+DEFAULT_TARGET_FPS = 30
+MAX_TARGET_FPS = 120
+STATS_INTERVAL_SECONDS = 1.0
+
+# Reasons for rendering a new frame, passed to FrameScheduler.notify
+EVENT_PARAMETER = 'parameter'
+EVENT_STICKER = 'sticker'
+EVENT_SOURCE = 'source'
+EVENT_STOP = 'stop'
+
+
+# Wakes the render loop only when something changed and paces frames to a target rate
+# A target of 0 means frames are rendered as fast as they arrive
+class FrameScheduler:
+    def __init__(self, target_fps: int = DEFAULT_TARGET_FPS):
+        self.condition = threading.Condition()
+        self.pending_events = set()
+        self.target_fps = target_fps
+        self.next_frame_time = 0.0
+        self.presented_times = deque(maxlen=2 * MAX_TARGET_FPS)
+        self.presented_frames = 0
+        self.stats_wall_time = time.perf_counter()
+        self.stats_cpu_time = time.process_time()
+        self.cpu_percent = 0.0
+
+    def set_target_fps(self, target_fps: int):
+        self.target_fps = target_fps
+        self.next_frame_time = 0.0
+
+    def frame_interval(self):
+        return 1.0 / self.target_fps if self.target_fps > 0 else 0.0
+
+    def notify(self, event: str):
+        with self.condition:
+            self.pending_events.add(event)
+            self.condition.notify_all()
+
+    # Blocks until at least one event arrives, returning and clearing every pending event
+    def wait_for_event(self, timeout: float = None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending_events, timeout)
+            events = self.pending_events
+            self.pending_events = set()
+            return events
+
+    def wait_until_due(self):
+        remaining = self.next_frame_time - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def frame_started(self):
+        now = time.perf_counter()
+        # A late frame does not make the next ones come faster, they are paced from now instead
+        self.next_frame_time = max(self.next_frame_time + self.frame_interval(), now)
+
+    def frame_presented(self):
+        self.presented_times.append(time.perf_counter())
+        self.presented_frames += 1
+
+    def achieved_fps(self):
+        now = time.perf_counter()
+        recent = [timestamp for timestamp in self.presented_times if now - timestamp <= STATS_INTERVAL_SECONDS]
+        if len(recent) < 2:
+            return float(len(recent))
+        return (len(recent) - 1) / (recent[-1] - recent[0])
+
+    # Updates the CPU usage of the whole process since the previous call, returns False if it is too soon
+    def update_stats(self):
+        wall_time = time.perf_counter()
+        elapsed = wall_time - self.stats_wall_time
+        if elapsed < STATS_INTERVAL_SECONDS:
+            return False
+        cpu_time = time.process_time()
+        self.cpu_percent = 100.0 * (cpu_time - self.stats_cpu_time) / elapsed
+        self.stats_wall_time = wall_time
+        self.stats_cpu_time = cpu_time
+        return True
+
+    def stats_text(self):
+        return f'FPS: {self.achieved_fps():.1f} | CPU: {self.cpu_percent:.0f}%'
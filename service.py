@@ -0,0 +1,428 @@
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import shared_memory
+
+import cv2 as cv
+import numpy as np
+
+from filters import filter_chain_from_json
+from image_loading import read_image_header_from
+from pipeline import ChainCompiler
+
+# Serves the filter chains to other processes on the same host over HTTP on localhost
+# POST /filter with the chain as JSON in the X-Filter-Chain header (see filters.filter_chain_to_json) and the image as
+# the body: raw uint8 pixels (Content-Type application/octet-stream, X-Image-Shape "height,width[,channels]"),
+# answered in the same format, or an encoded image (e.g. image/png), answered as PNG
+# Concurrent requests are batched and filtered on a process pool; pixels travel through shared memory, never pickled
+# When every slot is taken the server answers 503 with Retry-After instead of queueing without bound
+# Encoded images must be PNG or JPEG, whose size is read from their header before anything is decoded
+# Must never import PyQt5, it is meant to run without a display
+
+SERVICE_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_BATCH_SIZE = 8
+# How long the dispatcher waits for more requests to join a batch
+DEFAULT_BATCH_WINDOW_SECONDS = 0.002
+# Requests accepted at once, each one holds a shared memory slot until its response is sent
+DEFAULT_MAX_PENDING = 32
+# Largest body, and largest image once decoded (in BGR)
+MAX_IMAGE_BYTES = 8192 * 8192 * 3
+RETRY_AFTER_SECONDS = 1
+REQUEST_TIMEOUT_SECONDS = 60
+RAW_CONTENT_TYPE = 'application/octet-stream'
+PARSED_CHAINS = 64
+
+
+class Overloaded(Exception):
+    pass
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+# A failure of the service rather than of the request: 500, or 503 while the pool is being replaced
+class FilterFailed(Exception):
+    def __init__(self, message: str, status: int = 500):
+        super().__init__(message)
+        self.status = status
+
+
+# Shared memory holding one request's input image followed by room for its result (at most the input size in BGR)
+# A slot outgrown by a frame gets a new segment, under a new name
+class SharedFrameSlot:
+    def __init__(self, index: int):
+        self.index = index
+        self.memory = None
+
+    def prepare(self, shape: tuple):
+        input_bytes = int(np.prod(shape))
+        needed = input_bytes + shape[0] * shape[1] * 3
+        if self.memory is None or self.memory.size < needed:
+            self.close()
+            self.memory = shared_memory.SharedMemory(create=True, size=needed)
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.memory.buf)
+
+    def output(self, shape: tuple, input_shape: tuple):
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.memory.buf, offset=int(np.prod(input_shape)))
+
+    def close(self):
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+
+
+# abandoned is set when the request stopped waiting: the pool may still write into the slot, so it is only freed
+# once the batch finished
+class Job:
+    def __init__(self, slot: SharedFrameSlot, shape: tuple, chain_text: str):
+        self.slot = slot
+        self.shape = shape
+        self.chain_text = chain_text
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.abandoned = False
+        self.output_shape = None
+        self.error = None
+        self.status = None
+
+
+# State of each pool process: the segment attached for each slot and the compiled chains, bounded
+_attached_segments = {}
+_compiled_chains = OrderedDict()
+
+
+def _init_worker():
+    # Each process already gets its own core, OpenCV threads would only compete with the other processes
+    cv.setNumThreads(1)
+
+
+# A slot with a new name was reallocated by the server: the previous segment is unlinked and closed here too,
+# so its pages are freed instead of staying mapped in every pool process
+def _attach(slot_index: int, name: str):
+    memory = _attached_segments.get(slot_index)
+    if memory is None or memory.name != name:
+        if memory is not None:
+            memory.close()
+        memory = _attached_segments[slot_index] = shared_memory.SharedMemory(name=name)
+    return memory
+
+
+def _compiled_chain(chain_text: str):
+    entry = _compiled_chains.get(chain_text)
+    if entry is None:
+        entry = _compiled_chains[chain_text] = (filter_chain_from_json(json.loads(chain_text)), ChainCompiler())
+        if len(_compiled_chains) > PARSED_CHAINS:
+            _compiled_chains.popitem(last=False)
+    _compiled_chains.move_to_end(chain_text)
+    return entry
+
+
+# Runs in a pool process: filters every image of the batch from its slot into the same slot
+# Returns (output shape, error, HTTP status of the error) per job: 400 when the chain rejects the image,
+# 500 for anything going wrong in OpenCV
+def process_jobs(jobs: list):
+    results = []
+    for slot_index, name, shape, chain_text in jobs:
+        try:
+            memory = _attach(slot_index, name)
+            image = np.ndarray(shape, dtype=np.uint8, buffer=memory.buf)
+            chain, chain_compiler = _compiled_chain(chain_text)
+            input_bytes = int(np.prod(shape))
+            result = chain_compiler.apply(image, chain, expand_grey=False)
+            output = np.ndarray(result.shape, dtype=np.uint8, buffer=memory.buf, offset=input_bytes)
+            np.copyto(output, result)
+            results.append((result.shape, None, None))
+        except ValueError as error:
+            results.append((None, str(error), 400))
+        except cv.error as error:
+            results.append((None, f'Filtering failed: {error}', 500))
+    return results
+
+
+class FilterService:
+    def __init__(self, workers: int = None, batch_size: int = DEFAULT_BATCH_SIZE,
+                 batch_window: float = DEFAULT_BATCH_WINDOW_SECONDS, max_pending: int = DEFAULT_MAX_PENDING):
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.free_slots = queue.Queue()
+        self.slots = [SharedFrameSlot(index) for index in range(max_pending)]
+        for slot in self.slots:
+            self.free_slots.put(slot)
+        self.jobs = queue.Queue()
+        # Two batches per process: one running, one ready to start as soon as it finishes
+        self.in_flight = threading.Semaphore(2 * self.workers)
+        self.pool = self.create_pool()
+        self.validated_chains = OrderedDict()
+        self.chains_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.processed = 0
+        self.rejected = 0
+        self.batches = 0
+        self.pool_restarts = 0
+        self.dispatcher = threading.Thread(target=self.dispatch_loop, daemon=True)
+        self.dispatcher.start()
+
+    # Forking while request threads hold locks (the shared memory resource tracker's, for one) can deadlock the
+    # child, so pool processes are started fresh
+    def create_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker)
+
+    # Parsed once in the server too, so that invalid chains are answered with 400 before taking a slot
+    def validate_chain(self, chain_text: str):
+        with self.chains_lock:
+            if chain_text in self.validated_chains:
+                return
+        filter_chain_from_json(json.loads(chain_text))
+        with self.chains_lock:
+            self.validated_chains[chain_text] = True
+            if len(self.validated_chains) > PARSED_CHAINS:
+                self.validated_chains.popitem(last=False)
+
+    # Filters one image, blocking the calling request thread; raises Overloaded when no slot is free
+    # write_input(array) fills the input, read_output(array) consumes the result before the slot is reused
+    def filter(self, shape: tuple, chain_text: str, write_input, read_output):
+        self.validate_chain(chain_text)
+        try:
+            slot = self.free_slots.get_nowait()
+        except queue.Empty:
+            with self.stats_lock:
+                self.rejected += 1
+            raise Overloaded()
+        job = None
+        try:
+            write_input(slot.prepare(shape))
+            job = Job(slot, shape, chain_text)
+            self.jobs.put(job)
+            if not job.done.wait(REQUEST_TIMEOUT_SECONDS):
+                raise TimeoutError('Filtering timed out')
+            if job.status == 400:
+                raise ValueError(job.error)
+            if job.error is not None:
+                raise FilterFailed(job.error, job.status)
+            return read_output(slot.output(job.output_shape, shape))
+        finally:
+            if job is None:
+                self.free_slots.put(slot)
+            else:
+                with job.lock:
+                    # Still queued or running: batch_finished frees the slot
+                    job.abandoned = not job.done.is_set()
+                if not job.abandoned:
+                    self.free_slots.put(slot)
+
+    def dispatch_loop(self):
+        while True:
+            batch = [self.jobs.get()]
+            if batch[0] is None:
+                return
+            # Requests arriving within the batch window share one round trip to a pool process
+            deadline = time.perf_counter() + self.batch_window
+            while len(batch) < self.batch_size:
+                try:
+                    job = self.jobs.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if job is None:
+                    self.jobs.put(None)
+                    break
+                batch.append(job)
+            self.in_flight.acquire()
+            try:
+                future = self.pool.submit(process_jobs, [(job.slot.index, job.slot.memory.name, job.shape, job.chain_text)
+                                                         for job in batch])
+            except BrokenProcessPool as error:
+                # A pool process died (e.g. killed for memory), later batches get a new pool
+                self.pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = self.create_pool()
+                with self.stats_lock:
+                    self.pool_restarts += 1
+                self.finish_batch(batch, [(None, f'Worker failed: {error}', 503)] * len(batch))
+                continue
+            future.add_done_callback(lambda done, batch=batch: self.batch_finished(batch, done))
+
+    def batch_finished(self, batch: list, future):
+        try:
+            results = future.result()
+        except BrokenProcessPool as error:
+            # The next submit replaces the pool
+            results = [(None, f'Worker failed: {error}', 503)] * len(batch)
+        except Exception as error:
+            results = [(None, f'Worker failed: {error}', 500)] * len(batch)
+        self.finish_batch(batch, results)
+
+    def finish_batch(self, batch: list, results: list):
+        self.in_flight.release()
+        with self.stats_lock:
+            self.batches += 1
+            self.processed += len(batch)
+        for job, (output_shape, error, status) in zip(batch, results):
+            with job.lock:
+                job.output_shape = output_shape
+                job.error = error
+                job.status = status
+                job.done.set()
+                abandoned = job.abandoned
+            if abandoned:
+                self.free_slots.put(job.slot)
+
+    def stats(self):
+        with self.stats_lock:
+            return {'processed': self.processed, 'rejected': self.rejected, 'batches': self.batches,
+                    'pending': len(self.slots) - self.free_slots.qsize(), 'workers': self.workers,
+                    'pool_restarts': self.pool_restarts}
+
+    def shutdown(self):
+        self.jobs.put(None)
+        self.dispatcher.join()
+        self.pool.shutdown(cancel_futures=True)
+        for slot in self.slots:
+            slot.close()
+
+
+def parse_shape(text: str):
+    shape = tuple(int(value) for value in text.split(','))
+    if len(shape) not in (2, 3) or (len(shape) == 3 and shape[2] not in (1, 3)) or min(shape) <= 0:
+        raise ValueError(f'Invalid image shape: {text}')
+    return shape[:2] if len(shape) == 3 and shape[2] == 1 else shape
+
+
+# Refuses encoded images whose header is unknown or too large once decoded, before imdecode allocates them
+def check_encoded_size(body: bytes):
+    header = read_image_header_from(io.BytesIO(body))
+    if header is None:
+        raise ValueError('Encoded images must be PNG or JPEG, other formats can be sent as raw pixels')
+    if header.width * header.height * 3 > MAX_IMAGE_BYTES:
+        raise ImageTooLarge(f'Image of {header.width}x{header.height} is too large')
+
+
+def create_server(service: FilterService, port: int = DEFAULT_PORT):
+    class FilterHandler(BaseHTTPRequestHandler):
+        # Keeps connections open between requests, clients sending many images skip the TCP handshake
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            if self.path != '/stats':
+                self.send_error(404)
+                return
+            self.send_body(200, 'application/json', json.dumps(service.stats()).encode())
+
+        def do_POST(self):
+            if self.path != '/filter':
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                self.send_error(400, 'Invalid Content-Length')
+                return
+            if length <= 0 or length > MAX_IMAGE_BYTES:
+                self.send_error(413 if length > 0 else 400, 'Missing or too large image')
+                return
+            body = self.rfile.read(length)
+            raw = self.headers.get('Content-Type', RAW_CONTENT_TYPE) == RAW_CONTENT_TYPE
+            try:
+                chain_text = self.headers.get('X-Filter-Chain', '[]')
+                if raw:
+                    shape = parse_shape(self.headers.get('X-Image-Shape', ''))
+                    if int(np.prod(shape)) != length:
+                        raise ValueError('Body size does not match X-Image-Shape')
+                    source = np.frombuffer(body, dtype=np.uint8).reshape(shape)
+                else:
+                    check_encoded_size(body)
+                    source = cv.imdecode(np.frombuffer(body, dtype=np.uint8), cv.IMREAD_COLOR)
+                    if source is None:
+                        raise ValueError('Could not decode the image')
+                    shape = source.shape
+
+                def read_output(output):
+                    if raw:
+                        return output.tobytes(), ','.join(str(value) for value in output.shape)
+                    return cv.imencode('.png', output)[1].tobytes(), None
+
+                payload, output_shape = service.filter(shape, chain_text, lambda target: np.copyto(target, source),
+                                                       read_output)
+            except ImageTooLarge as error:
+                self.send_body(413, 'text/plain', str(error).encode())
+                return
+            except Overloaded:
+                self.send_response(503)
+                self.send_header('Retry-After', str(RETRY_AFTER_SECONDS))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            except ValueError as error:
+                self.send_body(400, 'text/plain', str(error).encode())
+                return
+            except FilterFailed as error:
+                headers = {'Retry-After': str(RETRY_AFTER_SECONDS)} if error.status == 503 else {}
+                self.send_body(error.status, 'text/plain', str(error).encode(), headers)
+                return
+            except TimeoutError as error:
+                self.send_body(504, 'text/plain', str(error).encode())
+                return
+            headers = {'X-Image-Shape': output_shape} if output_shape is not None else {}
+            self.send_body(200, RAW_CONTENT_TYPE if raw else 'image/png', payload, headers)
+
+        def send_body(self, status: int, content_type: str, body: bytes, headers: dict = None):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class FilterServer(ThreadingHTTPServer):
+        # Clients beyond the listen backlog would get their connection reset instead of a 503
+        request_queue_size = 128
+
+    return FilterServer((SERVICE_HOST, port), FilterHandler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serves filter chains on http://127.0.0.1:<port>/filter.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='Number of filtering processes')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--batch-window', type=float, default=DEFAULT_BATCH_WINDOW_SECONDS,
+                        help='Seconds the dispatcher waits for a batch to fill')
+    parser.add_argument('--max-pending', type=int, default=DEFAULT_MAX_PENDING,
+                        help='Requests accepted at once, further ones get 503')
+    args = parser.parse_args(argv)
+
+    service = FilterService(args.workers, args.batch_size, args.batch_window, args.max_pending)
+    server = create_server(service, args.port)
+    # Terminating the server still unlinks its shared memory
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f'Serving on http://{SERVICE_HOST}:{args.port}/filter with {service.workers} workers', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
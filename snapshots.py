@@ -0,0 +1,193 @@
+import copy
+import itertools
+import threading
+import time
+
+from scheduling import EVENT_PARAMETER, EVENT_STICKER
+
+# Hands the filter chain, the stickers and the still picture from the GUI thread to the render threads as immutable,
+# versioned snapshots. Edits are made on copies and published by replacing a single reference, so a render thread reading the snapshot
+# once per frame never sees half of a change and never takes a lock
+# Must never import PyQt5, so edits can be driven without a display
+
+
+# Everything a frame is rendered from, never changed once published
+# version increases on every published change, chain_version and stickers_version only when that part changed,
+# so caches can key on a number instead of hashing parameters and sticker positions
+# The filters and stickers in it are copies no one else holds, they must not be modified either
+class EditSnapshot:
+    __slots__ = ('version', 'chain', 'chain_version', 'stickers', 'stickers_version')
+
+    def __init__(self, version: int, chain: tuple, chain_version: int, stickers: tuple, stickers_version: int):
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'chain', chain)
+        object.__setattr__(self, 'chain_version', chain_version)
+        object.__setattr__(self, 'stickers', stickers)
+        object.__setattr__(self, 'stickers_version', stickers_version)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('EditSnapshot is immutable')
+
+
+# The still picture being edited, replaced as a whole whenever a picture or its preview is set
+# picture is None while only the preview is loaded (loading is then True) and proxy holds it; proxy may also be None
+# for a fully loaded picture, the render thread then builds it
+# version increases with every picture set, so cached results of the previous one are never reused
+class PictureSource:
+    __slots__ = ('version', 'picture', 'proxy', 'loading')
+
+    def __init__(self, version: int, picture=None, proxy=None, loading: bool = False):
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'picture', picture)
+        object.__setattr__(self, 'proxy', proxy)
+        object.__setattr__(self, 'loading', loading)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('PictureSource is immutable')
+
+    def has_picture(self):
+        return self.picture is not None or self.loading
+
+
+# Edits made by the GUI thread, published as EditSnapshots at most once per min_interval seconds
+# The first change after a quiet period is published at once, the ones following it within min_interval are
+# coalesced into a single snapshot published when the interval ends, so dragging a slider renders at most one
+# frame per interval with its latest value
+# on_publish(snapshot, events) is called after each publication with the scheduling events it implies
+class EditState:
+    def __init__(self, filters: list, min_interval: float = 0.0, on_publish=None):
+        self.lock = threading.Lock()
+        self.min_interval = min_interval
+        self.on_publish = on_publish
+        # filter_id -> latest version of every filter, active or not, so parameters survive toggling a filter off
+        self.filters = {filter_.filter_id: filter_ for filter_ in filters}
+        self.active_ids = ()
+        self.stickers = ()
+        self.versions = itertools.count(1)
+        self.chain_changed = False
+        self.stickers_changed = False
+        self.published_at = float('-inf')
+        self.timer = None
+        self.coalesced = 0
+        self.snapshot = EditSnapshot(0, (), 0, (), 0)
+
+    def active_chain(self):
+        with self.lock:
+            return [self.filters[filter_id] for filter_id in self.active_ids]
+
+    def toggle_filter(self, filter_id: int):
+        with self.lock:
+            if filter_id in self.active_ids:
+                self.active_ids = tuple(active_id for active_id in self.active_ids if active_id != filter_id)
+            else:
+                # New filters go at the end so that they are processed last
+                self.active_ids += (filter_id,)
+            self.chain_changed = True
+        self.changed()
+
+    def set_parameter(self, filter_id: int, value, index: int | None):
+        with self.lock:
+            current = self.filters[filter_id]
+            filter_ = copy.copy(current)
+            filter_.filter_parameter_value = copy.copy(current.filter_parameter_value)
+            filter_.update_parameter_value(value, index)
+            if filter_.parameter_key() == current.parameter_key():
+                return
+            self.replace_filter(filter_)
+        self.changed()
+
+    def set_option(self, filter_id: int, name: str, value):
+        with self.lock:
+            current = self.filters[filter_id]
+            if current.filter_options.get(name) == value:
+                return
+            filter_ = copy.copy(current)
+            filter_.filter_options = dict(current.filter_options, **{name: value})
+            self.replace_filter(filter_)
+        self.changed()
+
+    def replace_filter(self, filter_):
+        self.filters[filter_.filter_id] = filter_
+        if filter_.filter_id in self.active_ids:
+            self.chain_changed = True
+
+    def add_sticker(self, sticker):
+        with self.lock:
+            self.stickers += (sticker,)
+            self.stickers_changed = True
+        self.changed()
+
+    # Removes the oldest sticker, returns how many are left
+    def remove_sticker(self):
+        with self.lock:
+            if self.stickers:
+                self.stickers = self.stickers[1:]
+                self.stickers_changed = True
+            remaining = len(self.stickers)
+        self.changed()
+        return remaining
+
+    # Moves the newest sticker, the sticker published before keeps its position
+    def move_last_sticker(self, dx: int, dy: int):
+        with self.lock:
+            if not self.stickers:
+                return
+            sticker = copy.copy(self.stickers[-1])
+            sticker.x += dx
+            sticker.y += dy
+            self.stickers = self.stickers[:-1] + (sticker,)
+            self.stickers_changed = True
+        self.changed()
+
+    def set_min_interval(self, min_interval: float):
+        self.min_interval = min_interval
+
+    # Publishes now, or schedules publishing at the end of the current interval
+    def changed(self):
+        with self.lock:
+            if not (self.chain_changed or self.stickers_changed):
+                return
+            if self.timer is not None:
+                self.coalesced += 1
+                return
+            remaining = self.published_at + self.min_interval - time.perf_counter()
+            if remaining > 0:
+                self.timer = threading.Timer(remaining, self.publish)
+                self.timer.daemon = True
+                self.timer.start()
+                return
+        self.publish()
+
+    def publish(self):
+        with self.lock:
+            self.timer = None
+            if not (self.chain_changed or self.stickers_changed):
+                return
+            previous = self.snapshot
+            version = next(self.versions)
+            events = set()
+            chain, chain_version = previous.chain, previous.chain_version
+            if self.chain_changed:
+                chain = tuple(self.filters[filter_id] for filter_id in self.active_ids)
+                chain_version = version
+                events.add(EVENT_PARAMETER)
+            stickers, stickers_version = previous.stickers, previous.stickers_version
+            if self.stickers_changed:
+                stickers = self.stickers
+                stickers_version = version
+                events.add(EVENT_STICKER)
+            self.chain_changed = self.stickers_changed = False
+            # Replacing the reference is the whole hand-over: readers get either the previous snapshot or this one
+            self.snapshot = EditSnapshot(version, chain, chain_version, stickers, stickers_version)
+            self.published_at = time.perf_counter()
+            snapshot = self.snapshot
+        if self.on_publish is not None:
+            self.on_publish(snapshot, events)
+
+    # Publishes a pending change right away, e.g. before a copy of the state is exported
+    def flush(self):
+        with self.lock:
+            timer = self.timer
+        if timer is not None:
+            timer.cancel()
+        self.publish()
@@ -0,0 +1,357 @@
+import argparse
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+import cv2 as cv
+import numpy as np
+
+from filters import parse_filter_chain, format_filter_chain
+from overlays import composite_stickers
+from pipeline import ChainCompiler
+from recording import FrameReplay
+from stages import Frame, LatestSlot
+from video import load_sticker, DEFAULT_STICKER_SCALE
+
+# Processes several cameras, videos and images at once, each with its own filter chain and stickers,
+# on one shared pool of worker threads instead of a busy thread per source
+# Capture threads only wait on their source and keep its newest frame, the workers pick the next source to process
+# with a fair scheduler: the runnable source that used the least processing time, weighted by its priority
+# Must never import PyQt5, it is also used headless and with synthetic sources
+
+SOURCE_FIELD_SEPARATOR = '|'
+DEFAULT_SYNTHETIC_SIZE = (640, 480)
+# Rate at which sources that never block (images, synthetic frames) produce frames when they have no FPS cap
+DEFAULT_CAPTURE_FPS = 30
+FPS_HISTORY_SECONDS = 2.0
+CAPTURE_RETRY_SECONDS = 0.5
+
+_synthetic_seeds = itertools.count()
+
+
+# max_fps: most frames per second processed for this source, 0 for no cap
+# priority: relative share of the processing time while the workers are saturated
+# capture_fps: rate at which read_frame is called, None for sources whose read_frame waits for the next frame itself
+class FrameSource:
+    _ids = itertools.count()
+
+    def __init__(self, name: str, read_frame, chain: list, stickers: list = None, max_fps: float = 0, priority: float = 1,
+                 capture_fps: float = None, release=None):
+        if priority <= 0:
+            raise ValueError(f'Priority of {name} must be positive')
+        self.source_id = next(FrameSource._ids)
+        self.name = name
+        self.read_frame = read_frame
+        self.chain = chain
+        self.stickers = stickers if stickers is not None else []
+        self.max_fps = max_fps
+        self.priority = priority
+        self.capture_fps = capture_fps
+        self.release = release
+        self.slot = LatestSlot()
+        self.sequence = itertools.count()
+        # Only one worker processes a source at a time, so its ChainCompiler is never shared
+        self.chain_compiler = ChainCompiler()
+        self.busy = False
+        # Processing time used so far divided by priority, the scheduler runs the source with the lowest
+        self.virtual_time = 0.0
+        self.next_due = 0.0
+        self.latest = None
+        self.processed = 0
+        self.cost_seconds = 0.0
+        self.processed_times = deque()
+        # Frames whose processing raised, and the last exception, shown in the stats
+        self.errors = 0
+        self.last_error = None
+
+    def frame_interval(self):
+        return 1.0 / self.max_fps if self.max_fps > 0 else 0.0
+
+    def process(self, frame: Frame):
+        image = composite_stickers(frame.image, self.stickers)
+        frame.image = self.chain_compiler.apply(image, self.chain, expand_grey=False)
+        return frame
+
+    def fps(self):
+        if len(self.processed_times) < 2:
+            return 0.0
+        return (len(self.processed_times) - 1) / (self.processed_times[-1] - self.processed_times[0])
+
+    def dropped(self):
+        return self.slot.dropped
+
+    def stats_text(self):
+        cost = self.cost_seconds / self.processed * 1000 if self.processed else 0.0
+        text = (f'{self.name}: {self.fps():.1f} fps, {self.processed} processed, {self.dropped()} dropped, '
+                f'{cost:.1f} ms/frame')
+        if self.errors:
+            text += f', {self.errors} errors (last: {self.last_error})'
+        return text
+
+
+# Shared pool of worker threads processing every source
+# on_result(source, frame) is called by the worker that processed the frame
+class SourceScheduler:
+    def __init__(self, workers: int = None, on_result=None):
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.on_result = on_result
+        self.condition = threading.Condition()
+        self.sources = []
+        # Virtual time of the last source selected, sources that sat idle are brought up to it
+        self.virtual_clock = 0.0
+        self.stopped = threading.Event()
+        self.worker_threads = []
+        self.capture_threads = {}
+        self.started_wall_time = None
+        self.started_cpu_time = None
+
+    def add_source(self, source: FrameSource):
+        with self.condition:
+            # A new source starts level with the others instead of catching up on the time it was not there
+            source.virtual_time = self.virtual_clock
+            self.sources.append(source)
+        if self.worker_threads:
+            self.start_capture(source)
+
+    def remove_source(self, source: FrameSource):
+        with self.condition:
+            self.sources.remove(source)
+        source.slot.close()
+        thread = self.capture_threads.pop(source.source_id, None)
+        if thread is not None:
+            thread.join()
+        if source.release is not None:
+            source.release()
+
+    def start(self):
+        self.started_wall_time = time.perf_counter()
+        self.started_cpu_time = time.process_time()
+        self.worker_threads = [threading.Thread(target=self.worker_loop, daemon=True) for _ in range(self.workers)]
+        for thread in self.worker_threads:
+            thread.start()
+        for source in list(self.sources):
+            self.start_capture(source)
+
+    def stop(self):
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+        for source in list(self.sources):
+            self.remove_source(source)
+        for thread in self.worker_threads:
+            thread.join()
+
+    def start_capture(self, source: FrameSource):
+        thread = threading.Thread(target=self.capture_loop, args=(source,), daemon=True)
+        self.capture_threads[source.source_id] = thread
+        thread.start()
+
+    def capture_loop(self, source: FrameSource):
+        next_capture = time.perf_counter()
+        while not self.stopped.is_set() and not source.slot.closed:
+            if source.capture_fps:
+                # Sources that never block would otherwise produce frames as fast as the CPU allows
+                next_capture = max(next_capture + 1.0 / source.capture_fps, time.perf_counter())
+                self.stopped.wait(max(next_capture - time.perf_counter(), 0.0))
+            ret, image = source.read_frame()
+            if not ret:
+                self.stopped.wait(CAPTURE_RETRY_SECONDS)
+                continue
+            source.slot.put(Frame(next(source.sequence), image))
+            with self.condition:
+                self.condition.notify()
+
+    # Runnable sources have a frame waiting, are not being processed and are not held back by their FPS cap
+    # Returns the source to process, or the number of seconds until one of the capped sources is due
+    def select_source(self, now: float):
+        runnable = None
+        next_due = None
+        for source in self.sources:
+            if source.busy or source.slot.item is None:
+                continue
+            if source.next_due > now:
+                next_due = source.next_due if next_due is None else min(next_due, source.next_due)
+                continue
+            if runnable is None or (source.virtual_time, -source.priority) < (runnable.virtual_time, -runnable.priority):
+                runnable = source
+        if runnable is not None:
+            return runnable, None
+        return None, None if next_due is None else next_due - now
+
+    def next_task(self):
+        with self.condition:
+            while not self.stopped.is_set():
+                now = time.perf_counter()
+                source, wait = self.select_source(now)
+                if source is not None:
+                    frame = source.slot.get(0)
+                    source.busy = True
+                    # Time a source spent without frames (e.g. a camera reconnecting) is not credit to monopolise the pool
+                    source.virtual_time = max(source.virtual_time, self.virtual_clock)
+                    self.virtual_clock = source.virtual_time
+                    # A late frame does not make the next ones come faster, they are paced from now instead
+                    source.next_due = max(source.next_due + source.frame_interval(), now)
+                    return source, frame
+                self.condition.wait(wait)
+            return None, None
+
+    def worker_loop(self):
+        while True:
+            source, frame = self.next_task()
+            if source is None:
+                return
+            start = time.perf_counter()
+            error = None
+            try:
+                frame = source.process(frame)
+            except Exception as exception:
+                # A failing chain drops the frame, the worker goes on serving this and the other sources
+                error = exception
+            finally:
+                cost = time.perf_counter() - start
+                with self.condition:
+                    if error is not None:
+                        source.errors += 1
+                        source.last_error = f'{type(error).__name__}: {error}'
+                    source.busy = False
+                    source.virtual_time += cost / source.priority
+                    source.processed += 1
+                    source.cost_seconds += cost
+                    source.processed_times.append(time.perf_counter())
+                    while source.processed_times[-1] - source.processed_times[0] > FPS_HISTORY_SECONDS:
+                        source.processed_times.popleft()
+                    self.condition.notify()
+            if error is not None:
+                continue
+            source.latest = frame
+            if self.on_result is not None:
+                self.on_result(source, frame)
+
+    # Share of one core used by the whole process since start (1.0 = one core busy)
+    def cpu_usage(self):
+        if self.started_wall_time is None:
+            return 0.0
+        elapsed = time.perf_counter() - self.started_wall_time
+        return (time.process_time() - self.started_cpu_time) / elapsed if elapsed > 0 else 0.0
+
+    def stats_text(self):
+        lines = [f'{len(self.sources)} sources on {self.workers} workers, CPU {self.cpu_usage():.0%}']
+        lines += ['  ' + source.stats_text() for source in self.sources]
+        return '\n'.join(lines)
+
+
+# Moving gradient with a noise texture, so filters have edges to work on without a camera
+def synthetic_reader(width: int, height: int, seed: int = 0):
+    texture = np.random.default_rng(seed).integers(0, 64, (height, width, 3), dtype=np.uint8)
+    gradient = np.linspace(0, 191, width, dtype=np.uint8)[np.newaxis, :, np.newaxis]
+    counter = itertools.count()
+
+    def read_frame():
+        shift = next(counter) * 4 % width
+        return True, cv.add(np.roll(gradient, shift, axis=1).repeat(height, axis=0).repeat(3, axis=2), texture)
+    return read_frame
+
+
+def looping_video_reader(capture: cv.VideoCapture):
+    def read_frame():
+        ret, image = capture.read()
+        if not ret:
+            capture.set(cv.CAP_PROP_POS_FRAMES, 0)
+            ret, image = capture.read()
+        return ret, image
+    return read_frame
+
+
+# Source descriptions are fields separated by "|": the source itself, then optional settings, e.g.
+# "camera=0 | chain=Gaussian Blur: 9, 9 > Canny: 50, 150 | fps=15 | priority=2 | sticker=pictures/sticker1.png@10,10"
+# Sources: camera=<index>, video=<path> (looped), image=<path>, synthetic=<width>x<height>,
+# replay=<path> (a recording made with recording.py, looped at its recorded timing)
+def parse_source(description: str, sticker_scale: float = DEFAULT_STICKER_SCALE):
+    fields = [field.strip() for field in description.split(SOURCE_FIELD_SEPARATOR) if field.strip()]
+    if not fields:
+        raise ValueError('Empty source description')
+    kind, _, value = fields[0].partition('=')
+    kind, value = kind.strip(), value.strip()
+    settings = {'chain': '', 'fps': '0', 'priority': '1'}
+    stickers = []
+    for field in fields[1:]:
+        key, _, setting = field.partition('=')
+        key = key.strip()
+        if key == 'sticker':
+            stickers.append(load_sticker(setting.strip(), sticker_scale))
+        elif key in settings:
+            settings[key] = setting.strip()
+        else:
+            raise ValueError(f'Unknown source setting: {key}')
+    chain = parse_filter_chain(settings['chain'])
+    max_fps = float(settings['fps'])
+    priority = float(settings['priority'])
+    capture_fps = max_fps if max_fps > 0 else DEFAULT_CAPTURE_FPS
+    name = f'{kind}:{value}' if value else kind
+
+    if kind == 'camera':
+        capture = cv.VideoCapture(int(value))
+        if not capture.isOpened():
+            raise FileNotFoundError(f'Could not open camera {value}')
+        capture.set(cv.CAP_PROP_BUFFERSIZE, 1)
+        return FrameSource(name, capture.read, chain, stickers, max_fps, priority, release=capture.release)
+    if kind == 'video':
+        capture = cv.VideoCapture(value)
+        if not capture.isOpened():
+            raise FileNotFoundError(f'Could not open video {value}')
+        video_fps = capture.get(cv.CAP_PROP_FPS)
+        return FrameSource(name, looping_video_reader(capture), chain, stickers, max_fps, priority,
+                           video_fps if video_fps > 0 else capture_fps, capture.release)
+    if kind == 'replay':
+        replay = FrameReplay(value, loop=True)
+        return FrameSource(name, replay.read, chain, stickers, max_fps, priority, release=replay.release)
+    if kind == 'image':
+        image = cv.imread(value)
+        if image is None:
+            raise FileNotFoundError(f'Could not read image {value}')
+        # Stickers are drawn in place, so every frame is a copy of the picture
+        return FrameSource(name, lambda: (True, image.copy()), chain, stickers, max_fps, priority, capture_fps)
+    if kind == 'synthetic':
+        width, height = (int(size) for size in value.split('x')) if value else DEFAULT_SYNTHETIC_SIZE
+        return FrameSource(name, synthetic_reader(width, height, next(_synthetic_seeds)), chain, stickers, max_fps, priority,
+                           capture_fps)
+    raise ValueError(f'Unknown source type: {kind}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Processes several sources at once on a shared pool of workers.')
+    parser.add_argument('--source', action='append', required=True,
+                        help='e.g. "synthetic=640x480 | chain=Blur: 9, 9 > Canny: 50, 150 | fps=15 | priority=2"; '
+                             'may be repeated')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--seconds', type=float, default=10.0, help='How long to run')
+    parser.add_argument('--sticker-scale', type=float, default=DEFAULT_STICKER_SCALE)
+    args = parser.parse_args(argv)
+
+    try:
+        sources = [parse_source(description, args.sticker_scale) for description in args.source]
+    except (ValueError, FileNotFoundError) as error:
+        parser.error(str(error))
+    scheduler = SourceScheduler(args.workers)
+    for source in sources:
+        print(f'{source.name}: "{format_filter_chain(source.chain)}", fps cap {source.max_fps or "none"}, '
+              f'priority {source.priority:g}')
+        scheduler.add_source(source)
+    scheduler.start()
+    try:
+        deadline = time.perf_counter() + args.seconds
+        while time.perf_counter() < deadline:
+            time.sleep(min(1.0, max(deadline - time.perf_counter(), 0.0)))
+            print(scheduler.stats_text())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+from collections import OrderedDict
+
+from pipeline import apply_stage
+
+DEFAULT_STAGE_CACHE_BYTES = 512 * 2 ** 20
+
+
+# Least recently used cache of intermediate images, bounded by the total number of bytes it holds
+class StageCache:
+    def __init__(self, max_bytes: int = DEFAULT_STAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        image = self.entries.get(key)
+        if image is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return image
+
+    def put(self, key, image):
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key).nbytes
+        # An image bigger than the whole cache would only evict everything else
+        if image.nbytes > self.max_bytes:
+            return
+        self.entries[key] = image
+        self.total_bytes += image.nbytes
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= evicted.nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+
+# Runs the compiled stages reusing the longest prefix already in the cache
+# The key of stage k holds the source key and the parameters of stages 1 to k, so changing stage k
+# only recomputes stages k to n, and an unchanged chain does no processing at all
+# Cached images are shared, so stages must never modify their input in place
+def apply_cached(cache: StageCache, source_key, load_source, stages: list, executor=None):
+    keys = [(source_key,)]
+    for stage in stages:
+        keys.append(keys[-1] + (stage.parameter_key(),))
+
+    first_stage = 0
+    image = None
+    for index in range(len(keys) - 1, -1, -1):
+        image = cache.get(keys[index])
+        if image is not None:
+            first_stage = index
+            break
+    if image is None:
+        image = load_source()
+        cache.put(keys[0], image)
+
+    for index in range(first_stage, len(stages)):
+        image = apply_stage(stages[index], image, executor)
+        cache.put(keys[index + 1], image)
+    return image, keys[-1]
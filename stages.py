@@ -0,0 +1,177 @@
+import itertools
+import sys
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from profiling import PROFILER
+
+DEFAULT_PROCESSING_THREADS = 2
+LATENCY_HISTORY = 120
+CAPTURE_RETRY_SECONDS = 0.5
+
+
+# A captured image travelling through the capture, processing and presentation stages
+class Frame:
+    def __init__(self, sequence: int, image: np.ndarray):
+        self.sequence = sequence
+        self.image = image
+        self.captured_at = time.perf_counter()
+
+
+# Bounded queue with a single slot: putting a new item replaces the one waiting, so consumers always get the newest
+# When ordered, items older than the last one accepted are dropped, so they leave the slot in sequence order
+class LatestSlot:
+    def __init__(self, ordered: bool = False):
+        self.condition = threading.Condition()
+        self.item = None
+        self.ordered = ordered
+        self.last_sequence = -1
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item: Frame):
+        with self.condition:
+            if self.ordered and item.sequence <= self.last_sequence:
+                self.dropped += 1
+                return False
+            if self.item is not None:
+                self.dropped += 1
+            self.item = item
+            self.last_sequence = item.sequence
+            self.condition.notify()
+            return True
+
+    def get(self, timeout: float = None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.item is not None or self.closed, timeout)
+            item = self.item
+            self.item = None
+            return item
+
+    def depth(self):
+        return 0 if self.item is None else 1
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+# Runs capture and processing on their own threads, connected to each other and to the presenter by LatestSlots
+# read_frame returns (ret, image) like cv.VideoCapture.read
+# create_processor is called once per processing thread and returns a function from image to processed image,
+# so that each thread can keep its own state (e.g. a ChainCompiler)
+# pace is called by a processing thread before it starts a frame, so the frame rate can be limited
+class FramePipeline:
+    def __init__(self, read_frame, create_processor, pace=None, processing_threads: int = DEFAULT_PROCESSING_THREADS):
+        self.read_frame = read_frame
+        self.create_processor = create_processor
+        self.pace = pace
+        self.pace_lock = threading.Lock()
+        self.processing_threads = processing_threads
+        self.capture_slot = LatestSlot()
+        self.output_slot = LatestSlot(ordered=True)
+        self.sequence = itertools.count()
+        self.running = threading.Event()
+        self.stopped = threading.Event()
+        self.threads = []
+        self.busy_threads = 0
+        self.busy_lock = threading.Lock()
+        self.latencies = deque(maxlen=LATENCY_HISTORY)
+        # Frames whose processing raised, and the last exception, shown in the stats
+        self.errors = 0
+        self.last_error = None
+
+    def start(self):
+        self.running.set()
+        self.threads = [threading.Thread(target=self.capture_loop, daemon=True)]
+        self.threads += [threading.Thread(target=self.processing_loop, daemon=True) for _ in range(self.processing_threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.running.set()
+        self.capture_slot.close()
+        self.output_slot.close()
+        for thread in self.threads:
+            thread.join()
+
+    # Paused pipelines neither read nor process frames, e.g. while a still image is shown instead of the camera
+    def set_paused(self, paused: bool):
+        if paused:
+            self.running.clear()
+        else:
+            self.running.set()
+
+    def capture_loop(self):
+        while not self.stopped.is_set():
+            self.running.wait()
+            if self.stopped.is_set():
+                break
+            start = PROFILER.start()
+            ret, image = self.read_frame()
+            PROFILER.stop('capture', start)
+            if not ret:
+                self.stopped.wait(CAPTURE_RETRY_SECONDS)
+                continue
+            self.capture_slot.put(Frame(next(self.sequence), image))
+
+    def processing_loop(self):
+        process = self.create_processor()
+        while not self.stopped.is_set():
+            if self.pace is not None:
+                with self.pace_lock:
+                    self.pace()
+            frame = self.capture_slot.get()
+            if frame is None:
+                continue
+            with self.busy_lock:
+                self.busy_threads += 1
+            start = PROFILER.start()
+            error = None
+            try:
+                frame.image = process(frame.image)
+            except Exception as exception:
+                # A failing chain drops the frame, the thread goes on processing the next ones
+                error = f'{type(exception).__name__}: {exception}'
+            finally:
+                PROFILER.stop('process', start)
+                with self.busy_lock:
+                    self.busy_threads -= 1
+                    if error is not None:
+                        self.errors += 1
+                        repeated = error == self.last_error
+                        self.last_error = error
+            if error is not None:
+                # Logged once per distinct error, a chain failing on every frame would flood the output
+                if not repeated:
+                    print(f'Frame processing failed: {error}', file=sys.stderr)
+                continue
+            self.output_slot.put(frame)
+
+    # Called by the presentation stage, returns None if no frame was ready before the timeout
+    def next_frame(self, timeout: float = None):
+        return self.output_slot.get(timeout)
+
+    def frame_presented(self, frame: Frame):
+        latency = time.perf_counter() - frame.captured_at
+        self.latencies.append(latency)
+        if PROFILER.enabled:
+            PROFILER.record('latency', latency)
+
+    def dropped_frames(self):
+        return self.capture_slot.dropped + self.output_slot.dropped
+
+    def stats_text(self):
+        text = (f'Queues: capture {self.capture_slot.depth()}, processing {self.busy_threads}/{self.processing_threads}, '
+                f'present {self.output_slot.depth()} | Dropped: {self.dropped_frames()}')
+        if self.errors:
+            text += f' | Errors: {self.errors} (last: {self.last_error})'
+        if self.latencies:
+            latencies = np.array(self.latencies) * 1000
+            text += f' | Latency: {np.median(latencies):.1f} ms (p95 {np.percentile(latencies, 95):.1f} ms)'
+        return text
@@ -0,0 +1,54 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Frames smaller than this are filtered in a single call, splitting them costs more than it saves
+DEFAULT_MIN_TILED_PIXELS = 1920 * 1080
+# Stripes are never made thinner than this many times their halo, so that halos stay a small overhead
+MIN_STRIPE_TO_HALO_RATIO = 2
+
+
+# Splits large frames in horizontal stripes, filters them on a thread pool and stitches the results
+# Each stripe is extended by the stage's halo so the stitched result matches the whole-frame result exactly
+# Stages declare their halo with get_tile_halo(), stages returning None are always applied to the whole frame
+class TiledExecutor:
+    def __init__(self, threads: int = None, min_pixels: int = DEFAULT_MIN_TILED_PIXELS):
+        self.threads = threads if threads is not None else os.cpu_count()
+        self.min_pixels = min_pixels
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+
+    def stripe_bounds(self, height: int, halo: int):
+        stripe_count = self.threads
+        if halo > 0:
+            stripe_count = min(stripe_count, height // (MIN_STRIPE_TO_HALO_RATIO * halo))
+        stripe_count = max(1, stripe_count)
+        stripe_height = math.ceil(height / stripe_count)
+        return [(top, min(top + stripe_height, height)) for top in range(0, height, stripe_height)]
+
+    # dst: optional array the result is written to, every stripe is computed before any of it is written,
+    # so it may be the input of a stage that works in place
+    def apply(self, stage, image, dst: np.ndarray = None):
+        halo = stage.get_tile_halo()
+        height = image.shape[0]
+        if halo is None or image.shape[0] * image.shape[1] < self.min_pixels:
+            return stage.apply_layout(image, dst)
+        bounds = self.stripe_bounds(height, halo)
+        if len(bounds) == 1:
+            return stage.apply_layout(image, dst)
+
+        def apply_stripe(top, bottom):
+            extended_top = max(0, top - halo)
+            extended_bottom = min(height, bottom + halo)
+            result = stage.apply_layout(image[extended_top:extended_bottom])
+            return result[top - extended_top:bottom - extended_top]
+
+        stripes = list(self.pool.map(lambda stripe: apply_stripe(*stripe), bounds))
+        output = dst if dst is not None else np.empty((height,) + stripes[0].shape[1:], dtype=stripes[0].dtype)
+        for (top, bottom), stripe in zip(bounds, stripes):
+            output[top:bottom] = stripe
+        return output
+
+    def shutdown(self):
+        self.pool.shutdown()
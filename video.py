@@ -0,0 +1,151 @@
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2 as cv
+
+from filters import parse_filter_chain, format_filter_chain, expand_to_bgr
+from image_loading import load_sticker_image
+from overlays import Sticker, composite_stickers
+from pipeline import ChainCompiler
+
+# Streams a video file through the same stickers and filter chain as the app and writes the result in order
+# Only max_in_flight frames exist at any time, so memory use does not depend on the length of the video
+# Must never import PyQt5, it is also used headless
+
+DEFAULT_FOURCC = 'mp4v'
+DEFAULT_STICKER_SCALE = 0.1
+
+
+class VideoStats:
+    def __init__(self, frames: int, elapsed: float, source_fps: float):
+        self.frames = frames
+        self.elapsed = elapsed
+        self.source_fps = source_fps
+
+    def fps(self):
+        return self.frames / self.elapsed if self.elapsed > 0 else 0.0
+
+    # How many times faster than the video's own frame rate it was processed
+    def realtime_factor(self):
+        return self.fps() / self.source_fps if self.source_fps > 0 else 0.0
+
+    def __str__(self):
+        return (f'{self.frames} frames in {self.elapsed:.2f}s, {self.fps():.1f} frames/s, '
+                f'{self.realtime_factor():.2f}x real time')
+
+
+def read_frames(capture: cv.VideoCapture):
+    while True:
+        ret, frame = capture.read()
+        if not ret:
+            return
+        yield frame
+
+
+# Applies stickers and filters on a thread pool, each thread with its own ChainCompiler
+class FrameProcessor:
+    def __init__(self, chain: list, stickers: list = None):
+        self.chain = chain
+        self.stickers = stickers if stickers is not None else []
+        self.local = threading.local()
+
+    def __call__(self, frame):
+        if not hasattr(self.local, 'chain_compiler'):
+            self.local.chain_compiler = ChainCompiler()
+        frame = composite_stickers(frame, self.stickers)
+        return self.local.chain_compiler.apply(frame, self.chain)
+
+
+# progress(frames_done, total_frames) is called after each written frame, total_frames is 0 when unknown
+# Processing stops early when cancelled (a threading.Event) is set; the frames written so far are kept
+def process_video(input_path: str, output_path: str, chain: list, stickers: list = None, workers: int = None,
+                  max_in_flight: int = None, fourcc: str = DEFAULT_FOURCC, progress=None, cancelled=None):
+    capture = cv.VideoCapture(input_path)
+    if not capture.isOpened():
+        raise FileNotFoundError(f'Could not open video {input_path}')
+    source_fps = capture.get(cv.CAP_PROP_FPS)
+    total_frames = max(int(capture.get(cv.CAP_PROP_FRAME_COUNT)), 0)
+    size = (int(capture.get(cv.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv.CAP_PROP_FRAME_HEIGHT)))
+    writer = cv.VideoWriter(output_path, cv.VideoWriter_fourcc(*fourcc), source_fps if source_fps > 0 else 30, size)
+    if not writer.isOpened():
+        capture.release()
+        raise ValueError(f'Could not write video {output_path}')
+
+    workers = workers if workers is not None else os.cpu_count()
+    max_in_flight = max_in_flight if max_in_flight is not None else 2 * workers
+    process = FrameProcessor(chain, stickers)
+    in_flight = deque()
+    written = 0
+    start = time.perf_counter()
+
+    def write_oldest():
+        nonlocal written
+        writer.write(expand_to_bgr(in_flight.popleft().result()))
+        written += 1
+        if progress is not None:
+            progress(written, total_frames)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for frame in read_frames(capture):
+                if cancelled is not None and cancelled.is_set():
+                    break
+                # Results are written in the order frames were submitted, waiting for the oldest when the pool is full
+                if len(in_flight) >= max_in_flight:
+                    write_oldest()
+                in_flight.append(executor.submit(process, frame))
+            while in_flight:
+                write_oldest()
+    finally:
+        capture.release()
+        writer.release()
+    return VideoStats(written, time.perf_counter() - start, source_fps)
+
+
+# Sticker arguments are "path" (centered) or "path@x,y"
+def load_sticker(argument: str, scale: float):
+    path, _, position = argument.partition('@')
+    image = load_sticker_image(path, scale)
+    if image is None:
+        raise FileNotFoundError(f'Could not read sticker {path}')
+    if position:
+        x, y = (int(value) for value in position.split(','))
+        return Sticker(image, x, y)
+    return Sticker(image)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Applies stickers and a filter chain to a video file without opening a window.')
+    parser.add_argument('input', help='Video file to read')
+    parser.add_argument('chain', help='Filters in application order, e.g. "Gaussian Blur: 9, 9 > Canny: 50, 150"')
+    parser.add_argument('output', help='Video file to write')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='Number of processing threads')
+    parser.add_argument('--max-in-flight', type=int, help='Frames decoded but not yet written, twice the workers by default')
+    parser.add_argument('--fourcc', default=DEFAULT_FOURCC, help='Codec of the output video')
+    parser.add_argument('--sticker', action='append', default=[], help='Sticker PNG, as "path" or "path@x,y"; may be repeated')
+    parser.add_argument('--sticker-scale', type=float, default=DEFAULT_STICKER_SCALE)
+    args = parser.parse_args(argv)
+
+    try:
+        chain = parse_filter_chain(args.chain)
+        stickers = [load_sticker(argument, args.sticker_scale) for argument in args.sticker]
+        print(f'Applying "{format_filter_chain(chain)}" to {args.input}')
+
+        def progress(done, total):
+            if done % 25 == 0 or done == total:
+                print(f'\r{done}/{total or "?"} frames', end='', flush=True)
+        stats = process_video(args.input, args.output, chain, stickers, args.workers, args.max_in_flight, args.fourcc, progress)
+    except (ValueError, FileNotFoundError) as error:
+        parser.error(str(error))
+    print()
+    print(stats)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())